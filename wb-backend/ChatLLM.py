@@ -1,13 +1,37 @@
 import os
-from openai import OpenAI
+import asyncio
+import threading
+from collections import OrderedDict
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, APIConnectionError, APITimeoutError
 from dashscope.audio.asr import Recognition
-from dashscope.audio.tts_v2 import SpeechSynthesizer, AudioFormat
+from dashscope.audio.tts_v2 import SpeechSynthesizer, SpeechSynthesizerObjectPool, AudioFormat, ResultCallback
 from pydantic import BaseModel
 import dataModel
+from wb_tts_cache import tts_cache
+from wb_blob import blob_store
+from wb_image import image_variants
+import wb_context
+import wb_telemetry
+import wb_admission
+import logging
+import time
 import datetime
 from http import HTTPStatus
-from typing import List, Dict, Any, Iterator, Optional
+from typing import List, Dict, Any, Iterator, AsyncIterator, Optional
 import base64
+import io
+import wave
+
+
+# 客户端复用配置：注册表最多缓存的 LLM 客户端数、每个 base_url 的连接上限与 keep-alive 时长
+LLM_POOL_SIZE = int(os.getenv("WB_LLM_POOL_SIZE", "8"))
+LLM_MAX_CONNECTIONS = int(os.getenv("WB_LLM_MAX_CONNECTIONS", "100"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("WB_LLM_KEEPALIVE_EXPIRY", "120"))
+# 覆盖所有模型的 base_url，用于把请求指向代理或本地压测用的模拟服务
+LLM_BASE_URL = os.getenv("WB_LLM_BASE_URL") or None
+# 预连接的语音合成器数量，0 表示不使用连接池
+TTS_POOL_SIZE = int(os.getenv("WB_TTS_POOL_SIZE", "4"))
 
 
 
@@ -46,24 +70,29 @@ class LLMTextClient:
     MODEL_CONFIGS = {
         "qwen-plus": {
             "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
-            "api_key_env": "DASHSCOPE_API_KEY"
+            "api_key_env": "DASHSCOPE_API_KEY",
+            "context_tokens": 131072
         },
         "qwen-max": {
             "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
-            "api_key_env": "DASHSCOPE_API_KEY"
+            "api_key_env": "DASHSCOPE_API_KEY",
+            "context_tokens": 32768
         },
         "qwen-omni-turbo": {
             "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
-            "api_key_env": "DASHSCOPE_API_KEY"
+            "api_key_env": "DASHSCOPE_API_KEY",
+            "context_tokens": 32768
         },
         "qwen-vl-max-latest": {
             "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
-            "api_key_env": "DASHSCOPE_API_KEY"
+            "api_key_env": "DASHSCOPE_API_KEY",
+            "context_tokens": 131072
         }
         # 示例：未来可添加 OpenAI 模型
         # "gpt-4": {
         #     "base_url": "https://api.openai.com/v1",
-        #     "api_key_env": "OPENAI_API_KEY"
+        #     "api_key_env": "OPENAI_API_KEY",
+        #     "context_tokens": 8192
         # }
     }
 
@@ -72,7 +101,9 @@ class LLMTextClient:
         model: str = "qwen-omni-turbo",
         system_message: str = SYSTEM_MESSAGE,
         api_key: Optional[str] = None,
-        base_url: Optional[str] = None
+        base_url: Optional[str] = None,
+        http_client: Optional[httpx.Client] = None,
+        async_http_client: Optional[httpx.AsyncClient] = None
     ):
         """
         初始化 LLM 客户端。
@@ -81,6 +112,8 @@ class LLMTextClient:
         :param system_message: 系统提示语
         :param api_key: 可选，API 密钥（优先使用）
         :param base_url: 可选，API 基础 URL（优先使用）
+        :param http_client: 可选，共享的 HTTP 连接池（同步）
+        :param async_http_client: 可选，共享的 HTTP 连接池（异步）
         """
         if model not in self.MODEL_CONFIGS and (base_url is None or api_key is None):
             raise ValueError(f"Model '{model}' not in MODEL_CONFIGS. "
@@ -90,24 +123,43 @@ class LLMTextClient:
         self.model = model
         self.system_message = system_message
         self.api_key = api_key or os.getenv(config.get("api_key_env"))
-        self.base_url = base_url or config.get("base_url")
+        self.base_url = base_url or LLM_BASE_URL or config.get("base_url")
 
         if not self.api_key:
             raise ValueError(f"API key is required. Set it via arg or env {config.get('api_key_env')}")
 
-        self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
+        # 上游返回 429 时由 openai SDK 按 Retry-After 指数退避重试
+        self.client = OpenAI(api_key=self.api_key, base_url=self.base_url, http_client=http_client,
+                             max_retries=wb_admission.UPSTREAM_RETRY_ATTEMPTS)
+        # 异步客户端，供 websocket 等 async 场景使用，避免阻塞事件循环
+        self.async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, http_client=async_http_client,
+                                        max_retries=wb_admission.UPSTREAM_RETRY_ATTEMPTS)
+        # 上下文窗口：按模型窗口大小（扣除输出预留）与全局上限取较小值作为历史消息的预算
+        context_tokens = config.get("context_tokens", wb_context.CONTEXT_MAX_TOKENS)
+        self.context_window = wb_context.ContextWindow(
+            min(context_tokens - wb_context.CONTEXT_OUTPUT_RESERVE, wb_context.CONTEXT_MAX_TOKENS),
+            summarizer=summarize_context if wb_context.CONTEXT_SUMMARY else None
+        )
 
     def _format_messages(self, history: List[Dict[str, Any]], system_prompt: Optional[str] = None) -> List[Dict[str, str]]:
         """
         将用户输入的历史消息转换为标准 OpenAI 格式，并插入系统消息。
+        历史消息先经过上下文窗口裁剪，只有保留下来的消息才会还原 blob 引用中的媒体。
         """
+        start = time.perf_counter()
         messages = []
         # messages = [
         #     {"role": "user" if msg["isUser"] else "assistant", "content": msg["text"]}
         #     for msg in history
         # ]
 
-        for msg in history:
+        system_message = system_prompt if system_prompt is not None else self.system_message
+        history, summary = self.context_window.build(history, system_message)
+        if summary:
+            system_message = system_message + "\n\n以下是更早对话的摘要：\n" + summary
+
+        # 图片先换成缩放、压缩后的变体，减小请求体积
+        for msg in blob_store.inline_messages(image_variants.model_messages(history)):
             role = "user" if msg["isUser"] else "assistant"
             
             # 处理包含图像的消息
@@ -150,8 +202,8 @@ class LLMTextClient:
 
 
         # 插入系统消息在最前面，优先使用传入的system_prompt
-        system_message = system_prompt if system_prompt is not None else self.system_message
         messages.insert(0, {"role": "system", "content": system_message})
+        wb_telemetry.CHAT_STAGE_SECONDS.labels(stage="format_messages").observe(time.perf_counter() - start)
         return messages
 
     def generate(self, messages: List[Dict[str, Any]], system_prompt: Optional[str] = None) -> str:
@@ -188,28 +240,444 @@ class LLMTextClient:
             stream_options={"include_usage": True}
         )
 
+    async def agenerate(self, messages: List[Dict[str, Any]], system_prompt: Optional[str] = None) -> str:
+        """
+        generate 的异步版本，基于 AsyncOpenAI，不阻塞事件循环。
+        """
+        # 整理消息会读取 blob、生成图片变体，放到线程池中执行
+        formatted_msgs = await asyncio.to_thread(self._format_messages, list(messages), system_prompt)
+        completion = await self.async_client.chat.completions.create(
+            model=self.model,
+            messages=formatted_msgs,
+            modalities=["text"],
+            stream=False
+        )
+        return completion.choices[0].message.content
+
+    async def astream(self, messages: List[Dict[str, Any]], system_prompt: Optional[str] = None) -> AsyncIterator:
+        """
+        stream 的异步版本，返回可 async for 迭代的 chunk 流。
+        """
+        # 整理消息会读取 blob、计算哈希、生成图片变体，放到线程池中执行，不阻塞其它会话
+        formatted_msgs = await asyncio.to_thread(self._format_messages, list(messages), system_prompt)
+        return await self.async_client.chat.completions.create(
+            model=self.model,
+            messages=formatted_msgs,
+            modalities=["text"],
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+
+class LLMClientRegistry:
+    """
+    进程级的 LLM 客户端注册表，按 (model, base_url) 复用 LLMTextClient。
+    同一 base_url 的客户端共享一个 keep-alive 连接池，省去每轮对话的 TLS 握手。
+    """
+
+    def __init__(self, max_size: int = LLM_POOL_SIZE):
+        self.max_size = max_size
+        self._clients: OrderedDict[tuple, LLMTextClient] = OrderedDict()
+        self._http_clients: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def _get_http_clients(self, base_url: str) -> tuple:
+        if base_url not in self._http_clients:
+            limits = httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                                  max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                                  keepalive_expiry=LLM_KEEPALIVE_EXPIRY)
+            self._http_clients[base_url] = (DefaultHttpxClient(limits=limits), DefaultAsyncHttpxClient(limits=limits))
+        return self._http_clients[base_url]
+
+    def get(self, model: str, base_url: Optional[str] = None) -> LLMTextClient:
+        base_url = base_url or LLM_BASE_URL or LLMTextClient.MODEL_CONFIGS.get(model, {}).get("base_url")
+        key = (model, base_url)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+            http_client, async_http_client = self._get_http_clients(base_url)
+            client = LLMTextClient(model=model, base_url=base_url,
+                                   http_client=http_client, async_http_client=async_http_client)
+            self._clients[key] = client
+            # 淘汰的客户端可能仍有进行中的请求，共享连接池不随之关闭
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+            return client
+
+    async def health_check(self, timeout: float = 10) -> Dict[tuple, bool]:
+        """
+        探测各客户端的上游连接，顺带保持 keep-alive 连接温热。
+        只有连接失败或超时才视为不健康并移出注册表，服务端返回的错误码不算。
+        """
+        results = {}
+        for key, client in list(self._clients.items()):
+            try:
+                await asyncio.wait_for(client.async_client.models.list(), timeout)
+                results[key] = True
+            except (APIConnectionError, APITimeoutError, asyncio.TimeoutError):
+                results[key] = False
+                with self._lock:
+                    self._clients.pop(key, None)
+            except Exception:
+                results[key] = True
+        return results
+
+    async def warm_up(self, models: Optional[List[str]] = None) -> Dict[tuple, bool]:
+        for model in models or list(LLMTextClient.MODEL_CONFIGS):
+            try:
+                self.get(model)
+            except ValueError as e:
+                wb_telemetry.log_event("llm_warm_up_skipped", logging.WARNING, model=model, error=str(e))
+        return await self.health_check()
+
+    async def aclose(self):
+        with self._lock:
+            self._clients.clear()
+            http_clients, self._http_clients = list(self._http_clients.values()), {}
+        for http_client, async_http_client in http_clients:
+            http_client.close()
+            await async_http_client.aclose()
+
+
+llm_client_registry = LLMClientRegistry()
+
+
+# 摘要调用在准入控制中使用的用户标识：所有摘要共用一个用户的并发上限，并与真实用户轮流获得名额
+SUMMARY_ADMISSION_USER = "context-summary"
+
+
+def summarize_context(previous_summary: str, transcript: str) -> str:
+    """
+    滚动摘要：把已有摘要和新折叠的对话合并成一段新的摘要。
+    使用支持非流式调用的 CONTEXT_SUMMARY_MODEL，而不是当前对话的模型。
+    在 wb_context 的摘要线程中执行，调用上游前先获取该模型的准入名额。
+    """
+    prompt = ""
+    if previous_summary:
+        prompt += "已有摘要：\n" + previous_summary + "\n\n"
+    prompt += "新增对话：\n" + transcript
+    with wb_admission.admission.blocking_slot(wb_context.CONTEXT_SUMMARY_MODEL, SUMMARY_ADMISSION_USER):
+        return get_llm_client(wb_context.CONTEXT_SUMMARY_MODEL).generate(
+            [{"isUser": True, "text": prompt}],
+            system_prompt="你负责压缩对话记录。请把已有摘要和新增对话合并为一段不超过 300 字的中文摘要，"
+                          "保留人物、事实、约定和未解决的问题，只输出摘要本身。"
+        )
+
+
+def get_llm_client(model: str, base_url: Optional[str] = None) -> LLMTextClient:
+    return llm_client_registry.get(model, base_url)
+
+
+_tts_pool = None
+_tts_pool_failed = False
+_tts_pool_lock = threading.Lock()
+
+
+def get_tts_pool() -> SpeechSynthesizerObjectPool | None:
+    """
+    获取语音合成器连接池，首次调用时创建并预连接（阻塞，需在线程中调用）。
+    创建失败时返回 None，回退为每次新建合成器。
+    """
+    global _tts_pool, _tts_pool_failed
+    if TTS_POOL_SIZE <= 0 or _tts_pool_failed:
+        return None
+    with _tts_pool_lock:
+        if _tts_pool is None and not _tts_pool_failed:
+            try:
+                _tts_pool = SpeechSynthesizerObjectPool(max_size=TTS_POOL_SIZE)
+            except Exception as e:
+                # 只尝试一次，避免每次合成都阻塞在建连上
+                _tts_pool_failed = True
+                wb_telemetry.log_event("tts_pool_failed", logging.ERROR, error=str(e))
+        return _tts_pool
+
+
+def borrow_synthesizer(model: str, voice: str, format: AudioFormat,
+                       callback: Optional[ResultCallback] = None) -> SpeechSynthesizer:
+    """从连接池借出已连接的合成器（阻塞调用），用完后调用 return_synthesizer 归还"""
+    pool = get_tts_pool()
+    if pool is None:
+        return SpeechSynthesizer(model=model, voice=voice, format=format, callback=callback)
+    return pool.borrow_synthesizer(model=model, voice=voice, format=format, callback=callback)
+
+
+def return_synthesizer(synthesizer: SpeechSynthesizer):
+    # 连接池会在借出对象时检查连接状态，异常断开的合成器也可以安全归还
+    if _tts_pool is not None:
+        _tts_pool.return_synthesizer(synthesizer)
+
+
+def shutdown_tts_pool():
+    global _tts_pool
+    with _tts_pool_lock:
+        if _tts_pool is not None:
+            _tts_pool.shutdown()
+            _tts_pool = None
+
+
+# 客户端可协商的回复音频编码（见 wb_protocol.AUDIO_FORMATS）
+# wav 在合成时使用 PCM 以便分块推送，结束后再加上 WAV 头；mp3 / opus 由合成器直接输出
+TTS_FORMATS = {
+    "wav": AudioFormat.PCM_16000HZ_MONO_16BIT,
+    "mp3": AudioFormat.MP3_16000HZ_MONO_128KBPS,
+    "opus": AudioFormat.OGG_OPUS_16KHZ_MONO_32KBPS,
+}
+AUDIO_CONTENT_TYPES = {"pcm": "audio/wav", "wav": "audio/wav", "mp3": "audio/mpeg", "opus": "audio/ogg"}
+# 可以直接首尾拼接的编码；Ogg 容器拼接后是多段流，部分浏览器只播放第一段
+CONCATENABLE_FORMATS = ("pcm", "mp3")
+
+
 class TextToSpeechClient:
     def __init__(self, model_name: str = "cosyvoice-v2",
                 voice_name: str = "longyingyan",
-                format = AudioFormat.WAV_16000HZ_MONO_16BIT,
+                format = TTS_FORMATS["mp3"],
                 ):
         self.format = format
         self.voice_name = voice_name
         self.model_name = model_name
-        self.synthesizer = SpeechSynthesizer(model=model_name, voice=voice_name, format=format)
 
     def __call_synthesizer(self, text: str = "") -> bytes | None:
-        return self.synthesizer.call(text)
+        # 问候语等重复文本直接读取缓存，不再请求上游
+        cache_key = tts_cache.key(self.model_name, self.voice_name, self.format, text)
+        audio = tts_cache.get(cache_key)
+        if audio is not None:
+            return audio
+        synthesizer = borrow_synthesizer(self.model_name, self.voice_name, self.format)
+        try:
+            audio = synthesizer.call(text)
+        finally:
+            # 上游出错时同样归还，否则连接池耗尽后每轮都会阻塞在借出上
+            return_synthesizer(synthesizer)
+        if audio:
+            tts_cache.put(cache_key, audio)
+        return audio
 
     def text_to_speech(self, text: str = "") -> str:
         byteVoice = self.__call_synthesizer(text)
+        if byteVoice is None:
+            # 合成失败时 SpeechSynthesizer.call 返回 None
+            raise RuntimeError("Speech synthesis failed: no audio returned")
         base64Voice = self.encode_audio(byteVoice)
-        return "data:audio/" + self.format.format + ";base64," + base64Voice
+        return "data:" + AUDIO_CONTENT_TYPES[self.format.format] + ";base64," + base64Voice
+
+    async def atext_to_speech(self, text: str = "") -> str:
+        # SpeechSynthesizer.call 是阻塞调用，放到线程池中执行
+        return await asyncio.to_thread(self.text_to_speech, text)
 
     def encode_audio(self, byteVoice: bytes) -> str:
         return base64.b64encode(byteVoice).decode("utf-8")
 
 
+# 句子边界（含中文标点），流式 TTS 按句送入合成器
+SENTENCE_ENDINGS = "。！？；…!?;\n"
+# 没有句末标点时，超过该长度则在逗号处提前切分，避免首段音频等待过久
+SENTENCE_SOFT_LIMIT = 60
+SENTENCE_SOFT_BREAKS = "，、,："
+
+
+class SentenceSplitter:
+    """
+    将 LLM 的 token 流按句子边界切分。
+    英文句点只有在后接空白时才视为句末，避免切开小数和缩写。
+    """
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        self.buffer += text
+        sentences = []
+        start = 0
+        for i, ch in enumerate(self.buffer):
+            is_end = ch in SENTENCE_ENDINGS
+            if ch == "." and i + 1 < len(self.buffer) and self.buffer[i + 1].isspace():
+                is_end = True
+            if is_end:
+                sentence = self.buffer[start:i + 1]
+                if sentence.strip():
+                    sentences.append(sentence)
+                start = i + 1
+        self.buffer = self.buffer[start:]
+
+        if len(self.buffer) > SENTENCE_SOFT_LIMIT:
+            cut = max(self.buffer.rfind(ch) for ch in SENTENCE_SOFT_BREAKS)
+            if cut > 0:
+                sentences.append(self.buffer[:cut + 1])
+                self.buffer = self.buffer[cut + 1:]
+        return sentences
+
+    def flush(self) -> str:
+        rest, self.buffer = self.buffer, ""
+        return rest if rest.strip() else ""
+
+
+def encode_wav(pcm: bytes, sample_rate: int = 16000, channels: int = 1) -> bytes:
+    """为 16bit PCM 数据加上 WAV 头"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm)
+    return buffer.getvalue()
+
+
+class StreamingTextToSpeech(ResultCallback):
+    """
+    与 LLM 生成并行的流式语音合成。
+
+    feed() 接收 token 增量，按句送入 SpeechSynthesizer 的 streaming_call；
+    chunks() 逐块产出已合成的音频（PCM 或 format 指定的压缩编码）；finish() 等待合成结束并返回完整音频。
+    合成器的网络调用都在线程池中执行，不阻塞事件循环。
+    """
+
+    _DONE = object()
+
+    def __init__(self, model_name: str = "cosyvoice-v2",
+                voice_name: str = "longyingyan",
+                format = TTS_FORMATS["wav"],
+                user_id: str = "",
+                ):
+        """
+        :param user_id: 用于合成器并发的准入控制（wb_admission），按用户公平排队
+        """
+        self.format = format
+        self.voice_name = voice_name
+        self.model_name = model_name
+        self.user_id = user_id
+        self.synthesizer = None
+        self._admitted = False
+        self.splitter = SentenceSplitter()
+        self.text = ""
+        self.audio = bytearray()
+        self.error = None
+        self._started_at = None
+        # 线程中进行中的合成器调用，取消时等待其结束后再中止会话
+        self._inflight = None
+        self._loop = asyncio.get_running_loop()
+        self._sentences: asyncio.Queue = asyncio.Queue()
+        self._chunks: asyncio.Queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self.__synthesize())
+
+    # ResultCallback，由 dashscope 的 websocket 线程调用
+    def on_data(self, data: bytes) -> None:
+        self.audio.extend(data)
+        self._loop.call_soon_threadsafe(self._chunks.put_nowait, bytes(data))
+
+    def on_error(self, message) -> None:
+        self.error = RuntimeError(f"Speech synthesis failed: {message}")
+
+    async def __synthesize(self):
+        started = False
+        try:
+            while True:
+                sentence = await self._sentences.get()
+                if sentence is self._DONE:
+                    break
+                # 合成会话开始前，开头的句子可以直接使用缓存；会话开始后为保证顺序统一交给合成器
+                if not started and self.format.format in CONCATENABLE_FORMATS:
+                    cached = await asyncio.to_thread(tts_cache.get, self.__cache_key(sentence))
+                    if cached is not None:
+                        self.audio.extend(cached)
+                        self._chunks.put_nowait(cached)
+                        continue
+                if self.synthesizer is None:
+                    await wb_admission.admission.acquire(self.model_name, self.user_id)
+                    self._admitted = True
+                    await self.__run_inflight(self.__borrow)
+                await self.__run_inflight(self.synthesizer.streaming_call, sentence)
+                started = True
+            if started:
+                await asyncio.to_thread(self.synthesizer.streaming_complete)
+                if self.error is None:
+                    # 以完整回复为键缓存，单句的常用回复下次可直接命中
+                    await asyncio.to_thread(tts_cache.put, self.__cache_key(self.text), bytes(self.audio))
+        except wb_admission.AdmissionRejected as e:
+            # 合成排队已满时本轮回复不带语音，文本照常返回
+            wb_telemetry.log_event("tts_rejected", logging.WARNING, model=self.model_name, error=str(e))
+        except asyncio.CancelledError:
+            if self._inflight is not None:
+                await asyncio.gather(self._inflight, return_exceptions=True)
+            if self.synthesizer is not None:
+                await asyncio.to_thread(self.__cancel_synthesis)
+        except Exception as e:
+            self.error = e
+        finally:
+            # 连接池会在借出时检查连接状态，出错或中止的合成器同样归还
+            if self.synthesizer is not None:
+                return_synthesizer(self.synthesizer)
+            if self._admitted:
+                wb_admission.admission.release(self.model_name, self.user_id)
+            self._loop.call_soon_threadsafe(self._chunks.put_nowait, self._DONE)
+
+    async def __run_inflight(self, func, *args):
+        # 取消时线程中的调用仍会执行完，shield 后由取消处理等待其结束，避免借出的合成器丢失
+        self._inflight = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        return await asyncio.shield(self._inflight)
+
+    def __borrow(self):
+        self.synthesizer = borrow_synthesizer(self.model_name, self.voice_name, self.format, self)
+
+    def __cancel_synthesis(self):
+        try:
+            self.synthesizer.streaming_cancel()
+        except Exception:
+            # 会话尚未开始或已经结束
+            pass
+
+    def __cache_key(self, text: str) -> str:
+        return tts_cache.key(self.model_name, self.voice_name, self.format, text)
+
+    def __put_sentence(self, sentence: str):
+        if self._started_at is None:
+            self._started_at = time.perf_counter()
+        self._sentences.put_nowait(sentence)
+
+    def feed(self, text: str):
+        self.text += text
+        for sentence in self.splitter.feed(text):
+            self.__put_sentence(sentence)
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        while True:
+            chunk = await self._chunks.get()
+            if chunk is self._DONE:
+                return
+            yield chunk
+
+    async def finish(self) -> bytes:
+        """
+        送出剩余文本并等待合成结束，返回完整音频数据。
+        """
+        rest = self.splitter.flush()
+        if rest:
+            self.__put_sentence(rest)
+        self._sentences.put_nowait(self._DONE)
+        await self._worker
+        if self._started_at is not None:
+            # 没有借出合成器说明全部命中缓存
+            wb_telemetry.TTS_SECONDS.labels(cached=self.synthesizer is None).observe(
+                time.perf_counter() - self._started_at)
+        if self.error is not None:
+            wb_telemetry.log_event("tts_failed", logging.ERROR, model=self.model_name, error=str(self.error))
+            raise self.error
+        return bytes(self.audio)
+
+    async def cancel(self) -> bytes:
+        """
+        中止合成：丢弃尚未合成的句子，通知服务端停止合成并归还合成器，返回已合成的音频数据。
+        """
+        self._worker.cancel()
+        await asyncio.gather(self._worker, return_exceptions=True)
+        return bytes(self.audio)
+
+    def to_data_uri(self, audio: bytes) -> str:
+        if self.format.format == "pcm":
+            audio = encode_wav(audio, self.format.sample_rate)
+        return "data:" + AUDIO_CONTENT_TYPES[self.format.format] + ";base64," + base64.b64encode(audio).decode("utf-8")
+
+
 
 if __name__ == "__main__":
     print(voice_to_text(r"userData\audio\test\1751721795734_hello_world_female2.wav"))
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import httpx
+import websockets
+
+# 端到端压测：N 个并发用户通过 /ws/chat/ 对话，并调用历史相关的 REST 接口
+# 默认同时启动本地模拟上游（bench/fake_upstream.py）和后端，不消耗真实 API 额度
+# 用法: python bench/bench_load.py [--users 20] [--turns 5] [--history 40]
+#       python bench/bench_load.py --target http://127.0.0.1:8000   # 压测已启动的后端
+
+BACKEND_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_messages(history_id: int, count: int) -> list:
+    # 长短不一的消息，接近真实对话的分布
+    messages = []
+    for i in range(count):
+        length = random.choice((8, 20, 60, 200))
+        messages.append({
+            "text": f"第{history_id}段对话第{i}条：" + "稻妻" * (length // 2),
+            "isUser": i % 2 == 0,
+            "timestamp": str(history_id * 1000 + i),
+        })
+    return messages
+
+
+class Metrics:
+    def __init__(self):
+        self.samples: dict[str, list[float]] = {}
+        self.bytes: dict[str, list[int]] = {}
+        self.errors = 0
+
+    def add(self, name: str, ms: float, size: int | None = None):
+        self.samples.setdefault(name, []).append(ms)
+        if size is not None:
+            self.bytes.setdefault(name, []).append(size)
+
+    def report(self, elapsed: float):
+        print(f"{'metric':<20}{'count':>7}{'mean ms':>11}{'p50 ms':>11}{'p99 ms':>11}{'bytes/op':>12}")
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+            p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+            sizes = self.bytes.get(name)
+            size = f"{statistics.mean(sizes):12.0f}" if sizes else f"{'-':>12}"
+            print(f"{name:<20}{len(samples):>7}{statistics.mean(samples):11.1f}"
+                  f"{statistics.median(samples):11.1f}{p99:11.1f}{size}")
+        turns = len(self.samples.get("turn", []))
+        print(f"throughput: {turns / elapsed:.2f} turns/s over {elapsed:.1f} s, errors: {self.errors}")
+
+
+async def chat_turn(ws_url: str, user_id: str, history_id: str, messages: list, metrics: Metrics):
+    """发送一轮对话，记录首 token 延迟、整轮耗时和下行字节数，返回助手回复"""
+    start = time.perf_counter()
+    received = 0
+    reply = ""
+    first_token = None
+    async with websockets.connect(ws_url + "/ws/chat/", max_size=None) as ws:
+        await ws.send(json.dumps({"user_id": user_id, "history_id": history_id,
+                                  "messages": messages, "protocol": 2}))
+        async for raw in ws:
+            received += len(raw)
+            frame = json.loads(raw)
+            if frame.get("type") == "delta":
+                if first_token is None:
+                    first_token = time.perf_counter()
+                reply += frame["text"]
+            elif frame.get("type") == "done":
+                break
+    metrics.add("ttft", ((first_token or time.perf_counter()) - start) * 1000)
+    metrics.add("turn", (time.perf_counter() - start) * 1000, received)
+    return reply
+
+
+async def timed_get(client: httpx.AsyncClient, name: str, url: str, metrics: Metrics):
+    start = time.perf_counter()
+    response = await client.get(url)
+    response.raise_for_status()
+    metrics.add(name, (time.perf_counter() - start) * 1000, len(response.content))
+
+
+async def run_user(index: int, args, base_url: str, metrics: Metrics):
+    user_id = f"bench_user_{index}"
+    ws_url = "ws" + base_url[len("http"):]
+    async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+        # 预置历史：每个用户若干段对话，当前对话带 --history 条消息
+        for h in range(args.histories):
+            history_id = str(h)
+            data = {"user_id": user_id, "history_id": history_id,
+                    "messages": make_messages(h, args.history)}
+            response = await client.post(f"/api/chat/{user_id}/{history_id}", json=data)
+            response.raise_for_status()
+        messages = make_messages(0, args.history)
+
+        for turn in range(args.turns):
+            messages.append({"text": f"第{turn}轮提问：雷电将军，请谈谈永恒。", "isUser": True,
+                             "timestamp": str(time.time())})
+            try:
+                reply = await chat_turn(ws_url, user_id, "0", messages, metrics)
+                messages.append({"text": reply, "isUser": False, "timestamp": str(time.time())})
+                await timed_get(client, "history_list", f"/api/chat_history_list/{user_id}", metrics)
+                await timed_get(client, "history_load", f"/api/chat/{user_id}/0", metrics)
+            except Exception as e:
+                metrics.errors += 1
+                print(f"{user_id} turn {turn} failed: {e!r}")
+
+
+async def wait_ready(url: str, timeout: float = 30):
+    deadline = time.time() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.time() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+
+def start_services(args) -> tuple[str, list[subprocess.Popen]]:
+    """启动模拟上游和后端，后端运行在临时目录中，使用独立的 userData"""
+    upstream = f"http://127.0.0.1:{args.upstream_port}"
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(BACKEND_ROOT, "bench", "fake_upstream.py"),
+        "--port", str(args.upstream_port),
+        "--first-token-ms", str(args.first_token_ms),
+        "--token-rate", str(args.token_rate),
+        "--reply-tokens", str(args.reply_tokens),
+    ])
+    work_dir = tempfile.mkdtemp(prefix="wb-load-")
+    for sub_dir in ("chat", "audio", "image"):
+        os.makedirs(os.path.join(work_dir, "userData", sub_dir))
+    env = {
+        **os.environ,
+        "DASHSCOPE_API_KEY": "bench",
+        "WB_LLM_BASE_URL": upstream + "/compatible-mode/v1",
+        "DASHSCOPE_HTTP_BASE_URL": upstream + "/api/v1",
+        "DASHSCOPE_WEBSOCKET_BASE_URL": upstream.replace("http", "ws") + "/api-ws/v1/inference",
+    }
+    backend = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_ROOT,
+        "--port", str(args.port), "--log-level", "warning",
+    ], cwd=work_dir, env=env)
+    return f"http://127.0.0.1:{args.port}", [backend, fake]
+
+
+async def main(args):
+    processes = []
+    base_url = args.target
+    if base_url is None:
+        base_url, processes = start_services(args)
+    try:
+        await wait_ready(base_url + "/")
+        metrics = Metrics()
+        start = time.perf_counter()
+        await asyncio.gather(*(run_user(i, args, base_url, metrics) for i in range(args.users)))
+        print(f"{args.users} users x {args.turns} turns, {args.history} messages per history")
+        metrics.report(time.perf_counter() - start)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", help="已启动的后端地址，不指定则在本地启动模拟上游和后端")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--upstream-port", type=int, default=9100)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--history", type=int, default=40, help="每段对话的初始消息数")
+    parser.add_argument("--histories", type=int, default=10, help="每个用户预置的对话段数")
+    parser.add_argument("--first-token-ms", type=float, default=300)
+    parser.add_argument("--token-rate", type=float, default=50)
+    parser.add_argument("--reply-tokens", type=int, default=80)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+# 对比 JSON 与 SQLite 存储在大量历史下的保存与列表延迟
+# 用法: python bench/bench_store.py [--messages 10000] [--per-history 50] [--rounds 50] [--mode cached|fresh|both]
+#   cached: 与 main.py 一致，经 dataModel.open_chat_db（ChatStoreCache）共享存储对象，
+#           JSON 的修改由后台任务合并写盘，写盘耗时单独记为 flush
+#   fresh:  每个请求新建存储对象（引入缓存之前的请求路径），用于对比
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_history(history_id: int, count: int) -> list:
+    messages = []
+    for i in range(count):
+        messages.append({
+            "text": f"第{history_id}段对话的第{i}条消息，" + "内容" * 20,
+            "isUser": i % 2 == 0,
+            "timestamp": str(history_id * 1000 + i),
+        })
+    return messages
+
+
+def summarize(name: str, samples: list[float]):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"  {name:<14} mean {statistics.mean(samples):8.2f} ms   p50 {statistics.median(samples):8.2f} ms   p99 {p99:8.2f} ms")
+
+
+def bench_backend(backend: str, mode: str, total_messages: int, per_history: int, rounds: int):
+    import dataModel
+    dataModel.CHAT_STORE_BACKEND = backend
+    dataModel.chat_store_cache.clear()
+    open_db = dataModel.open_chat_db if mode == "cached" else dataModel.create_chat_db
+    user_id = f"bench-{backend}-{mode}"
+
+    histories = {str(h): make_history(h, per_history) for h in range(1, total_messages // per_history + 1)}
+    db = open_db(user_id)
+    for history_id, messages in histories.items():
+        db.add_history(history_id, messages)
+    del db
+    dataModel.chat_store_cache.flush_all()
+
+    save, flush, listing, load = [], [], [], []
+    history_ids = list(histories)
+    for r in range(rounds):
+        history_id = history_ids[r % len(history_ids)]
+        histories[history_id].append({"text": "新的一轮", "isUser": True, "timestamp": str(10 ** 9 + r)})
+
+        # 与 main.py 保存一轮对话的方式一致
+        start = time.perf_counter()
+        db = open_db(user_id)
+        db.add_history(history_id, histories[history_id])
+        del db
+        save.append((time.perf_counter() - start) * 1000)
+
+        # 后台写盘任务的耗时（不在请求路径上；直接落库或每次新建存储对象时没有待写入的修改）
+        start = time.perf_counter()
+        dataModel.chat_store_cache.flush_all()
+        flush.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        db = open_db(user_id)
+        db.get_history_list()
+        del db
+        listing.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        db = open_db(user_id)
+        db.get_history_data(history_id)
+        del db
+        load.append((time.perf_counter() - start) * 1000)
+
+    summarize("save", save)
+    summarize("flush", flush)
+    summarize("list", listing)
+    summarize("load history", load)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--per-history", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--mode", choices=("cached", "fresh", "both"), default="both")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="wb-bench-"))
+    os.makedirs("userData/chat")
+
+    modes = ("cached", "fresh") if args.mode == "both" else (args.mode,)
+    for mode in modes:
+        for backend in ("json", "sqlite"):
+            print(f"{backend} ({mode}): {args.messages} messages, {args.per_history} per history")
+            bench_backend(backend, mode, args.messages, args.per_history, args.rounds)
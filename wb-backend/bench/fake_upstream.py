@@ -0,0 +1,222 @@
+import json
+import time
+import uuid
+import zlib
+import struct
+import random
+import asyncio
+import argparse
+
+import uvicorn
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, Response
+
+# 本地模拟的上游服务，压测时替代百炼的接口，不消耗真实额度
+# - OpenAI 兼容的对话接口:  /compatible-mode/v1/chat/completions  (WB_LLM_BASE_URL)
+# - 语音合成/识别 websocket:  /api-ws/v1/inference                 (DASHSCOPE_WEBSOCKET_BASE_URL)
+# - 图像生成 HTTP 接口:       /api/v1/services/...、/api/v1/tasks/  (DASHSCOPE_HTTP_BASE_URL)
+# 用法: python bench/fake_upstream.py [--port 9100] [--token-rate 50] [--first-token-ms 300]
+
+REPLY_SENTENCES = [
+    "稻妻的雷光从未停歇。",
+    "永恒，是我为这片土地许下的誓约，",
+    "你所求之事，我已知晓。",
+    "若要前行，便不要回头！",
+    "天守阁的风，今日格外安静。",
+]
+
+settings = {
+    # 对话：首 token 延迟、每秒 token 数、每次回复的 token 数
+    "first_token_ms": 300.0,
+    "token_rate": 50.0,
+    "reply_tokens": 80,
+    # 语音合成：每个字对应的音频时长，实时率（合成耗时 / 音频时长）
+    "tts_ms_per_char": 200.0,
+    "tts_rtf": 0.1,
+    # 语音识别：结束输入后返回整句结果的延迟
+    "asr_final_ms": 200.0,
+    # 图像生成耗时与返回图片的边长
+    "image_ms": 2000.0,
+    "image_size": 512,
+}
+
+app = FastAPI()
+
+
+def reply_tokens(count: int) -> list[str]:
+    # 以 2 个字为一个 token 切分，保留标点以便下游按句合成
+    text = ""
+    while len(text) < count * 2:
+        text += random.choice(REPLY_SENTENCES)
+    return [text[i:i + 2] for i in range(0, count * 2, 2)]
+
+
+def chunk_payload(completion_id: str, model: str, delta: dict, finish_reason=None, usage=None) -> str:
+    data = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [] if usage else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    if usage:
+        data["usage"] = usage
+    return "data: " + json.dumps(data, ensure_ascii=False) + "\n\n"
+
+
+@app.post("/compatible-mode/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "fake")
+    completion_id = "chatcmpl-" + uuid.uuid4().hex
+    tokens = reply_tokens(settings["reply_tokens"])
+    prompt_tokens = sum(len(json.dumps(m.get("content"), ensure_ascii=False)) for m in body.get("messages", []))
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+             "total_tokens": prompt_tokens + len(tokens)}
+
+    if not body.get("stream"):
+        await asyncio.sleep(settings["first_token_ms"] / 1000 + len(tokens) / settings["token_rate"])
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                         "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    async def events():
+        await asyncio.sleep(settings["first_token_ms"] / 1000)
+        yield chunk_payload(completion_id, model, {"role": "assistant", "content": ""})
+        for token in tokens:
+            yield chunk_payload(completion_id, model, {"content": token})
+            await asyncio.sleep(1 / settings["token_rate"])
+        yield chunk_payload(completion_id, model, {}, finish_reason="stop")
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield chunk_payload(completion_id, model, {}, usage=usage)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def tts_event(task_id: str, event: str, **payload) -> str:
+    return json.dumps({"header": {"task_id": task_id, "event": event, "attributes": {}}, "payload": payload})
+
+
+@app.websocket("/api-ws/v1/inference")
+async def inference(ws: WebSocket):
+    """
+    百炼 websocket 双工协议的最小实现：run-task -> task-started，finish-task -> task-finished。
+    语音合成：每个 continue-task 按文本长度返回静音 PCM。
+    语音识别：每收到约 1 秒音频返回一次中间结果，结束时返回整句。
+    同一连接上可以依次执行多个任务（对应合成器连接池的复用）。
+    """
+    await ws.accept()
+    sample_rate = 22050
+    task = "tts"
+    asr_bytes = 0
+    try:
+        while True:
+            received = await ws.receive()
+            if received["type"] == "websocket.disconnect":
+                break
+            if received.get("bytes") is not None:
+                asr_bytes += len(received["bytes"])
+                if asr_bytes // (sample_rate * 2) > (asr_bytes - len(received["bytes"])) // (sample_rate * 2):
+                    await ws.send_text(asr_event(task_id, asr_text(asr_bytes, sample_rate), final=False))
+                continue
+            message = json.loads(received["text"])
+            header = message["header"]
+            task_id = header.get("task_id", "")
+            action = header.get("action")
+            if action == "run-task":
+                payload = message.get("payload", {})
+                task = payload.get("task", "tts")
+                parameters = payload.get("parameters", {})
+                sample_rate = int(parameters.get("sample_rate") or sample_rate)
+                asr_bytes = 0
+                await ws.send_text(tts_event(task_id, "task-started"))
+            elif action == "continue-task":
+                text = message.get("payload", {}).get("input", {}).get("text") or ""
+                duration = len(text) * settings["tts_ms_per_char"] / 1000
+                # 按 100ms 一块推送，推送节奏由实时率决定
+                frames = max(1, int(duration * 10))
+                chunk = bytes(int(sample_rate * 0.1) * 2)
+                for _ in range(frames):
+                    await asyncio.sleep(0.1 * settings["tts_rtf"])
+                    await ws.send_bytes(chunk)
+                await ws.send_text(tts_event(task_id, "result-generated", output={"sentence": {"text": text}}))
+            elif action == "finish-task":
+                if task == "asr":
+                    await asyncio.sleep(settings["asr_final_ms"] / 1000)
+                    await ws.send_text(asr_event(task_id, asr_text(asr_bytes, sample_rate), final=True))
+                await ws.send_text(tts_event(task_id, "task-finished", usage={"characters": 0}))
+    except WebSocketDisconnect:
+        pass
+
+
+def asr_text(audio_bytes: int, sample_rate: int) -> str:
+    # 每秒音频对应 4 个字
+    return ("永恒" * 1000)[:max(1, audio_bytes * 4 // (sample_rate * 2))]
+
+
+def asr_event(task_id: str, text: str, final: bool) -> str:
+    sentence = {"begin_time": 0, "end_time": 1000 if final else None, "text": text}
+    return tts_event(task_id, "result-generated", output={"sentence": sentence})
+
+
+def make_png(size: int) -> bytes:
+    # 不依赖图像库，生成一张随机灰度 PNG，体积接近真实图片
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    rows = b"".join(b"\x00" + random.randbytes(size) for _ in range(size))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows, 1)) + chunk(b"IEND", b""))
+
+
+_image_tasks: dict[str, float] = {}
+_png_cache: dict[int, bytes] = {}
+
+
+def image_task_output(request: Request, task_id: str) -> dict:
+    done = time.time() >= _image_tasks.get(task_id, 0)
+    output = {"task_id": task_id, "task_status": "SUCCEEDED" if done else "RUNNING"}
+    if done:
+        output["results"] = [{"url": str(request.base_url) + f"files/{task_id}.png"}]
+    return {"request_id": uuid.uuid4().hex, "output": output, "usage": {"image_count": 1 if done else 0}}
+
+
+@app.post("/api/v1/services/{service:path}")
+async def image_synthesis(service: str, request: Request):
+    task_id = uuid.uuid4().hex
+    _image_tasks[task_id] = time.time() + settings["image_ms"] / 1000
+    if request.headers.get("X-DashScope-Async") == "enable":
+        return image_task_output(request, task_id)
+    await asyncio.sleep(settings["image_ms"] / 1000)
+    return image_task_output(request, task_id)
+
+
+@app.get("/api/v1/tasks/{task_id}")
+async def image_task(task_id: str, request: Request):
+    return image_task_output(request, task_id)
+
+
+@app.get("/files/{name}")
+async def image_file(name: str):
+    size = settings["image_size"]
+    if size not in _png_cache:
+        _png_cache[size] = make_png(size)
+    return Response(_png_cache[size], media_type="image/png")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    for key, value in settings.items():
+        parser.add_argument("--" + key.replace("_", "-"), type=type(value), default=value)
+    args = parser.parse_args()
+    for key in settings:
+        settings[key] = getattr(args, key)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
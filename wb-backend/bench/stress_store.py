@@ -0,0 +1,137 @@
+import os
+import sys
+import glob
+import json
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+# 多进程并发写同一用户的 JSON 对话存储，验证原子写入、文件锁与按历史合并不会丢失或损坏数据
+# 每个 worker 进程模拟一个 uvicorn worker：经 open_chat_db 访问（进程内缓存 + 延迟写盘），
+# 新建自己的历史、追加消息、切换收藏，并不定期写盘；另有若干进程在运行中被强制杀死
+# 结束后检查：文件均可解析；存活 worker 的全部修改都在；被杀进程已写入的历史内容完整
+# 用法: python bench/stress_store.py [--workers 8] [--ops 300] [--kill 2]
+
+BACKEND_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_ID = "stress"
+
+
+def message_text(history_id: str, index: int) -> str:
+    return f"{history_id}:{index}"
+
+
+def run_worker(data_root: str, worker: int, ops: int, results):
+    os.chdir(data_root)
+    sys.path.insert(0, BACKEND_ROOT)
+    import dataModel
+
+    rng = random.Random(worker)
+    expected: dict[str, int] = {}
+    favorites: set[str] = set()
+    for op in range(ops):
+        db = dataModel.open_chat_db(USER_ID)
+        action = rng.random()
+        if not expected or action < 0.2:
+            history_id = f"w{worker}-{len(expected)}"
+            db.add_history(history_id, [{"text": message_text(history_id, 0), "isUser": True,
+                                         "timestamp": str(int(time.time() * 1000))}])
+            expected[history_id] = 1
+        elif action < 0.9:
+            history_id = rng.choice(list(expected))
+            db.change_chat_in_history(history_id, dataModel.Message(
+                text=message_text(history_id, expected[history_id]), isUser=op % 2 == 0,
+                timestamp=str(int(time.time() * 1000))), -1)
+            expected[history_id] += 1
+        else:
+            history_id = rng.choice(list(expected))
+            if db.toggle_favorite(history_id):
+                favorites.add(history_id)
+            else:
+                favorites.discard(history_id)
+        if rng.random() < 0.3:
+            dataModel.chat_store_cache.flush_all()
+        time.sleep(rng.random() * 0.002)
+    dataModel.chat_store_cache.flush_all()
+    if results is not None:
+        results.put((worker, expected, sorted(favorites)))
+
+
+def verify(data_root: str, reports: dict, killed: list[int]) -> list[str]:
+    chat_root = os.path.join(data_root, "userData", "chat")
+    errors = []
+    files = {}
+    for name in ("", "_favorites", "_index"):
+        path = os.path.join(chat_root, USER_ID + name + ".json")
+        try:
+            with open(path, encoding="utf-8") as f:
+                files[name] = json.load(f)
+        except (OSError, ValueError) as e:
+            errors.append(f"{path}: {e}")
+    if errors:
+        return errors
+    history, favorites, index = files[""], set(files["_favorites"]), files["_index"]
+
+    for worker, (expected, expected_favorites) in reports.items():
+        for history_id, count in expected.items():
+            texts = [msg["text"] for msg in history.get(history_id, [])]
+            if texts != [message_text(history_id, i) for i in range(count)]:
+                errors.append(f"worker {worker}: {history_id} has {len(texts)} message(s), expected {count}")
+        mine = {history_id for history_id in favorites if history_id.startswith(f"w{worker}-")}
+        if mine != set(expected_favorites):
+            errors.append(f"worker {worker}: favorites {sorted(mine)} != {expected_favorites}")
+    for worker in killed:
+        # 被杀进程未写盘的修改会丢失，但已写入的历史必须是完整的前缀
+        for history_id, messages in history.items():
+            if history_id.startswith(f"w{worker}-"):
+                texts = [msg["text"] for msg in messages]
+                if texts != [message_text(history_id, i) for i in range(len(texts))]:
+                    errors.append(f"killed worker {worker}: {history_id} is inconsistent")
+    if index.keys() != history.keys():
+        errors.append(f"index has {len(index)} histories, history file has {len(history)}")
+    for history_id, summary in index.items():
+        if history_id in history and summary["message_count"] != len(history[history_id]):
+            errors.append(f"index: {history_id} message_count {summary['message_count']} != {len(history[history_id])}")
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=300)
+    parser.add_argument("--kill", type=int, default=2, help="运行中被强制杀死的额外进程数")
+    args = parser.parse_args()
+
+    data_root = tempfile.mkdtemp(prefix="wb-stress-")
+    os.makedirs(os.path.join(data_root, "userData", "chat"))
+    # 与 Windows 一致使用 spawn，子进程各自导入 dataModel
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    workers = [ctx.Process(target=run_worker, args=(data_root, i, args.ops, results)) for i in range(args.workers)]
+    victims = [ctx.Process(target=run_worker, args=(data_root, args.workers + i, 10 ** 9, None))
+               for i in range(args.kill)]
+    start = time.perf_counter()
+    for process in workers + victims:
+        process.start()
+    for process in victims:
+        time.sleep(random.uniform(1.0, 3.0))
+        process.kill()
+    reports = {}
+    for _ in workers:
+        worker, expected, favorites = results.get()
+        reports[worker] = (expected, favorites)
+    for process in workers + victims:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    errors = verify(data_root, reports, [args.workers + i for i in range(args.kill)])
+    leftovers = glob.glob(os.path.join(data_root, "userData", "chat", "*.tmp"))
+    total_ops = sum(sum(expected.values()) for expected, _ in reports.values())
+    print(f"{args.workers} workers + {args.kill} killed, {total_ops} messages in {elapsed:.1f}s, data in {data_root}")
+    if leftovers:
+        print(f"{len(leftovers)} temporary file(s) left by killed workers (ignored on load)")
+    for error in errors:
+        print("FAIL", error)
+    print("OK" if not errors else f"{len(errors)} error(s)")
+    sys.exit(1 if errors else 0)
@@ -1,6 +1,19 @@
 from pydantic import BaseModel, FilePath
-from sqlmodel import Field, Session, SQLModel, create_engine, select
+from sqlmodel import Field, Session, SQLModel, create_engine, select, delete, func, Index
+from sqlalchemy import event
+from abc import ABC, abstractmethod
+import os
 import json
+import time
+import atexit
+import asyncio
+import threading
+from collections import OrderedDict
+from wb_blob import blob_store
+from wb_search import search_index
+import wb_telemetry
+import wb_fileio
+import logging
 
 # file : user_id - {history_id - str : messages - [{text: str, isUser: bool, timestamp: str}]}, ...]}
 
@@ -9,13 +22,27 @@ AUDIO_DATA_PATH_ROOT = USER_DATA_PATH_ROOT + 'audio/'
 IMAGE_DATA_PATH_ROOT = USER_DATA_PATH_ROOT + 'image/'
 CHAT_DATA_PATH_ROOT = USER_DATA_PATH_ROOT + 'chat/'
 
+# 对话存储后端："json"（默认，每用户一个文件）或 "sqlite"
+CHAT_STORE_BACKEND = os.getenv("WB_CHAT_STORE", "json")
+CHAT_DB_URL = os.getenv("WB_CHAT_DB_URL", "sqlite:///" + USER_DATA_PATH_ROOT + "chat.db")
+
+# 进程内用户存储缓存：最多缓存的用户数、估算字节数，以及后台刷盘间隔（秒）
+CHAT_CACHE_MAX_USERS = int(os.getenv("WB_CHAT_CACHE_MAX_USERS", "256"))
+CHAT_CACHE_MAX_BYTES = int(os.getenv("WB_CHAT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+CHAT_FLUSH_INTERVAL = float(os.getenv("WB_CHAT_FLUSH_INTERVAL", "2"))
+
 class Message(BaseModel):
     text: str | None = ""
     isUser: bool
     timestamp: str
     audio_base64: str | None = None
+    # 音频编码：wav / mp3 / opus，旧数据为空（即 WAV）
+    audio_format: str | None = None
     image_base64: str | None = None
     image_type: str | None = None
+    # blob 存储中的引用，持久化后代替内嵌的 base64
+    audio_ref: str | None = None
+    image_ref: str | None = None
 
 class ChatData(BaseModel):
     user_id: str
@@ -23,82 +50,423 @@ class ChatData(BaseModel):
     messages: list[Message]
 
 
+def make_history_title(messages: list) -> str:
+    # 获取第一条用户消息作为标题
+    for msg in messages:
+        if msg.get("isUser", False) and (msg.get("text") or "").strip():
+            return msg["text"][:30] + ("..." if len(msg["text"]) > 30 else "")
+    return "无标题"
+
+
+def summarize_history(history_id: str, messages: list, is_favorite: bool = False) -> dict:
+    """生成历史摘要：标题、最后一条消息的时间戳、消息数、收藏标记"""
+    return {
+        "title": make_history_title(messages),
+        "timestamp": messages[-1].get("timestamp", history_id) if messages else history_id,
+        "message_count": len(messages),
+        "is_favorite": is_favorite
+    }
+
+
+def parse_history_cursor(cursor: str) -> tuple[int, str]:
+    """分页游标格式为 "<timestamp>:<history_id>"，指向上一页的最后一条"""
+    timestamp, _, history_id = cursor.partition(':')
+    return int(timestamp), history_id
+
+
+def make_history_cursor(item: dict) -> str:
+    return f"{item['timestamp']}:{item['id']}"
+
+
+class ChatHistoryStore(ABC):
+    """对话历史存储接口，不同后端（JSON 文件、SQLite）实现相同的方法"""
+
+    @abstractmethod
+    def get_history_list(self, offset: int = 0, limit: int | None = None, cursor: str | None = None) -> list: ...
+
+    @abstractmethod
+    def get_history_data(self, history_id: str) -> list | None: ...
+
+    @abstractmethod
+    def add_history(self, history_id: str, messages: list): ...
+
+    # 批量追加消息（导入时使用），历史不存在时新建
+    @abstractmethod
+    def append_messages(self, history_id: str, messages: list): ...
+
+    def append_message(self, history_id: str, message: dict):
+        """追加一条消息，不改写已有的消息"""
+        self.append_messages(history_id, [message])
+
+    @abstractmethod
+    def delete_history(self, history_id: str) -> bool: ...
+
+    @abstractmethod
+    def clear_all_history(self): ...
+
+    @abstractmethod
+    def change_chat_in_history(self, history_id: str, message: Message, index: int): ...
+
+    @abstractmethod
+    def save(self): ...
+
+    @abstractmethod
+    def get_favorites(self) -> list: ...
+
+    @abstractmethod
+    def add_favorite(self, history_id: str) -> bool: ...
+
+    @abstractmethod
+    def remove_favorite(self, history_id: str) -> bool: ...
+
+    @abstractmethod
+    def toggle_favorite(self, history_id: str) -> bool: ...
+
+    # 以下供 ChatStoreCache 使用，直接落库的后端无需覆盖
+    @property
+    def is_dirty(self) -> bool:
+        return False
+
+    @property
+    def size_bytes(self) -> int:
+        return 0
+
+    @property
+    def is_stale(self) -> bool:
+        """其它进程修改了底层文件、需要重新加载"""
+        return False
+
+    def take_pending_writes(self) -> list:
+        """取出待写入的修改快照（PendingJsonWrite），并清除脏标记"""
+        return []
+
+    # 供 HTTP 条件请求使用：返回 (版本标识, 最后修改时间)，内容变化时版本标识随之变化；
+    # 返回 None 表示该后端不跟踪版本
+    def list_version(self) -> tuple[str, float] | None:
+        return None
+
+    def history_version(self, history_id: str) -> tuple[str, float] | None:
+        return None
+
+    def flush(self):
+        write_pending(self.take_pending_writes())
+
+
+@wb_telemetry.timed(wb_telemetry.STORE_SECONDS, backend="json", op="save")
+def write_pending(items: list):
+    """逐个提交修改快照；同一批写入的目录最后统一 fsync 一次"""
+    dirs = set()
+    for item in items:
+        item.commit()
+        dirs.add(os.path.dirname(item.store.history_path))
+    if wb_fileio.FSYNC:
+        for dir_path in dirs:
+            wb_fileio.fsync_dir(dir_path)
+
+
+class PendingJsonWrite:
+    """
+    一个用户待写入的修改，按历史 id 记录。
+    提交时持有该用户的文件锁，读出磁盘上的最新内容（可能已被其它进程修改），
+    只替换本进程改动过的历史和收藏项，再原子写回，不会覆盖其它进程的修改。
+    """
+
+    def __init__(self, store: "ChatHistoryJsonDB", changed: dict, deleted: set, cleared: bool,
+                 favorite_ops: list, summaries: dict, rebuilt_summaries: dict | None = None):
+        """
+        :param summaries: 改动过的历史的摘要，覆盖磁盘上的条目
+        :param rebuilt_summaries: 加载时重建的完整摘要，只补充磁盘索引中缺少的条目
+        """
+        self.store = store
+        self.changed = changed
+        self.deleted = deleted
+        self.cleared = cleared
+        self.favorite_ops = favorite_ops
+        self.summaries = summaries
+        self.rebuilt_summaries = rebuilt_summaries or {}
+
+    def commit(self):
+        try:
+            self._merge_and_write()
+        except BaseException:
+            self.store.write_failed(self)
+            raise
+
+    def _merge_and_write(self):
+        store = self.store
+        with wb_fileio.file_lock(store.lock_path):
+            foreign = wb_fileio.file_stamp(store.history_path) != store.disk_stamp
+            history = None
+            if self.changed or self.deleted or self.cleared:
+                history = {} if self.cleared else wb_fileio.read_json(store.history_path, {})
+                for history_id in self.deleted:
+                    history.pop(history_id, None)
+                history.update(self.changed)
+                wb_fileio.write_json_atomic(store.history_path, history)
+
+            favorites = wb_fileio.read_json(store.favorites_path, [])
+            if self.favorite_ops:
+                for op, history_id in self.favorite_ops:
+                    if op == "add" and history_id not in favorites:
+                        favorites.append(history_id)
+                    elif op == "remove" and history_id in favorites:
+                        favorites.remove(history_id)
+                wb_fileio.write_json_atomic(store.favorites_path, favorites)
+
+            index = {} if self.cleared else wb_fileio.read_json(store.index_path, {})
+            for history_id in self.deleted:
+                index.pop(history_id, None)
+            index.update(self.summaries)
+            for history_id, summary in self.rebuilt_summaries.items():
+                index.setdefault(history_id, summary)
+            favorite_set = set(favorites)
+            if history is not None:
+                # 与合并后的历史对齐：去掉已不存在的条目，补上缺少的条目
+                index = {history_id: summary for history_id, summary in index.items() if history_id in history}
+                for history_id, messages in history.items():
+                    if history_id not in index:
+                        index[history_id] = summarize_history(history_id, messages, history_id in favorite_set)
+            for history_id, summary in index.items():
+                summary["is_favorite"] = history_id in favorite_set
+            wb_fileio.write_json_atomic(store.index_path, index)
+            store.written(wb_fileio.file_stamp(store.history_path), foreign)
+
+
 # 与Json对话数据文件交互
-class ChatHistoryJsonDB:
-    def __init__(self, user_id: str):
+class ChatHistoryJsonDB(ChatHistoryStore):
+    def __init__(self, user_id: str, write_behind: bool = False):
+        """
+        :param write_behind: 为 True 时修改只标记为脏，由 ChatStoreCache 合并后写盘
+        """
         self.userId = user_id
-        try: 
-            with open(CHAT_DATA_PATH_ROOT + self.userId + '.json', 'r', encoding="utf-8") as f:
-                self.historyData = json.load(f)
-        except:
-            self.historyData = {}
-        
-        # 加载收藏数据
+        self.write_behind = write_behind
+        # 自上次写盘以来改动过的历史 id（含已删除的）、是否清空过、收藏的增删操作
+        self._dirty_ids: set[str] = set()
+        self._cleared = False
+        self._favorite_ops: list[tuple[str, str]] = []
+        self._index_dirty = False
+        self.history_path = CHAT_DATA_PATH_ROOT + self.userId + '.json'
+        self.favorites_path = CHAT_DATA_PATH_ROOT + self.userId + '_favorites.json'
+        self.index_path = CHAT_DATA_PATH_ROOT + self.userId + '_index.json'
+        self.lock_path = CHAT_DATA_PATH_ROOT + self.userId + '.lock'
+        # 最近一次加载或写入后历史文件的状态，用于发现其它进程的写入
+        self._state_lock = threading.Lock()
+        self._writing = 0
+        self._needs_reload = False
+        load_start = time.perf_counter()
+        # 文件总是整体替换，单个文件的读取无需加锁；加锁是为了三个文件来自同一次写入
+        with wb_fileio.file_lock(self.lock_path):
+            self.disk_stamp = wb_fileio.file_stamp(self.history_path)
+            self.historyData = wb_fileio.read_json(self.history_path, {})
+            # 加载收藏数据
+            self.favoriteData = wb_fileio.read_json(self.favorites_path, [])
+            self.__load_index()
+        # 版本号只在进程内递增，加上加载时刻作为前缀，重启或重新加载后不会与旧的 ETag 重合
+        self._epoch = format(time.time_ns(), 'x')
+        self._user_version = 0
+        self._history_versions: dict[str, int] = {}
         try:
-            with open(CHAT_DATA_PATH_ROOT + self.userId + '_favorites.json', 'r', encoding="utf-8") as f:
-                self.favoriteData = json.load(f)
-        except:
-            self.favoriteData = []
-
-    def __save_json(self):
-        with open(CHAT_DATA_PATH_ROOT + self.userId + '.json', 'w', encoding="utf-8") as f:
-            json.dump(self.historyData, f, indent=2)
+            self._modified_at = os.path.getmtime(self.history_path)
+        except OSError:
+            self._modified_at = time.time()
+        self._history_modified: dict[str, float] = {}
+        wb_telemetry.STORE_SECONDS.labels(backend="json", op="load").observe(time.perf_counter() - load_start)
+
+    def __load_index(self):
+        # 摘要索引：history_id -> {title, timestamp, message_count, is_favorite}
+        self.summaryIndex = wb_fileio.read_json(self.index_path, None)
+        # 索引缺失或与历史数据不一致时（如旧版本数据）整体重建一次
+        if self.summaryIndex is None or self.summaryIndex.keys() != self.historyData.keys():
+            favorites = set(self.favoriteData)
+            self.summaryIndex = {
+                history_id: summarize_history(history_id, messages, history_id in favorites)
+                for history_id, messages in self.historyData.items()
+            }
+            self._index_dirty = True
+        self._ordered_ids = None
+
+    def __index_changed(self):
+        # 摘要随历史一起按 id 写入（见 take_pending_writes），这里只需使排序缓存失效
+        self._ordered_ids = None
+
+    def __bump_version(self, history_id: str | None = None):
+        """历史列表（标题、条数、收藏）或某段历史的内容变化时调用"""
+        self._user_version += 1
+        self._modified_at = time.time()
+        if history_id is not None:
+            self._history_versions[history_id] = self._history_versions.get(history_id, 0) + 1
+            self._history_modified[history_id] = self._modified_at
+
+    def list_version(self):
+        return f"{self._epoch}-{self._user_version}", self._modified_at
+
+    def history_version(self, history_id: str):
+        return (f"{self._epoch}-{self._history_versions.get(history_id, 0)}",
+                self._history_modified.get(history_id, self._modified_at))
+
+    def __save_json(self, history_id: str | None = None):
+        if history_id is not None:
+            self._dirty_ids.add(history_id)
+        if not self.write_behind:
+            self.flush()
     
-    def __save_favorites(self):
-        with open(CHAT_DATA_PATH_ROOT + self.userId + '_favorites.json', 'w', encoding="utf-8") as f:
-            json.dump(self.favoriteData, f, indent=2)
-
-    def get_history_list(self):
-        history_data = []
-        for id, messages in self.historyData.items():
-            # 获取第一条用户消息作为标题
-            title = "无标题"
-            for msg in messages:
-                if msg.get("isUser", False) and msg.get("text", "").strip():
-                    title = msg["text"][:30] + ("..." if len(msg["text"]) > 30 else "")
-                    break
-            
-            # 获取最后一条消息的时间戳
-            last_timestamp = messages[-1].get("timestamp", id) if messages else id
-            
-            history_data.append({
-                "id": id, 
-                "title": title,
-                "timestamp": last_timestamp,
-                "message_count": len(messages)
-            })
-        
-        # 按时间戳倒序排列（最新的在前面）
-        history_data.sort(key=lambda x: int(x['timestamp']), reverse=True)
-        return history_data
+    def __save_favorites(self, op: str, history_id: str):
+        self._favorite_ops.append((op, history_id))
+        if not self.write_behind:
+            self.flush()
+
+    @property
+    def is_dirty(self) -> bool:
+        return bool(self._dirty_ids or self._cleared or self._favorite_ops or self._index_dirty)
+
+    @property
+    def is_stale(self) -> bool:
+        # 有未写盘或正在写盘的修改时不重新加载，写盘时会与磁盘内容合并
+        if self.is_dirty or self._writing:
+            return False
+        return self._needs_reload or wb_fileio.file_stamp(self.history_path) != self.disk_stamp
+
+    def written(self, stamp: tuple | None, foreign: bool):
+        """PendingJsonWrite 提交后调用；合并进了其它进程的修改时标记为需要重新加载"""
+        with self._state_lock:
+            self.disk_stamp = stamp
+            self._needs_reload = self._needs_reload or foreign
+            self._writing -= 1
+
+    def write_failed(self, item: "PendingJsonWrite"):
+        """写盘失败：内存中的数据仍是最新的，把涉及的历史和收藏操作重新标记为待写入"""
+        with self._state_lock:
+            self._writing -= 1
+        self._dirty_ids.update(item.changed.keys() | item.deleted)
+        self._cleared = self._cleared or item.cleared
+        self._favorite_ops = item.favorite_ops + self._favorite_ops
+        if item.rebuilt_summaries:
+            self._index_dirty = True
+
+    @property
+    def size_bytes(self) -> int:
+        # 以最近一次落盘的文件大小估算内存占用
+        try:
+            return os.path.getsize(self.history_path)
+        except OSError:
+            return 0
+
+    def take_pending_writes(self) -> list:
+        # 浅拷贝消息列表即可：消息本身只会被整体替换，不会原地修改
+        if not self.is_dirty:
+            return []
+        changed = {k: list(self.historyData[k]) for k in self._dirty_ids if k in self.historyData}
+        deleted = {k for k in self._dirty_ids if k not in self.historyData}
+        summaries = {k: dict(self.summaryIndex[k]) for k in changed}
+        # 加载时重建过索引：只补充磁盘索引缺少的条目，不覆盖其它进程写入的新摘要
+        rebuilt = {k: dict(v) for k, v in self.summaryIndex.items()} if self._index_dirty else None
+        item = PendingJsonWrite(self, changed, deleted, self._cleared, list(self._favorite_ops), summaries, rebuilt)
+        self._dirty_ids = set()
+        self._cleared = False
+        self._favorite_ops = []
+        self._index_dirty = False
+        with self._state_lock:
+            self._writing += 1
+        return [item]
+
+    def __sort_key(self, history_id: str):
+        return int(self.summaryIndex[history_id]["timestamp"]), history_id
+
+    def get_history_list(self, offset: int = 0, limit: int | None = None, cursor: str | None = None):
+        # 按时间戳倒序排列（最新的在前面），排序结果缓存到索引下次变化
+        if self._ordered_ids is None:
+            self._ordered_ids = sorted(self.summaryIndex, key=self.__sort_key, reverse=True)
+            self._positions = {history_id: i for i, history_id in enumerate(self._ordered_ids)}
+
+        start = 0
+        if cursor:
+            if cursor.partition(':')[2] in self._positions:
+                start = self._positions[cursor.partition(':')[2]] + 1
+            else:
+                # 游标指向的历史已被删除，按排序键定位
+                key = parse_history_cursor(cursor)
+                start = next((i for i, history_id in enumerate(self._ordered_ids)
+                              if self.__sort_key(history_id) < key), len(self._ordered_ids))
+        start += offset
+        end = None if limit is None else start + limit
+        return [{"id": history_id, **self.summaryIndex[history_id]} for history_id in self._ordered_ids[start:end]]
 
     def get_history_data(self, history_id: str):
         return self.historyData.get(history_id)
     
     def add_history(self, history_id: str, messages: list):
-        self.historyData[history_id] = messages
-        self.__save_json()
+        # 媒体数据写入 blob 存储，JSON 中只保留引用
+        self.historyData[history_id] = [blob_store.externalize_message(dict(msg)) for msg in messages]
+        self.summaryIndex[history_id] = summarize_history(history_id, self.historyData[history_id],
+                                                          history_id in self.favoriteData)
+        search_index.update_history(self.userId, history_id, self.historyData[history_id])
+        self.__bump_version(history_id)
+        self.__index_changed()
+        self.__save_json(history_id)
+
+    def append_messages(self, history_id: str, messages: list):
+        history = self.historyData.setdefault(history_id, [])
+        start = len(history)
+        history.extend(blob_store.externalize_message(dict(msg)) for msg in messages)
+        self.summaryIndex[history_id] = summarize_history(history_id, history, history_id in self.favoriteData)
+        search_index.update_messages(self.userId, history_id, start, history[start:])
+        self.__bump_version(history_id)
+        self.__index_changed()
+        self.__save_json(history_id)
     
     def delete_history(self, history_id: str):
         if history_id in self.historyData:
             del self.historyData[history_id]
-            self.__save_json()
+            self.summaryIndex.pop(history_id, None)
+            search_index.remove_history(self.userId, history_id)
+            self.__bump_version(history_id)
+            self.__index_changed()
+            self.__save_json(history_id)
             return True
         return False
     
     def clear_all_history(self):
         self.historyData = {}
+        self.summaryIndex = {}
+        search_index.clear_user(self.userId)
+        # 清空后所有历史的内容都变了，换一个前缀使之前的 ETag 全部失效
+        self._epoch = format(time.time_ns(), 'x')
+        self._history_versions.clear()
+        self._history_modified.clear()
+        self.__bump_version()
+        self.__index_changed()
+        self._cleared = True
+        self._dirty_ids = set()
         self.__save_json()
     
     def change_chat_in_history(self, history_id: str, message: Message, index: int):
+        msg = blob_store.externalize_message(message.model_dump())
+        summary = self.summaryIndex[history_id]
         if(index == -1 or index >= len(self.historyData[history_id])):
-            self.historyData[history_id].append(message.model_dump())
+            self.historyData[history_id].append(msg)
+            # 追加消息时增量更新摘要
+            summary["message_count"] += 1
+            summary["timestamp"] = msg.get("timestamp", history_id)
+            if summary["title"] == "无标题":
+                summary["title"] = make_history_title([msg])
+            index = len(self.historyData[history_id]) - 1
         else:
-            self.historyData[history_id][index] = message.model_dump()
-        self.__save_json()
+            self.historyData[history_id][index] = msg
+            self.summaryIndex[history_id] = summarize_history(history_id, self.historyData[history_id],
+                                                              summary["is_favorite"])
+        search_index.update_message(self.userId, history_id, index, msg)
+        self.__bump_version(history_id)
+        self.__index_changed()
+        self.__save_json(history_id)
+
+    def __set_favorite_flag(self, history_id: str, is_favorite: bool):
+        if history_id in self.summaryIndex:
+            self.summaryIndex[history_id]["is_favorite"] = is_favorite
+        self.__bump_version()
 
     def save(self):
-        self.__save_json()
+        self._dirty_ids.update(self.historyData)
+        self.flush()
     
     # 收藏相关方法
     def get_favorites(self):
@@ -107,27 +475,349 @@ class ChatHistoryJsonDB:
     def add_favorite(self, history_id: str):
         if history_id not in self.favoriteData:
             self.favoriteData.append(history_id)
-            self.__save_favorites()
+            self.__set_favorite_flag(history_id, True)
+            self.__save_favorites("add", history_id)
             return True
         return False
     
     def remove_favorite(self, history_id: str):
         if history_id in self.favoriteData:
             self.favoriteData.remove(history_id)
-            self.__save_favorites()
+            self.__set_favorite_flag(history_id, False)
+            self.__save_favorites("remove", history_id)
             return True
         return False
     
     def toggle_favorite(self, history_id: str):
         if history_id in self.favoriteData:
             self.favoriteData.remove(history_id)
-            self.__save_favorites()
+            self.__set_favorite_flag(history_id, False)
+            self.__save_favorites("remove", history_id)
             return False
         else:
             self.favoriteData.append(history_id)
-            self.__save_favorites()
+            self.__set_favorite_flag(history_id, True)
+            self.__save_favorites("add", history_id)
             return True
 
     def __del__(self):
-        self.__save_json()
-        self.__save_favorites()
+        # 只写回未保存的修改，只读的使用不会触发写盘
+        if self.is_dirty:
+            self.flush()
+
+
+# SQLite 存储：按消息逐条写入，历史列表走索引分页
+class HistoryRecord(SQLModel, table=True):
+    __tablename__ = "histories"
+    __table_args__ = (Index("ix_histories_user_time", "user_id", "last_timestamp"),)
+
+    user_id: str = Field(primary_key=True)
+    history_id: str = Field(primary_key=True)
+    title: str = "无标题"
+    last_timestamp: int = 0
+    message_count: int = 0
+
+
+class MessageRecord(SQLModel, table=True):
+    __tablename__ = "messages"
+    __table_args__ = (Index("ix_messages_history_pos", "user_id", "history_id", "position", unique=True),)
+
+    id: int | None = Field(default=None, primary_key=True)
+    user_id: str
+    history_id: str
+    position: int
+    is_user: bool
+    timestamp: str
+    text: str | None = ""
+    # 完整的消息 JSON（媒体已替换为 blob 引用）
+    data: str
+
+
+class FavoriteRecord(SQLModel, table=True):
+    __tablename__ = "favorites"
+    __table_args__ = (Index("ix_favorites_user_history", "user_id", "history_id", unique=True),)
+
+    id: int | None = Field(default=None, primary_key=True)
+    user_id: str
+    history_id: str
+
+
+_engines = {}
+
+
+def get_engine(url: str = CHAT_DB_URL):
+    engine = _engines.get(url)
+    if engine is None:
+        if url.startswith("sqlite:///"):
+            db_dir = os.path.dirname(url[len("sqlite:///"):])
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+        engine = create_engine(url, connect_args={"check_same_thread": False})
+
+        @event.listens_for(engine, "connect")
+        def _set_sqlite_pragma(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            # WAL 模式下读写互不阻塞，写入只追加日志
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.close()
+
+        SQLModel.metadata.create_all(engine)
+        _engines[url] = engine
+    return engine
+
+
+class ChatHistorySQLiteDB(ChatHistoryStore):
+    def __init__(self, user_id: str, url: str = CHAT_DB_URL):
+        self.userId = user_id
+        self.engine = get_engine(url)
+
+    def _message_rows(self, session: Session, history_id: str):
+        return session.exec(
+            select(MessageRecord)
+            .where(MessageRecord.user_id == self.userId, MessageRecord.history_id == history_id)
+            .order_by(MessageRecord.position)
+        ).all()
+
+    def _make_record(self, history_id: str, position: int, msg: dict) -> MessageRecord:
+        return MessageRecord(user_id=self.userId, history_id=history_id, position=position,
+                             is_user=msg.get("isUser", False), timestamp=msg.get("timestamp", ""),
+                             text=msg.get("text"), data=json.dumps(msg))
+
+    def _update_summary(self, session: Session, history_id: str):
+        # 摘要字段全部走 (user_id, history_id, position) 索引查询，不加载整段对话
+        in_history = (MessageRecord.user_id == self.userId, MessageRecord.history_id == history_id)
+        count = session.exec(select(func.count()).select_from(MessageRecord).where(*in_history)).one()
+        last = session.exec(select(MessageRecord).where(*in_history)
+                            .order_by(MessageRecord.position.desc()).limit(1)).first()
+        first_user = session.exec(select(MessageRecord).where(
+            *in_history, MessageRecord.is_user == True, func.trim(MessageRecord.text) != "")
+            .order_by(MessageRecord.position).limit(1)).first()
+        record = session.get(HistoryRecord, (self.userId, history_id)) or HistoryRecord(user_id=self.userId, history_id=history_id)
+        record.title = make_history_title([{"isUser": True, "text": first_user.text}] if first_user else [])
+        record.last_timestamp = int(last.timestamp if last else history_id)
+        record.message_count = count
+        session.add(record)
+
+    def get_history_list(self, offset: int = 0, limit: int | None = None, cursor: str | None = None):
+        with Session(self.engine) as session:
+            query = (select(HistoryRecord, FavoriteRecord.id)
+                     .join(FavoriteRecord, (FavoriteRecord.user_id == HistoryRecord.user_id)
+                           & (FavoriteRecord.history_id == HistoryRecord.history_id), isouter=True)
+                     .where(HistoryRecord.user_id == self.userId))
+            if cursor:
+                timestamp, history_id = parse_history_cursor(cursor)
+                query = query.where((HistoryRecord.last_timestamp < timestamp)
+                                    | ((HistoryRecord.last_timestamp == timestamp) & (HistoryRecord.history_id < history_id)))
+            query = (query.order_by(HistoryRecord.last_timestamp.desc(), HistoryRecord.history_id.desc())
+                     .offset(offset))
+            if limit is not None:
+                query = query.limit(limit)
+            return [{
+                "id": record.history_id,
+                "title": record.title,
+                "timestamp": str(record.last_timestamp),
+                "message_count": record.message_count,
+                "is_favorite": favorite_id is not None
+            } for record, favorite_id in session.exec(query).all()]
+
+    @wb_telemetry.timed(wb_telemetry.STORE_SECONDS, backend="sqlite", op="load")
+    def get_history_data(self, history_id: str):
+        with Session(self.engine) as session:
+            rows = self._message_rows(session, history_id)
+            if not rows and session.get(HistoryRecord, (self.userId, history_id)) is None:
+                return None
+            return [json.loads(row.data) for row in rows]
+
+    @wb_telemetry.timed(wb_telemetry.STORE_SECONDS, backend="sqlite", op="save")
+    def add_history(self, history_id: str, messages: list):
+        messages = [blob_store.externalize_message(dict(msg)) for msg in messages]
+        with Session(self.engine) as session:
+            rows = self._message_rows(session, history_id)
+            # 只写入新增或变化的消息，已有的前缀保持不动
+            for position, msg in enumerate(messages):
+                data = json.dumps(msg)
+                if position < len(rows):
+                    if rows[position].data != data:
+                        row = self._make_record(history_id, position, msg)
+                        row.id = rows[position].id
+                        session.merge(row)
+                else:
+                    session.add(self._make_record(history_id, position, msg))
+            if len(rows) > len(messages):
+                session.exec(delete(MessageRecord).where(
+                    MessageRecord.user_id == self.userId,
+                    MessageRecord.history_id == history_id,
+                    MessageRecord.position >= len(messages)))
+            session.flush()
+            self._update_summary(session, history_id)
+            session.commit()
+        search_index.update_history(self.userId, history_id, messages)
+
+    @wb_telemetry.timed(wb_telemetry.STORE_SECONDS, backend="sqlite", op="save")
+    def append_messages(self, history_id: str, messages: list):
+        messages = [blob_store.externalize_message(dict(msg)) for msg in messages]
+        with Session(self.engine) as session:
+            start = session.exec(select(func.count()).select_from(MessageRecord).where(
+                MessageRecord.user_id == self.userId, MessageRecord.history_id == history_id)).one()
+            for offset, msg in enumerate(messages):
+                session.add(self._make_record(history_id, start + offset, msg))
+            session.flush()
+            self._update_summary(session, history_id)
+            session.commit()
+        search_index.update_messages(self.userId, history_id, start, messages)
+
+    def delete_history(self, history_id: str):
+        with Session(self.engine) as session:
+            record = session.get(HistoryRecord, (self.userId, history_id))
+            if record is None:
+                return False
+            session.exec(delete(MessageRecord).where(
+                MessageRecord.user_id == self.userId, MessageRecord.history_id == history_id))
+            session.delete(record)
+            session.commit()
+        search_index.remove_history(self.userId, history_id)
+        return True
+
+    def clear_all_history(self):
+        with Session(self.engine) as session:
+            session.exec(delete(MessageRecord).where(MessageRecord.user_id == self.userId))
+            session.exec(delete(HistoryRecord).where(HistoryRecord.user_id == self.userId))
+            session.commit()
+        search_index.clear_user(self.userId)
+
+    def change_chat_in_history(self, history_id: str, message: Message, index: int):
+        msg = blob_store.externalize_message(message.model_dump())
+        with Session(self.engine) as session:
+            rows = self._message_rows(session, history_id)
+            if index == -1 or index >= len(rows):
+                index = len(rows)
+                session.add(self._make_record(history_id, index, msg))
+            else:
+                row = self._make_record(history_id, index, msg)
+                row.id = rows[index].id
+                session.merge(row)
+            session.flush()
+            self._update_summary(session, history_id)
+            session.commit()
+        search_index.update_message(self.userId, history_id, index, msg)
+
+    def save(self):
+        # 每次修改都已提交，无需额外保存
+        pass
+
+    # 收藏相关方法
+    def get_favorites(self):
+        with Session(self.engine) as session:
+            return list(session.exec(
+                select(FavoriteRecord.history_id)
+                .where(FavoriteRecord.user_id == self.userId)
+                .order_by(FavoriteRecord.id)
+            ).all())
+
+    def _get_favorite(self, session: Session, history_id: str):
+        return session.exec(select(FavoriteRecord).where(
+            FavoriteRecord.user_id == self.userId, FavoriteRecord.history_id == history_id)).first()
+
+    def add_favorite(self, history_id: str):
+        with Session(self.engine) as session:
+            if self._get_favorite(session, history_id) is not None:
+                return False
+            session.add(FavoriteRecord(user_id=self.userId, history_id=history_id))
+            session.commit()
+            return True
+
+    def remove_favorite(self, history_id: str):
+        with Session(self.engine) as session:
+            favorite = self._get_favorite(session, history_id)
+            if favorite is None:
+                return False
+            session.delete(favorite)
+            session.commit()
+            return True
+
+    def toggle_favorite(self, history_id: str):
+        if self.remove_favorite(history_id):
+            return False
+        return self.add_favorite(history_id)
+
+
+def create_chat_db(user_id: str, write_behind: bool = False) -> ChatHistoryStore:
+    """按配置（WB_CHAT_STORE）创建用户的对话存储"""
+    if CHAT_STORE_BACKEND == "sqlite":
+        return ChatHistorySQLiteDB(user_id)
+    return ChatHistoryJsonDB(user_id, write_behind=write_behind)
+
+
+class ChatStoreCache:
+    """
+    进程级的用户存储缓存。
+    同一用户的请求共享一个已加载的存储对象，按 LRU 淘汰；
+    修改只标记为脏，由后台任务按间隔合并写盘，淘汰和关闭时同样会写回。
+    """
+
+    def __init__(self, max_users: int = CHAT_CACHE_MAX_USERS, max_bytes: int = CHAT_CACHE_MAX_BYTES,
+                 flush_interval: float = CHAT_FLUSH_INTERVAL):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._stores: OrderedDict[str, ChatHistoryStore] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, user_id: str) -> ChatHistoryStore:
+        with self._lock:
+            store = self._stores.get(user_id)
+            if store is not None and not store.is_stale:
+                self._stores.move_to_end(user_id)
+                return store
+            # 首次使用，或其它 worker 进程修改了该用户的文件：重新加载
+            store = create_chat_db(user_id, write_behind=True)
+            self._stores[user_id] = store
+            self._stores.move_to_end(user_id)
+            self._evict()
+            return store
+
+    def _evict(self):
+        total_bytes = sum(store.size_bytes for store in self._stores.values())
+        # 至少保留最近使用的一个用户
+        while len(self._stores) > 1 and (len(self._stores) > self.max_users or total_bytes > self.max_bytes):
+            user_id, store = self._stores.popitem(last=False)
+            total_bytes -= store.size_bytes
+            store.flush()
+
+    def take_pending_writes(self) -> list:
+        with self._lock:
+            items = []
+            for store in self._stores.values():
+                if store.is_dirty:
+                    items.extend(store.take_pending_writes())
+            return items
+
+    def flush_all(self):
+        write_pending(self.take_pending_writes())
+
+    async def run_flusher(self):
+        """后台写盘任务：在事件循环中取快照，在线程池中写文件"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            items = self.take_pending_writes()
+            if items:
+                try:
+                    await asyncio.to_thread(write_pending, items)
+                except Exception as e:
+                    wb_telemetry.log_event("chat_flush_failed", logging.ERROR, error=str(e))
+
+    def clear(self):
+        with self._lock:
+            self.flush_all()
+            self._stores.clear()
+
+
+chat_store_cache = ChatStoreCache()
+# 未经 FastAPI lifespan 运行（如脚本中使用）时，退出前同样写回未保存的修改
+atexit.register(chat_store_cache.flush_all)
+
+
+def open_chat_db(user_id: str) -> ChatHistoryStore:
+    """获取用户的对话存储（进程内共享，修改由 chat_store_cache 延迟写盘）"""
+    return chat_store_cache.get(user_id)
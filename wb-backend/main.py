@@ -1,30 +1,77 @@
-from fastapi import FastAPI, WebSocket, UploadFile, File
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, Request, HTTPException
+from fastapi.responses import FileResponse, Response, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
+from pydantic import ValidationError
 import json
 import datetime
 import asyncio
 import os
-import base64
-from http import HTTPStatus
-from urllib.parse import urlparse, unquote
-from pathlib import PurePosixPath
-import requests
-from dashscope import ImageSynthesis
+import time
+import logging
 
 import dataModel
 import ChatLLM
-# import wb_audio  # 暂时注释掉音频功能以解决Python 3.13兼容性问题
-
-
-import os
+import wb_protocol
+import wb_tts_cache
+import wb_image_jobs
+import wb_telemetry
+import wb_asr
+import wb_admission
+import wb_context
+import wb_http_cache
+import wb_export
+from wb_blob import blob_store
+from wb_image import image_variants
+from wb_search import search_index
+# wb_audio 只在解码非 WAV 文件或重新编码时才导入 pydub，不影响 Python 3.13 下的启动
+import wb_audio
+import wb_recompress
 
 
 USER_DATA_PATH_ROOT = 'userData/'
 AUDIO_DATA_PATH_ROOT = USER_DATA_PATH_ROOT + 'audio/'
 IMAGE_DATA_PATH_ROOT = USER_DATA_PATH_ROOT + 'image/'
 CHAT_DATA_PATH_ROOT = USER_DATA_PATH_ROOT + 'chat/'
+# 长连接会话在没有新消息时保持的秒数
+CHAT_SESSION_IDLE_TIMEOUT = float(os.getenv("WB_CHAT_SESSION_IDLE_TIMEOUT", "600"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 后台合并写盘，关闭时写回所有未保存的对话
+    flusher = asyncio.create_task(dataModel.chat_store_cache.run_flusher())
+    # 线程中的上游调用（如上下文摘要）也经过准入控制，在本循环中排队
+    wb_admission.admission.bind_loop(asyncio.get_running_loop())
+    await wb_image_jobs.image_jobs.start()
+    # 可选：启动时预建 LLM 连接和语音合成器连接池，并定期探活
+    if os.getenv("WB_WARMUP", "0") == "1":
+        await ChatLLM.llm_client_registry.warm_up()
+        await asyncio.to_thread(ChatLLM.get_tts_pool)
+    health_checker = asyncio.create_task(check_clients_health())
+    # 可选：后台把历史中的 WAV 音频重新压缩为 mp3 / opus
+    recompressor = None
+    if os.getenv("WB_AUDIO_RECOMPRESS", "0") == "1":
+        recompressor = asyncio.create_task(wb_recompress.recompress_chat_files())
+    yield
+    health_checker.cancel()
+    wb_admission.admission.bind_loop(None)
+    wb_context.summary_cache.shutdown()
+    if recompressor is not None:
+        recompressor.cancel()
+    await wb_image_jobs.image_jobs.stop()
+    flusher.cancel()
+    dataModel.chat_store_cache.flush_all()
+    await ChatLLM.llm_client_registry.aclose()
+    await asyncio.to_thread(ChatLLM.shutdown_tts_pool)
+    wb_audio.shutdown_executor()
+    search_index.close_all()
+
+async def check_clients_health(interval: float = float(os.getenv("WB_CLIENT_HEALTH_INTERVAL", "60"))):
+    while True:
+        await asyncio.sleep(interval)
+        await ChatLLM.llm_client_registry.health_check()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware to allow requests from any origin
 app.add_middleware(
@@ -43,10 +90,17 @@ async def root():
     return {"message": "Wall Breaking Backend API is running", "status": "ok"}
 
 @app.get("/api/chat/{user_id}/{history_id}")
-async def chat(user_id: str, history_id: str):
-    chatdb = dataModel.ChatHistoryJsonDB(user_id)
-    messages = chatdb.get_history_data(history_id)
-    return dataModel.ChatData(history_id=history_id, messages=messages, user_id=user_id)
+async def chat(user_id: str, history_id: str, request: Request):
+    """单段历史的全部消息；内容未变化时按 ETag 返回 304"""
+    chatdb = dataModel.open_chat_db(user_id)
+
+    def build():
+        messages = chatdb.get_history_data(history_id)
+        chat_data = dataModel.ChatData(history_id=history_id, messages=messages, user_id=user_id)
+        return chat_data.model_dump_json().encode(), {}
+
+    return await wb_http_cache.response_cache.respond(request, ("chat", user_id, history_id),
+                                                      chatdb.history_version(history_id), build)
 
 @app.post("/api/chat/{user_id}/{history_id}")
 async def save_chat(user_id: str, history_id: str, chat_data: dataModel.ChatData):
@@ -56,73 +110,494 @@ async def save_chat(user_id: str, history_id: str, chat_data: dataModel.ChatData
     except Exception as e:
         return {"success": False, "message": f"保存失败: {str(e)}"}
 
+@asynccontextmanager
+async def chat_turn_metrics(stats: dict):
+    """一轮对话的耗时与用量，结束时写入指标和一条（可采样的）结构化日志"""
+    turn_start = time.perf_counter()
+    try:
+        yield
+    except WebSocketDisconnect:
+        stats["status"] = "disconnected"
+        raise
+    except asyncio.CancelledError:
+        stats["status"] = "cancelled"
+        raise
+    except Exception as e:
+        stats["status"] = "error"
+        wb_telemetry.log_event("chat_turn_failed", logging.ERROR, exc_info=e, **stats)
+        raise
+    finally:
+        duration = time.perf_counter() - turn_start
+        wb_telemetry.CHAT_STAGE_SECONDS.labels(stage="turn").observe(duration)
+        wb_telemetry.CHAT_TURNS.labels(model=stats["model"], status=stats.setdefault("status", "ok")).inc()
+        wb_telemetry.log_event("chat_turn", sampled=True, duration_ms=round(duration * 1000), **stats)
+
 @app.websocket("/ws/chat/")
 async def chat_ws(ws: WebSocket):
-    full_content = ""
     await ws.accept()
+    stats = {"model": "unknown"}
+    try:
+        async with chat_turn_metrics(stats):
+            await handle_chat_turn(ws, stats)
+    except WebSocketDisconnect:
+        pass
+
+async def handle_chat_turn(ws: WebSocket, stats: dict):
+    stage_start = time.perf_counter()
     data = await ws.receive_json()
     chat_data = dataModel.ChatData(**data).model_dump()
-    
+    wb_telemetry.CHAT_STAGE_SECONDS.labels(stage="accept").observe(time.perf_counter() - stage_start)
+    stats.update(user_id=chat_data["user_id"], history_id=chat_data["history_id"])
+
+    # 协商推流协议：旧客户端不携带 protocol 字段，仍按完整快照推送
+    writer = wb_protocol.ChatStreamWriter(ws, chat_data, wb_protocol.negotiate_protocol(data),
+                                          stream_audio=data.get("audio_stream", True) is not False)
+    # 协商回复音频的编码，旧客户端不携带 audio_format，仍返回 WAV
+    audio_format = wb_protocol.negotiate_audio_format(data)
+
     # 获取前端传来的system_prompt，如果没有则使用默认值
-    system_prompt = data.get('system_prompt', None)
-    
+    await generate_reply(writer, data.get('system_prompt', None), audio_format, stats)
+    await writer.close()
+
+    # 保存聊天记录到数据库，中途停止或断开时保存已生成的部分
+    with wb_telemetry.CHAT_STAGE_SECONDS.labels(stage="save").time():
+        chatdb = dataModel.open_chat_db(chat_data["user_id"])
+        chatdb.add_history(chat_data["history_id"], chat_data["messages"])
+
+@app.websocket("/ws/chat/session/")
+async def chat_session_ws(ws: WebSocket):
+    """
+    多轮长连接会话：连接在多轮对话之间保持打开，历史只在建立会话时从存储加载一次，
+    之后每轮客户端只发送新的一条消息。推流使用增量协议（见 wb_protocol）。
+    """
+    await ws.accept()
+    try:
+        # 首帧与 /ws/chat/ 相同，只是不携带 messages
+        data = await ws.receive_json()
+        user_id, history_id = data.get("user_id"), data.get("history_id")
+        if not user_id or not history_id:
+            await ws.send_json({"v": wb_protocol.PROTOCOL_DELTA, "type": "error",
+                                "message": "user_id and history_id are required"})
+            await ws.close()
+            return
+        user_id, history_id = str(user_id), str(history_id)
+        history = dataModel.open_chat_db(user_id).get_history_data(history_id)
+        is_new = history is None
+        chat_data = {"user_id": user_id, "history_id": history_id, "messages": list(history or [])}
+        writer = wb_protocol.ChatStreamWriter(ws, chat_data, wb_protocol.PROTOCOL_DELTA,
+                                              stream_audio=data.get("audio_stream", True) is not False)
+        audio_format = wb_protocol.negotiate_audio_format(data)
+        system_prompt = data.get("system_prompt", None)
+        await writer.session(history_id, len(chat_data["messages"]))
+
+        # 回复过程中收到的新消息会打断当前回复，作为下一轮处理
+        pending = None
+        while not writer.closed:
+            if pending is not None:
+                frame, pending = pending, None
+            else:
+                try:
+                    frame = await asyncio.wait_for(ws.receive_json(), CHAT_SESSION_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+            if frame.get("type") == "close":
+                break
+            if frame.get("type") == "stop":
+                # 没有进行中的回复，忽略
+                continue
+            try:
+                message = dataModel.Message(**frame.get("message") or {}).model_dump()
+            except ValidationError as e:
+                await writer.error(str(e))
+                continue
+            system_prompt = frame.get("system_prompt", system_prompt)
+
+            stats = {"model": "unknown", "user_id": user_id, "history_id": history_id, "session": True}
+            async with chat_turn_metrics(stats):
+                first_new = len(chat_data["messages"])
+                chat_data["messages"].append(message)
+                interrupt = await generate_reply(writer, system_prompt, audio_format, stats)
+                # 本轮的用户消息和回复（回复开始前就被打断时只有用户消息）
+                new_messages = chat_data["messages"][first_new:]
+                with wb_telemetry.CHAT_STAGE_SECONDS.labels(stage="save").time():
+                    # 每次重新获取存储对象，期间被缓存淘汰时也能写到当前的实例
+                    chatdb = dataModel.open_chat_db(user_id)
+                    if is_new:
+                        chatdb.add_history(history_id, chat_data["messages"])
+                        is_new = False
+                    else:
+                        for msg in new_messages:
+                            chatdb.change_chat_in_history(history_id, dataModel.Message(**msg), -1)
+                # 会话内只保留 blob 引用，媒体数据不常驻内存
+                chat_data["messages"][first_new:] = [blob_store.externalize_message(dict(msg)) for msg in new_messages]
+            if interrupt is not None and interrupt.get("type") != "stop":
+                pending = interrupt
+        await writer.close()
+    except WebSocketDisconnect:
+        pass
+
+async def generate_reply(writer: wb_protocol.ChatStreamWriter, system_prompt: str | None,
+                         audio_format: str, stats: dict) -> dict | None:
+    """
+    根据 writer.chat_data 中的历史生成一条回复，文本与语音边生成边推送，回复追加到历史末尾。
+    生成期间客户端断开、发送 stop 或新的消息时，立即中止上游生成和语音合成并归还连接，
+    已生成的部分保留在回复中由调用方保存。返回打断本轮的客户端帧，没有时返回 None。
+    """
+    messages = writer.chat_data["messages"]
+    stats["audio_format"] = audio_format
+
     # 检查是否有图像消息，如果有则使用支持视觉的模型
-    has_image = any(msg.get('image_base64') for msg in chat_data["messages"])
+    has_image = any(msg.get('image_base64') or msg.get('image_ref') for msg in messages)
     model_name = "qwen-vl-max-latest" if has_image else "qwen-omni-turbo"
-    
-    llm_client = ChatLLM.LLMTextClient(model=model_name)
-    t_to_vioce = ChatLLM.TextToSpeechClient()
-    # 使用 LLMClient 的 stream 方法，传入自定义的system_prompt
-    completion = llm_client.stream(chat_data["messages"], system_prompt=system_prompt)
-    
-    # 插入系统消息前，确保 messages 格式正确
-    chat_data["messages"].append({"isUser": False, "text": "", "timestamp": now_time()})
-
-    for chunk in completion:  # 注意：这里假设 completion 是异步生成器，如果不是，请根据实际情况调整
-        if hasattr(chunk, 'choices') and chunk.choices:
-            delta_content = chunk.choices[0].delta.content or ""
-            full_content += delta_content
-            # 更新最后一次的消息内容
-            chat_data["messages"][-1]["text"] = full_content
-            # 确保发送的数据包含完整的消息历史，包括图片信息
-            await ws.send_json(chat_data)
-
-    chat_data["messages"][-1]["audio_base64"] = t_to_vioce.text_to_speech(full_content)
-    await ws.send_json(chat_data)
-    
-    await ws.close()
-    
-    # 保存聊天记录到数据库
-    chatdb = dataModel.ChatHistoryJsonDB(chat_data["user_id"])
-    chatdb.add_history(chat_data["history_id"], chat_data["messages"])
+    stats["model"] = model_name
+
+    llm_client = ChatLLM.get_llm_client(model_name)
+    # 流式语音合成：按句合成，与文本生成并行
+    tts_stream = ChatLLM.StreamingTextToSpeech(format=ChatLLM.TTS_FORMATS[audio_format],
+                                               user_id=writer.chat_data["user_id"])
+    request_start = time.perf_counter()
+    completion = None
+    started = False
+    first_token_at = None
+    token_chunks = 0
+    usage = None
+
+    async def stream_completion():
+        nonlocal completion, started, first_token_at, token_chunks, usage
+        # 使用 LLMClient 的异步 astream 方法，传入自定义的system_prompt，避免阻塞其他连接
+        # 历史消息按上下文预算裁剪，保留下来的 blob 引用在 _format_messages 中还原
+        completion = await llm_client.astream(messages, system_prompt=system_prompt)
+        # 追加空的回复消息，后续增量写入
+        await writer.start(now_time())
+        started = True
+        async for chunk in completion:
+            # include_usage 时最后一个 chunk 的 choices 为空，只携带用量
+            if getattr(chunk, 'usage', None):
+                usage = chunk.usage
+            if hasattr(chunk, 'choices') and chunk.choices:
+                delta_content = chunk.choices[0].delta.content or ""
+                if delta_content:
+                    token_chunks += 1
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        wb_telemetry.LLM_TTFT_SECONDS.labels(model=model_name).observe(first_token_at - request_start)
+                tts_stream.feed(delta_content)
+                await writer.delta(delta_content)
+                if writer.closed:
+                    return
+
+    async def stream_reply():
+        # 按模型和用户限制并发，名额不足时排队并向客户端推送排队位置
+        async with wb_admission.admission.slot(model_name, writer.chat_data["user_id"], on_queued=writer.queued):
+            await stream_completion()
+
+    async def push_audio():
+        async for chunk in tts_stream.chunks():
+            await writer.audio_chunk(chunk, tts_stream.format.format, tts_stream.format.sample_rate)
+
+    async def listen():
+        # 生成期间同时接收客户端的帧：断开连接、stop 或新的消息都会打断本轮
+        while True:
+            try:
+                frame = await writer.ws.receive_json()
+            except ValueError:
+                continue
+            if isinstance(frame, dict) and frame.get("type") in wb_protocol.INTERRUPT_FRAMES:
+                return frame
+
+    audio_task = asyncio.create_task(push_audio())
+    generation = asyncio.create_task(stream_reply())
+    listener = asyncio.create_task(listen())
+    await asyncio.wait((generation, listener), return_when=asyncio.FIRST_COMPLETED)
+
+    interrupt = None
+    if not generation.done():
+        generation.cancel()
+        try:
+            interrupt = listener.result()
+            stats["status"] = "stopped"
+        except WebSocketDisconnect:
+            writer.closed = True
+    else:
+        listener.cancel()
+    await asyncio.wait((generation, listener))
+    if listener.done() and not listener.cancelled() and isinstance(listener.exception(), WebSocketDisconnect):
+        writer.closed = True
+    if writer.closed:
+        stats["status"] = "disconnected"
+    error = None if generation.cancelled() else generation.exception()
+    if isinstance(error, wb_admission.AdmissionRejected):
+        stats["status"] = "rejected"
+        await writer.error("服务繁忙，请稍后再试")
+
+    generation_end = time.perf_counter()
+    wb_telemetry.CHAT_STAGE_SECONDS.labels(stage="generation").observe(generation_end - request_start)
+    record_llm_usage(stats, model_name, usage, token_chunks, request_start, first_token_at, generation_end)
+
+    if error is not None or stats.get("status") in ("stopped", "disconnected", "rejected"):
+        # 关闭上游的流式响应，连接归还连接池；未合成的句子直接丢弃
+        if completion is not None:
+            await completion.close()
+        audio = await tts_stream.cancel()
+    else:
+        try:
+            audio = await tts_stream.finish()
+        except Exception as e:
+            # 语音合成失败（finish 中已记录 tts_failed）不影响文本回复：照常保存并结束本轮，只是不带语音
+            stats["tts_error"] = str(e)
+            audio = b""
+    await audio_task
+    if error is not None and stats.get("status") != "rejected":
+        raise error
+    stats["audio_bytes"] = len(audio)
+    if started:
+        # 最终消息仍保存一条完整的音轨（中止时为已合成的部分）
+        if audio:
+            await writer.audio(tts_stream.to_data_uri(audio), audio_format)
+        await writer.done(stopped=stats.get("status") == "stopped")
+    return interrupt
+
+def record_llm_usage(stats: dict, model_name: str, usage, token_chunks: int,
+                     request_start: float, first_token_at: float | None, generation_end: float):
+    """记录首 token 延迟、生成速度和上游返回的 token 用量"""
+    completion_tokens = usage.completion_tokens if usage else token_chunks
+    if first_token_at is not None:
+        stats["ttft_ms"] = round((first_token_at - request_start) * 1000)
+        if completion_tokens and generation_end > first_token_at:
+            wb_telemetry.LLM_TOKEN_RATE.labels(model=model_name).observe(
+                completion_tokens / (generation_end - first_token_at))
+    if usage:
+        wb_telemetry.LLM_TOKENS.labels(model=model_name, kind="prompt").inc(usage.prompt_tokens)
+        wb_telemetry.LLM_TOKENS.labels(model=model_name, kind="completion").inc(usage.completion_tokens)
+        stats.update(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+
+@app.websocket("/ws/asr/")
+async def asr_ws(ws: WebSocket):
+    """
+    实时语音识别。客户端首帧发送 {"format": "pcm", "sample_rate": 16000}，
+    随后发送二进制音频帧，说完后发送 {"type": "stop"}。
+    服务端推送 {"type": "partial", "text", "sentence_end"}，最后推送 {"type": "final", "text"}；
+    参数无效或识别出错时推送 {"type": "error", "message"} 后关闭连接。
+    """
+    await ws.accept()
+    try:
+        config = await ws.receive_json()
+        if not isinstance(config, dict):
+            raise ValueError("expected a JSON object")
+        audio_format = config.get("format", "pcm")
+        sample_rate = int(config.get("sample_rate", wb_asr.ASR_SAMPLE_RATE))
+    except WebSocketDisconnect:
+        return
+    except (ValueError, TypeError, KeyError) as e:
+        # 非 JSON、非对象、二进制首帧或采样率无效
+        await ws.send_json({"type": "error", "message": f"Invalid config: {e}"})
+        await ws.close()
+        return
+    if audio_format not in wb_asr.ASR_FORMATS:
+        await ws.send_json({"type": "error", "message": f"Unsupported audio format: {audio_format}"})
+        await ws.close()
+        return
+    session = wb_asr.asr_pool.acquire(audio_format, sample_rate)
+    if session is None:
+        wb_telemetry.ASR_SESSIONS.labels(status="rejected").inc()
+        await ws.send_json({"type": "error", "message": "Too many speech recognition sessions"})
+        await ws.close()
+        return
+
+    status = "ok"
+    forwarder = None
+    # start() 成功后必须 stop()，否则识别的 websocket 和线程要等上游超时才释放
+    started = False
+    try:
+        session.start()
+        started = True
+
+        async def forward_events():
+            async for event in session.events():
+                await ws.send_json(event)
+        forwarder = asyncio.create_task(forward_events())
+
+        while True:
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                status = "disconnected"
+                break
+            if message.get("bytes"):
+                session.send(message["bytes"])
+            elif message.get("text"):
+                try:
+                    frame = json.loads(message["text"])
+                except ValueError:
+                    continue
+                if isinstance(frame, dict) and frame.get("type") == "stop":
+                    break
+
+        if status == "disconnected":
+            forwarder.cancel()
+            return
+        stop_start = time.perf_counter()
+        started = False
+        text = await session.stop()
+        wb_telemetry.ASR_FINALIZE_SECONDS.observe(time.perf_counter() - stop_start)
+        await forwarder
+        if status == "ok":
+            if session.error:
+                status = "error"
+            await ws.send_json({"type": "final", "text": text, "error": session.error})
+            await ws.close()
+    except Exception as e:
+        status = "error"
+        wb_telemetry.log_event("asr_failed", logging.WARNING, format=audio_format,
+                               sample_rate=sample_rate, error=str(e))
+        if forwarder is not None:
+            forwarder.cancel()
+        try:
+            await ws.send_json({"type": "error", "message": "Speech recognition failed"})
+            await ws.close()
+        except Exception:
+            # 客户端已断开
+            pass
+    finally:
+        if started:
+            try:
+                await session.stop()
+            except Exception as e:
+                status = "error"
+                wb_telemetry.log_event("asr_stop_failed", logging.WARNING, error=str(e))
+        wb_telemetry.ASR_SESSIONS.labels(status=status).inc()
+        wb_asr.asr_pool.release(session, reusable=status == "ok")
+
+def blob_path_or_404(ref: str) -> str:
+    try:
+        path = blob_store.path(ref)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid blob reference")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    return path
+
+def blob_response(ref: str, request: Request, cache_control: str = "public, max-age=31536000, immutable"):
+    etag = '"' + ref.split('.')[0] + '"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(blob_store.path(ref), media_type=blob_store.content_type(ref), headers=headers)
+
+@app.get("/api/blob/{ref}")
+async def get_blob(ref: str, request: Request):
+    """按内容哈希返回音频/图片原始数据，支持 Range 请求，内容不可变可长期缓存"""
+    blob_path_or_404(ref)
+    return blob_response(ref, request)
+
+@app.get("/api/blob/{ref}/thumbnail")
+async def get_blob_thumbnail(ref: str, request: Request):
+    """图片的缩略图，供历史记录显示；首次请求时生成并缓存，原图足够小时直接返回原图"""
+    blob_path_or_404(ref)
+    if not blob_store.content_type(ref).startswith("image/"):
+        raise HTTPException(status_code=400, detail="Not an image")
+    thumb_ref = await image_variants.aget(ref, "thumb")
+    # 缩略图参数可能调整，不标记为 immutable，按 ETag 重新验证
+    return blob_response(thumb_ref, request, cache_control="public, max-age=86400")
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 文本格式的运行指标"""
+    return PlainTextResponse(wb_telemetry.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/tts-cache/stats")
+async def tts_cache_stats():
+    return wb_tts_cache.tts_cache.stats()
 
 @app.get("/api/chat_history_list/{user_id}")
-async def chat_history(user_id: str):
-    chatdb = dataModel.ChatHistoryJsonDB(user_id)
-    history_data = chatdb.get_history_list()
-    return history_data
+async def chat_history(user_id: str, request: Request, offset: int = 0, limit: int | None = None,
+                       cursor: str | None = None):
+    """
+    历史列表，支持 offset/limit 分页或 cursor 游标分页，下一页游标通过 X-Next-Cursor 响应头返回。
+    列表未变化时按 ETag 返回 304。
+    """
+    chatdb = dataModel.open_chat_db(user_id)
+
+    def build():
+        history_data = chatdb.get_history_list(offset=offset, limit=limit, cursor=cursor)
+        headers = {}
+        if limit is not None and len(history_data) == limit:
+            headers["X-Next-Cursor"] = dataModel.make_history_cursor(history_data[-1])
+        return json.dumps(history_data, ensure_ascii=False).encode(), headers
+
+    return await wb_http_cache.response_cache.respond(request, ("history_list", user_id, offset, limit, cursor),
+                                                      chatdb.list_version(), build)
+
+@app.get("/api/search/{user_id}")
+async def search_chat_history(user_id: str, q: str, limit: int = 20):
+    """全文搜索用户的对话，按相关度返回历史 id、标题和命中片段；首次搜索时建立索引"""
+    chatdb = dataModel.open_chat_db(user_id)
+    results = await asyncio.to_thread(search_index.search, user_id, q, chatdb, max(1, min(limit, 100)))
+    if results:
+        summaries = {item["id"]: item for item in chatdb.get_history_list()}
+        results = [dict(summaries[result["id"]], **result) for result in results if result["id"] in summaries]
+    return {"query": q, "results": results}
 
 @app.delete("/api/chat_history/{user_id}/{history_id}")
 async def delete_chat_history(user_id: str, history_id: str):
-    chatdb = dataModel.ChatHistoryJsonDB(user_id)
+    chatdb = dataModel.open_chat_db(user_id)
     success = chatdb.delete_history(history_id)
     return {"success": success, "message": "历史记录删除成功" if success else "历史记录不存在"}
 
 @app.delete("/api/chat_history_all/{user_id}")
 async def clear_all_chat_history(user_id: str):
-    chatdb = dataModel.ChatHistoryJsonDB(user_id)
+    chatdb = dataModel.open_chat_db(user_id)
     chatdb.clear_all_history()
     return {"success": True, "message": "所有历史记录已清空"}
 
+@app.get("/api/export/{user_id}")
+async def export_chat_history(user_id: str, media: str = "ref"):
+    """
+    以 NDJSON 流式导出用户的全部对话，每行一条消息（格式见 wb_export）。
+    media=ref 只导出 blob 引用，media=inline 把音频/图片内嵌为 base64。
+    """
+    if media not in wb_export.MEDIA_MODES:
+        raise HTTPException(status_code=400, detail="media must be one of: " + ", ".join(wb_export.MEDIA_MODES))
+    chatdb = dataModel.open_chat_db(user_id)
+    filename = f"{user_id}-{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.ndjson"
+    # 同步迭代器由 Starlette 放到线程池中执行，读取 blob 不阻塞事件循环
+    return StreamingResponse(wb_export.export_history(chatdb, user_id, media), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.post("/api/import/{user_id}")
+async def import_chat_history(user_id: str, request: Request, mode: str = "merge"):
+    """
+    流式导入 /api/export 生成的 NDJSON（请求体即文件内容），按批写入存储。
+    mode=merge 覆盖同 id 的历史并保留其它历史，mode=replace 先清空用户的全部历史。
+    出错时出错行之前的内容已写入，响应中给出出错的行号。
+    """
+    if mode not in ("merge", "replace"):
+        raise HTTPException(status_code=400, detail="mode must be merge or replace")
+    importer = wb_export.HistoryImporter(user_id, replace=mode == "replace")
+    error = None
+    try:
+        async for line in wb_export.iter_lines(request.stream()):
+            if importer.feed(line):
+                await importer.write_batch()
+    except wb_export.LineTooLong as e:
+        error = HTTPException(status_code=413, detail=f"line {importer.line_no + 1}: {e}")
+    except ValueError as e:
+        error = HTTPException(status_code=400, detail=f"line {importer.line_no}: {e}")
+    await importer.flush()
+    result = importer.result()
+    if error is not None:
+        error.detail = f"{error.detail} ({result['messages']} message(s) imported before the error)"
+        raise error
+    return {"success": True, **result}
+
 @app.get("/api/favorites/{user_id}")
 async def get_favorites(user_id: str):
-    chatdb = dataModel.ChatHistoryJsonDB(user_id)
+    chatdb = dataModel.open_chat_db(user_id)
     favorites = chatdb.get_favorites()
     return {"favorites": favorites}
 
 @app.post("/api/favorite/{user_id}/{history_id}")
 async def toggle_favorite(user_id: str, history_id: str):
-    chatdb = dataModel.ChatHistoryJsonDB(user_id)
+    chatdb = dataModel.open_chat_db(user_id)
     is_favorited = chatdb.toggle_favorite(history_id)
     return {
         "success": True, 
@@ -130,113 +605,89 @@ async def toggle_favorite(user_id: str, history_id: str):
         "message": "已收藏" if is_favorited else "已取消收藏"
     }
 
+def image_job_info(job: wb_image_jobs.ImageJob) -> dict:
+    info = {"job_id": job.job_id, "status": job.status, "prompt": job.prompt}
+    if job.status == wb_image_jobs.JOB_DONE:
+        info["image_url"] = f"/api/image-generation/{job.job_id}/image"
+        info["image_type"] = job.image_type
+    if job.error:
+        info["error"] = job.error
+    return info
+
 @app.post("/api/image-generation")
 async def image_generation(request: dict):
+    """提交图像生成任务，立即返回任务 id；状态通过轮询或 websocket 获取"""
+    prompt = request.get('prompt', '')
+    if not prompt:
+        return {"error": "Prompt is required"}
     try:
-        prompt = request.get('prompt', '')
-        print(f"Received request: {request}")
-        import sys
-        sys.stdout.flush()
-        if not prompt:
-            return {"error": "Prompt is required"}
-        
-        print(f"Generating image with prompt: {prompt}")
-        sys.stdout.flush()
-        
-        # 调用阿里云百炼图像生成API
-        api_key = os.getenv("DASHSCOPE_API_KEY")
-        print(f"Using API key: {api_key[:10]}..." if api_key else "No API key found")
-        sys.stdout.flush()
-        
-        rsp = ImageSynthesis.call(
-            api_key=api_key,
-            model="qwen-image",
-            prompt=prompt,
-            n=1,
-            size='1328*1328',  # 可用图片大小为 1664*928,1472*1140,1328*1328,1140*1472,928*1664.
-            prompt_extend=True,
-            watermark=False
-        )
-        
-        print(f"API response status: {rsp.status_code}")
-        print(f"API response type: {type(rsp)}")
-        print(f"API response attributes: {dir(rsp)}")
-        print(f"Full API response: {rsp}")
-        sys.stdout.flush()
-        
-        # 打印完整的响应内容
-        if hasattr(rsp, '__dict__'):
-            print(f"Response dict: {rsp.__dict__}")
-        if hasattr(rsp, 'output'):
-            print(f"Response output dict: {rsp.output.__dict__ if hasattr(rsp.output, '__dict__') else rsp.output}")
-        sys.stdout.flush()
-        
-        if rsp.status_code == HTTPStatus.OK:
-            print(f"Response output: {rsp.output}")
-            print(f"Response output type: {type(rsp.output)}")
-            
-            # 检查输出结构
-            if hasattr(rsp.output, 'results') and len(rsp.output.results) > 0:
-                # 获取生成的图像URL
-                image_url = rsp.output.results[0].url
-                print(f"Image URL: {image_url}")
-                
-                # 下载图像并转换为base64
-                response = requests.get(image_url)
-                if response.status_code == 200:
-                    image_base64 = base64.b64encode(response.content).decode('utf-8')
-                    print(f"Successfully generated image, base64 length: {len(image_base64)}")
-                    return {
-                        "success": True,
-                        "image_base64": image_base64,
-                        "image_type": "image/png",
-                        "prompt": prompt
-                    }
-                else:
-                    return {"error": f"Failed to download generated image, status: {response.status_code}"}
-            else:
-                print(f"No results found. Output structure: {rsp.output}")
-                return {"error": f"No results in API response. Output: {rsp.output}"}
-        else:
-            print(f"API call failed with status: {rsp.status_code}")
-            print(f"Error code: {getattr(rsp, 'code', 'Unknown')}")
-            print(f"Error message: {getattr(rsp, 'message', 'Unknown')}")
-            return {
-                "error": f"Image generation failed: {getattr(rsp, 'message', 'Unknown error')}",
-                "status_code": rsp.status_code,
-                "code": getattr(rsp, 'code', 'Unknown')
-            }
-    except Exception as e:
-        print(f"Exception in image generation: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return {"error": f"Image generation error: {str(e)}"}
-
-
-# 暂时注释掉音频功能
-# async def audio_save(audio_file: UploadFile, userId: str, historyId: str) -> str:
-#     # Validate content type
-#     allowed_types = ['audio/wav', 'audio/mpeg', 'audio/ogg']
-#     if audio_file.content_type not in allowed_types:
-#         return {"error": f"Invalid file type. Allowed types: {', '.join(allowed_types)}"}
-#     
-#     # Save the uploaded audio file
-#     upload_dir = AUDIO_DATA_PATH_ROOT + userId
-#     os.makedirs(upload_dir, exist_ok=True)
-#     file_name = f"{historyId}_{now_time()}.{audio_file.filename.split('.')[-1]}"
-#     file_path = os.path.join(upload_dir, file_name)
-#     with open(file_path, "wb") as buffer:
-#         buffer.write(await audio_file.read())
-#     try:
-#         if(wb_audio.audio_length(file_path) > 60):
-#             raise Exception("Audio length is too long")
-#         if(wb_audio.get_audio_track_count(file_path) > 1):
-#             audio_file = wb_audio.merge_audio_tracks(file_path)
-#             audio_file.export(file_path, format="wav")
-#     except Exception as e:
-#         os.remove(file_path)
-#         raise e
-#     return file_path, file_name
+        job = wb_image_jobs.image_jobs.submit(request.get('user_id', 'anonymous'), prompt)
+    except wb_image_jobs.ImageJobLimitError as e:
+        return {"error": str(e)}
+    return {"success": True, **image_job_info(job)}
+
+@app.get("/api/image-generation/{job_id}")
+async def image_generation_status(job_id: str, wait: float = 0):
+    """查询任务状态，wait > 0 时最多等待该秒数直到状态变化（长轮询）"""
+    job = wb_image_jobs.image_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if wait > 0 and not job.finished:
+        job = await wb_image_jobs.image_jobs.wait_for_change(job, job.status, timeout=min(wait, 60))
+    return image_job_info(job)
+
+@app.get("/api/image-generation/{job_id}/image")
+async def image_generation_result(job_id: str):
+    job = wb_image_jobs.image_jobs.get(job_id)
+    if job is None or job.status != wb_image_jobs.JOB_DONE or not os.path.exists(job.image_path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    return FileResponse(job.image_path, media_type=job.image_type or "image/png",
+                        headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+@app.websocket("/ws/image-generation/{job_id}")
+async def image_generation_ws(ws: WebSocket, job_id: str):
+    """推送任务状态变化，任务结束后关闭连接"""
+    await ws.accept()
+    job = wb_image_jobs.image_jobs.get(job_id)
+    if job is None:
+        await ws.send_json({"job_id": job_id, "status": wb_image_jobs.JOB_FAILED, "error": "Job not found"})
+        await ws.close()
+        return
+    last_status = None
+    while True:
+        if job.status != last_status:
+            last_status = job.status
+            await ws.send_json(image_job_info(job))
+        if job.finished:
+            break
+        job = await wb_image_jobs.image_jobs.wait_for_change(job, last_status, timeout=30)
+    await ws.close()
+
+
+async def audio_save(audio_file: UploadFile, userId: str, historyId: str) -> tuple[str, str]:
+    # Validate content type
+    allowed_types = ['audio/wav', 'audio/mpeg', 'audio/ogg']
+    if audio_file.content_type not in allowed_types:
+        raise HTTPException(status_code=415, detail=f"Invalid file type. Allowed types: {', '.join(allowed_types)}")
+
+    # Save the uploaded audio file
+    upload_dir = AUDIO_DATA_PATH_ROOT + userId
+    os.makedirs(upload_dir, exist_ok=True)
+    upload_path = os.path.join(upload_dir, f"{historyId}_{now_time()}.{audio_file.filename.split('.')[-1]}")
+    with open(upload_path, "wb") as buffer:
+        buffer.write(await audio_file.read())
+    # 一次解码完成时长检查与转换（16kHz 单声道 WAV），在进程池中执行
+    file_path = os.path.splitext(upload_path)[0] + ".wav"
+    try:
+        await wb_audio.anormalize_audio(upload_path, file_path, max_duration=60)
+    except Exception:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+    finally:
+        if upload_path != file_path:
+            os.remove(upload_path)
+    return file_path, os.path.basename(file_path)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,39 @@
+import os
+import glob
+import argparse
+
+import dataModel
+
+# 将 JSON 文件中的对话历史和收藏迁移到 SQLite 存储
+# 用法: python migrate_store.py [--db-url sqlite:///userData/chat.db] [user_id ...]
+
+
+def list_json_users(chat_root: str = dataModel.CHAT_DATA_PATH_ROOT) -> list[str]:
+    users = []
+    for file_path in glob.glob(os.path.join(chat_root, '*.json')):
+        name = os.path.basename(file_path)[:-len('.json')]
+        if not name.endswith(('_favorites', '_index')):
+            users.append(name)
+    return sorted(users)
+
+
+def migrate_user(user_id: str, db_url: str = dataModel.CHAT_DB_URL) -> int:
+    json_db = dataModel.ChatHistoryJsonDB(user_id)
+    sqlite_db = dataModel.ChatHistorySQLiteDB(user_id, url=db_url)
+    count = 0
+    for history_id, messages in json_db.historyData.items():
+        sqlite_db.add_history(history_id, messages)
+        count += len(messages)
+    for history_id in json_db.get_favorites():
+        sqlite_db.add_favorite(history_id)
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate chat history from JSON files to SQLite")
+    parser.add_argument("users", nargs="*", help="user ids to migrate, default all")
+    parser.add_argument("--db-url", default=dataModel.CHAT_DB_URL)
+    args = parser.parse_args()
+
+    for user_id in args.users or list_json_users():
+        print(f"{user_id}: {migrate_user(user_id, args.db_url)} messages migrated")
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# 后端模块按相对路径读写 userData/，并在导入时读取环境变量；
+# 测试在导入前设置好环境，每个用例切换到独立的临时数据目录
+BACKEND_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_ROOT)
+os.environ.setdefault("DASHSCOPE_API_KEY", "test")
+os.environ.setdefault("WB_TTS_POOL_SIZE", "0")
+
+
+@pytest.fixture(autouse=True)
+def data_root(tmp_path, monkeypatch):
+    for name in ("chat", "blob", "search"):
+        os.makedirs(tmp_path / "userData" / name)
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    # 存储缓存是进程级的：在切回原目录前写回并清空，未保存的修改不会落到仓库的 userData/
+    import dataModel
+    dataModel.chat_store_cache.clear()
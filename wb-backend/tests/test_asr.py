@@ -0,0 +1,67 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import wb_asr
+
+
+class FakeRecognition:
+    """记录 start/stop 调用的识别器；收到 b"boom" 时模拟上游连接已断开"""
+
+    instances = []
+
+    def __init__(self, **kwargs):
+        self.started = self.stopped = 0
+        FakeRecognition.instances.append(self)
+
+    def start(self):
+        self.started += 1
+
+    def send_audio_frame(self, frame: bytes):
+        if frame == b"boom":
+            raise RuntimeError("upstream closed")
+
+    def stop(self):
+        self.stopped += 1
+
+
+@pytest.fixture
+def client(monkeypatch):
+    FakeRecognition.instances = []
+    monkeypatch.setattr(wb_asr, "Recognition", FakeRecognition)
+    monkeypatch.setattr(wb_asr, "asr_pool", wb_asr.RecognizerPool())
+    with TestClient(main.app) as client:
+        yield client
+
+
+def test_stop_frame_returns_final(client):
+    with client.websocket_connect("/ws/asr/") as ws:
+        ws.send_json({"format": "pcm", "sample_rate": 16000})
+        ws.send_bytes(b"\0\0" * 160)
+        # 非 JSON 与非对象的文本帧被忽略
+        ws.send_text("not json")
+        ws.send_text("[1, 2]")
+        ws.send_json({"type": "stop"})
+        assert ws.receive_json() == {"type": "final", "text": "", "error": None}
+    recognition, = FakeRecognition.instances
+    assert (recognition.started, recognition.stopped) == (1, 1)
+    assert wb_asr.asr_pool.stats() == {"active": 0, "idle": 1}
+
+
+def test_send_failure_stops_recognition(client):
+    with client.websocket_connect("/ws/asr/") as ws:
+        ws.send_json({"format": "pcm"})
+        ws.send_bytes(b"boom")
+        assert ws.receive_json()["type"] == "error"
+    recognition, = FakeRecognition.instances
+    assert recognition.stopped == 1
+    # 出错的识别器不放回池中
+    assert wb_asr.asr_pool.stats() == {"active": 0, "idle": 0}
+
+
+@pytest.mark.parametrize("config", ['"pcm"', "not json", '{"sample_rate": "fast"}'])
+def test_invalid_config(client, config):
+    with client.websocket_connect("/ws/asr/") as ws:
+        ws.send_text(config)
+        assert ws.receive_json()["type"] == "error"
+    assert FakeRecognition.instances == []
@@ -0,0 +1,72 @@
+import math
+import wave
+import struct
+import asyncio
+
+import pytest
+
+import wb_audio
+
+
+def write_wav(path, sample_rate: int, channels: int, seconds: float):
+    frames = int(sample_rate * seconds)
+    samples = (int(8000 * math.sin(2 * math.pi * 440 * i / sample_rate)) for i in range(frames))
+    data = b"".join(struct.pack("<h", s) * channels for s in samples)
+    with wave.open(str(path), "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(data)
+    return data
+
+
+def test_probe_reads_wav_header_without_decoding(tmp_path, monkeypatch):
+    path = tmp_path / "a.wav"
+    write_wav(path, 44100, 2, 0.5)
+    monkeypatch.setattr(wb_audio, "_decode", lambda audio_file: pytest.fail("WAV should not be decoded"))
+
+    info = wb_audio.probe_audio(str(path))
+    assert (info.duration, info.channels, info.sample_rate) == (0.5, 2, 44100)
+
+
+def test_load_audio_returns_mono_16k_pcm(tmp_path):
+    ready = tmp_path / "ready.wav"
+    data = write_wav(ready, 16000, 1, 0.25)
+    info, pcm = wb_audio.load_audio(str(ready))
+    assert info.is_asr_ready and pcm == data
+
+    stereo = tmp_path / "stereo.wav"
+    write_wav(stereo, 44100, 2, 0.5)
+    info, pcm = wb_audio.load_audio(str(stereo))
+    assert (info.channels, info.sample_rate) == (2, 44100)
+    assert len(pcm) == pytest.approx(0.5 * wb_audio.ASR_SAMPLE_RATE * wb_audio.ASR_SAMPLE_WIDTH, abs=8)
+
+    with pytest.raises(ValueError):
+        wb_audio.load_audio(str(stereo), max_duration=0.1)
+
+
+def test_other_formats_are_decoded_once(tmp_path, monkeypatch):
+    import pydub
+    path = tmp_path / "a.mp3"
+    path.write_bytes(b"not a wav file")
+    decoded = []
+
+    def decode(audio_file):
+        decoded.append(audio_file)
+        return pydub.AudioSegment.silent(duration=300, frame_rate=48000).set_channels(2)
+
+    monkeypatch.setattr(wb_audio, "_decode", decode)
+    info, pcm = wb_audio.load_audio(str(path))
+    assert decoded == [str(path)]
+    assert (info.channels, info.sample_rate) == (2, 48000)
+    assert len(pcm) == int(0.3 * wb_audio.ASR_SAMPLE_RATE) * wb_audio.ASR_SAMPLE_WIDTH
+
+
+def test_load_audio_in_process_pool(tmp_path):
+    path = tmp_path / "a.wav"
+    write_wav(path, 22050, 1, 0.2)
+    try:
+        info, pcm = asyncio.run(wb_audio.aload_audio(str(path)))
+    finally:
+        wb_audio.shutdown_executor()
+    assert info.sample_rate == 22050 and len(pcm) > 0
@@ -0,0 +1,86 @@
+import asyncio
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+
+import main
+import ChatLLM
+import dataModel
+
+REPLY = ["你好，", "旅行者。", "今天天气不错。"]
+
+
+class FakeCompletion:
+    """按 OpenAI 流式 chunk 的结构逐个返回 REPLY"""
+
+    def __init__(self):
+        self.closed = False
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        for text in REPLY:
+            await asyncio.sleep(0)
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeLLM:
+    async def astream(self, messages, system_prompt=None):
+        return FakeCompletion()
+
+
+class FailingTTS:
+    """合成过程中出错的语音流：finish() 抛出异常"""
+
+    def __init__(self, format=None, user_id=""):
+        self.format = format
+        self._done = asyncio.Event()
+
+    def feed(self, text: str):
+        pass
+
+    async def chunks(self):
+        await self._done.wait()
+        return
+        yield
+
+    async def finish(self) -> bytes:
+        self._done.set()
+        raise RuntimeError("Speech synthesis failed: boom")
+
+    async def cancel(self) -> bytes:
+        self._done.set()
+        return b""
+
+    def to_data_uri(self, audio: bytes) -> str:
+        raise AssertionError("no audio expected")
+
+
+def test_tts_failure_still_saves_text_reply(monkeypatch):
+    monkeypatch.setattr(ChatLLM, "get_llm_client", lambda model: FakeLLM())
+    monkeypatch.setattr(ChatLLM, "StreamingTextToSpeech", FailingTTS)
+
+    with TestClient(main.app) as client:
+        with client.websocket_connect("/ws/chat/session/") as ws:
+            ws.send_json({"user_id": "tts-fail", "history_id": "1700000000000", "audio_stream": False})
+            assert ws.receive_json()["type"] == "session"
+            ws.send_json({"type": "message",
+                          "message": {"text": "你好", "isUser": True, "timestamp": "1700000000000"}})
+            frames = []
+            while not frames or frames[-1]["type"] not in ("done", "error"):
+                frames.append(ws.receive_json())
+            ws.send_json({"type": "close"})
+
+        types = [frame["type"] for frame in frames]
+        assert types[0] == "start" and types[-1] == "done"
+        assert "audio" not in types and "error" not in types
+        assert frames[-1]["stopped"] is False
+
+        history = dataModel.open_chat_db("tts-fail").get_history_data("1700000000000")
+        assert [msg["isUser"] for msg in history] == [True, False]
+        assert history[1]["text"] == "".join(REPLY)
+        assert history[1].get("audio_base64") is None and history[1].get("audio_ref") is None
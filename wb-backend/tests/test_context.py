@@ -0,0 +1,114 @@
+import time
+import asyncio
+import threading
+
+import ChatLLM
+import wb_admission
+import wb_context
+from wb_context import ContextWindow, SummaryCache, IMAGE_PLACEHOLDER
+
+IMAGE_REF = "a" * 64 + ".png"
+AUDIO_REF = "b" * 64 + ".wav"
+
+
+def image_turns(count: int) -> list:
+    """用户发图片、助手回复文本加语音，交替 count 轮"""
+    history = []
+    for i in range(count):
+        history.append({"text": f"看第{i}张图", "isUser": True, "timestamp": str(2 * i), "image_ref": IMAGE_REF})
+        history.append({"text": f"第{i}张图里是猫", "isUser": False, "timestamp": str(2 * i + 1),
+                        "audio_ref": AUDIO_REF, "audio_format": "mp3"})
+    return history
+
+
+def test_bot_audio_with_text_does_not_use_media_budget():
+    window = ContextWindow(max_tokens=100000, media_turns=2)
+    kept, summary = window.build(image_turns(5))
+
+    assert summary is None and len(kept) == 10
+    user_images = [bool(msg.get("image_ref")) for msg in kept if msg["isUser"]]
+    # 最近两张图片保留原图，更早的换成占位文字
+    assert user_images == [False, False, False, True, True]
+    assert all(msg["text"].endswith(IMAGE_PLACEHOLDER) for msg in kept[:6] if msg["isUser"])
+    # 有文本的回复不会发送语音，引用被去掉
+    assert not any(msg.get("audio_ref") for msg in kept)
+
+
+def test_audio_only_message_counts_as_media():
+    history = image_turns(2) + [{"text": "", "isUser": True, "timestamp": "9", "audio_ref": AUDIO_REF}]
+    kept, _ = ContextWindow(max_tokens=100000, media_turns=2).build(history)
+
+    assert kept[-1]["audio_ref"] == AUDIO_REF
+    assert [bool(msg.get("image_ref")) for msg in kept if msg["isUser"]] == [False, True, False]
+
+
+def test_summary_jobs_run_on_bounded_workers():
+    cache = SummaryCache(workers=2, max_pending=4)
+    release = threading.Event()
+    running, peak, threads = [0], [0], set()
+    lock = threading.Lock()
+
+    def job():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            threads.add(threading.get_ident())
+        release.wait(5)
+        with lock:
+            running[0] -= 1
+        return "摘要"
+
+    for i in range(10):
+        cache.schedule(f"key{i}", job)
+    # 超出排队上限的前缀本轮跳过
+    assert len(cache._pending) == 4
+    time.sleep(0.1)
+    release.set()
+    deadline = time.time() + 5
+    while cache._pending and time.time() < deadline:
+        time.sleep(0.01)
+    cache.shutdown()
+
+    assert peak[0] == 2 and len(threads) == 2
+    assert [cache.get(f"key{i}") for i in range(5)] == ["摘要"] * 4 + [None]
+
+
+def test_summarize_context_takes_admission_slot(monkeypatch):
+    controller = wb_admission.AdmissionController(default_limit=1)
+    monkeypatch.setattr(wb_admission, "admission", controller)
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    controller.bind_loop(loop)
+
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    class FakeClient:
+        def generate(self, messages, system_prompt=None):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return "摘要"
+
+    monkeypatch.setattr(ChatLLM, "get_llm_client", lambda model: FakeClient())
+    try:
+        cache = SummaryCache(workers=4)
+        for i in range(4):
+            cache.schedule(f"key{i}", lambda: ChatLLM.summarize_context("", "用户: 你好"))
+        deadline = time.time() + 5
+        while cache._pending and time.time() < deadline:
+            time.sleep(0.01)
+        cache.shutdown()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join(5)
+        loop.close()
+
+    # 摘要模型的并发上限为 1：4 个摘要线程依次获得名额
+    assert peak[0] == 1
+    assert all(cache.get(f"key{i}") == "摘要" for i in range(4))
+    assert controller.stats()[wb_context.CONTEXT_SUMMARY_MODEL]["active"] == 0
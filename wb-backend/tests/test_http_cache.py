@@ -0,0 +1,39 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import main
+import dataModel
+
+
+def test_history_list_built_off_loop_and_cached(monkeypatch):
+    store = dataModel.open_chat_db("cache-user")
+    for i in range(40):
+        store.add_history(str(1700000000000 + i), [{"text": "稻妻" * 50, "isUser": True, "timestamp": str(i)}])
+
+    on_loop = []
+    get_history_list = store.get_history_list
+
+    def recording_list(*args, **kwargs):
+        try:
+            asyncio.get_running_loop()
+            on_loop.append(True)
+        except RuntimeError:
+            on_loop.append(False)
+        return get_history_list(*args, **kwargs)
+
+    monkeypatch.setattr(store, "get_history_list", recording_list)
+    with TestClient(main.app) as client:
+        response = client.get("/api/chat_history_list/cache-user", headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200 and response.headers["content-encoding"] == "gzip"
+        assert len(response.json()) == 40
+        etag = response.headers["etag"]
+
+        # 同一版本直接使用缓存，未变化时返回 304
+        again = client.get("/api/chat_history_list/cache-user", headers={"Accept-Encoding": "gzip"})
+        assert again.content == response.content
+        unchanged = client.get("/api/chat_history_list/cache-user", headers={"If-None-Match": etag})
+        assert unchanged.status_code == 304
+
+    # 只在缓存未命中时生成一次，且不在事件循环线程中
+    assert on_loop == [False]
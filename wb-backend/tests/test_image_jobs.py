@@ -0,0 +1,89 @@
+import asyncio
+import subprocess
+import sys
+
+import httpx
+import pytest
+
+import wb_image_jobs
+from wb_image_jobs import ImageJobManager
+
+
+def make_manager() -> ImageJobManager:
+    # 不启动后台 worker，任务只进入队列
+    manager = ImageJobManager()
+    manager._queue = asyncio.Queue()
+    return manager
+
+
+def test_job_visible_to_other_worker():
+    async def run():
+        owner, other = make_manager(), make_manager()
+        job = owner.submit("alice", "一只猫")
+
+        seen = other.get(job.job_id)
+        assert seen is not None and seen.status == wb_image_jobs.JOB_QUEUED
+
+        waiter = asyncio.create_task(other.wait_for_change(seen, wb_image_jobs.JOB_QUEUED, timeout=5))
+        await asyncio.sleep(0.1)
+        job.image_type = "image/png"
+        await owner._set_status(job, wb_image_jobs.JOB_DONE)
+        changed = await waiter
+        assert changed.status == wb_image_jobs.JOB_DONE and changed.image_type == "image/png"
+
+    asyncio.run(run())
+
+
+def test_unfinished_job_of_exited_worker_is_failed():
+    async def run():
+        owner = make_manager()
+        job = owner.submit("alice", "一只狗")
+        # 换成一个已退出进程的 pid
+        exited = subprocess.Popen([sys.executable, "-c", "pass"])
+        exited.wait()
+        job.owner_pid = exited.pid
+        owner._save(job)
+
+        seen = make_manager().get(job.job_id)
+        assert seen.status == wb_image_jobs.JOB_FAILED and seen.error
+
+    asyncio.run(run())
+
+
+def test_unknown_or_invalid_job_id():
+    manager = make_manager()
+    assert manager.get("0" * 32) is None
+    assert manager.get("../../chat/alice") is None
+
+
+@pytest.mark.parametrize("content_type, ext", [("image/jpeg", ".jpg"), ("image/webp; q=1", ".webp"), ("image/png", ".png")])
+def test_download_uses_extension_of_content_type(content_type, ext):
+    async def run():
+        manager = make_manager()
+        manager._http = httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, headers={"content-type": content_type}, content=b"image-bytes")))
+        job = manager.submit("alice", "一只鸟")
+        await manager._download("https://example.invalid/result", job)
+        await manager._http.aclose()
+        return job
+
+    job = asyncio.run(run())
+    assert job.image_type == content_type.split(";")[0]
+    assert job.image_path.endswith(ext)
+    with open(job.image_path, "rb") as f:
+        assert f.read() == b"image-bytes"
+
+
+def test_download_rejects_non_image_response():
+    async def run():
+        manager = make_manager()
+        manager._http = httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, headers={"content-type": "text/html"}, content=b"<html>")))
+        job = manager.submit("alice", "一只鱼")
+        try:
+            await manager._download("https://example.invalid/result", job)
+        finally:
+            await manager._http.aclose()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
@@ -0,0 +1,108 @@
+import os
+import time
+import socket
+import asyncio
+import threading
+import importlib.util
+
+import pytest
+import uvicorn
+
+import ChatLLM
+from conftest import BACKEND_ROOT
+
+STREAMS = 8
+FIRST_TOKEN_MS = 300
+REPLY_TOKENS = 20
+TOKEN_RATE = 100
+
+
+def load_fake_upstream():
+    spec = importlib.util.spec_from_file_location("fake_upstream", os.path.join(BACKEND_ROOT, "bench", "fake_upstream.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="module")
+def upstream_url():
+    """在后台线程中启动 bench/fake_upstream.py，返回 OpenAI 兼容接口的 base_url"""
+    fake = load_fake_upstream()
+    fake.settings.update(first_token_ms=FIRST_TOKEN_MS, reply_tokens=REPLY_TOKENS, token_rate=TOKEN_RATE)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(fake.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.time() + 10
+    while not server.started:
+        assert time.time() < deadline, "fake upstream did not start"
+        time.sleep(0.05)
+    yield f"http://127.0.0.1:{port}/compatible-mode/v1"
+    server.should_exit = True
+    thread.join(5)
+
+
+def make_history(turns: int) -> list:
+    return [{"text": f"第{i}条消息：" + "稻妻" * 50, "isUser": i % 2 == 0, "timestamp": str(i)} for i in range(turns)]
+
+
+async def run_stream(client: ChatLLM.LLMTextClient, history: list) -> tuple[float, float, float, str]:
+    """返回开始时间、首个 token 到达时间、结束时间与回复文本"""
+    start = time.perf_counter()
+    first_token = None
+    completion = await client.astream(history, system_prompt="测试")
+    text = ""
+    async for chunk in completion:
+        if chunk.choices and chunk.choices[0].delta.content:
+            first_token = first_token or time.perf_counter()
+            text += chunk.choices[0].delta.content
+    return start, first_token, time.perf_counter(), text
+
+
+async def run_concurrent(client: ChatLLM.LLMTextClient) -> tuple[list, int]:
+    loop_thread = threading.get_ident()
+    return await asyncio.gather(*(run_stream(client, make_history(200)) for _ in range(STREAMS))), loop_thread
+
+
+def test_concurrent_streams_overlap(upstream_url, monkeypatch):
+    # 每个测试用自己的事件循环，客户端不与其它用例共享
+    client = ChatLLM.LLMTextClient(model="qwen-omni-turbo", base_url=upstream_url)
+    format_threads = []
+    format_messages = client._format_messages
+
+    def recording_format(*args, **kwargs):
+        format_threads.append(threading.get_ident())
+        return format_messages(*args, **kwargs)
+
+    monkeypatch.setattr(client, "_format_messages", recording_format)
+    single = FIRST_TOKEN_MS / 1000 + REPLY_TOKENS / TOKEN_RATE
+    wall_start = time.perf_counter()
+    results, loop_thread = asyncio.run(run_concurrent(client))
+    wall = time.perf_counter() - wall_start
+
+    assert all(len(text) == REPLY_TOKENS * 2 for _, _, _, text in results)
+    # 所有流同时进行：最晚开始的流早于最早结束的流，总耗时远小于串行执行
+    assert max(start for start, _, _, _ in results) < min(end for _, _, end, _ in results)
+    assert wall < single * STREAMS / 2
+    # 整理消息（读取 blob、生成图片变体）不在事件循环线程中执行
+    assert len(format_threads) == STREAMS and loop_thread not in format_threads
+
+
+def test_time_to_first_token_stays_flat(upstream_url):
+    client = ChatLLM.LLMTextClient(model="qwen-omni-turbo", base_url=upstream_url)
+
+    async def ttft(sessions: int) -> list[float]:
+        results = await asyncio.gather(*(run_stream(client, make_history(20)) for _ in range(sessions)))
+        return [first - start for start, first, _, _ in results]
+
+    async def run():
+        # 先建立连接，单会话与并发会话的测量都不包含连接建立
+        await ttft(1)
+        return await ttft(1), await ttft(STREAMS)
+
+    single, concurrent = asyncio.run(run())
+    # 每个并发会话的首 token 时间与单会话相比只多出少量调度开销；
+    # 若会话之间互相阻塞，最后一个会话要等待约 STREAMS 倍的首 token 延迟
+    assert max(concurrent) < single[0] + FIRST_TOKEN_MS / 1000
@@ -0,0 +1,51 @@
+import sqlite3
+import threading
+
+import dataModel
+from wb_search import SearchIndex
+
+
+def make_user(user_id: str) -> dataModel.ChatHistoryStore:
+    store = dataModel.open_chat_db(user_id)
+    store.add_history("1700000000000", [{"text": f"{user_id} 提到了稻妻的雷电将军", "isUser": True,
+                                         "timestamp": "1700000000000"}])
+    return store
+
+
+def test_evicted_index_stays_open_while_in_use(tmp_path):
+    index = SearchIndex(root=str(tmp_path), max_open=1)
+    store = make_user("alice")
+    with index.use("alice") as alice:
+        # 另一个用户的请求把 alice 挤出 LRU，但连接仍在使用
+        index.search("bob", "雷电", make_user("bob"))
+        alice.rebuild(store)
+        assert [hit["id"] for hit in alice.search("雷电", 5)] == ["1700000000000"]
+    # 最后一个使用者归还后才关闭
+    try:
+        alice.conn.execute("SELECT 1")
+        assert False, "evicted index should be closed after release"
+    except sqlite3.ProgrammingError:
+        pass
+
+
+def test_concurrent_users_with_small_cache(tmp_path):
+    index = SearchIndex(root=str(tmp_path), max_open=2)
+    users = [f"user{i}" for i in range(6)]
+    stores = {user: make_user(user) for user in users}
+    errors = []
+
+    def worker(user: str):
+        try:
+            for i in range(30):
+                index.update_message(user, "1700000000000", i + 1, {"text": f"第{i}条 雷电", "isUser": False})
+                assert index.search(user, "雷电", stores[user])
+        except Exception as e:
+            errors.append(repr(e))
+
+    threads = [threading.Thread(target=worker, args=(user,)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    index.close_all()
+    assert errors == []
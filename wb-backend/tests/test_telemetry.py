@@ -0,0 +1,15 @@
+import pytest
+
+import wb_telemetry
+
+
+def test_incomplete_metric_fails_on_instantiation():
+    class NoSamples(wb_telemetry._Metric):
+        metric_type = "counter"
+
+        def _new_child(self):
+            return wb_telemetry._CounterChild()
+
+    with pytest.raises(TypeError):
+        NoSamples("wb_test_incomplete", "incomplete metric")
+    assert "wb_test_incomplete" not in wb_telemetry.registry.render()
@@ -0,0 +1,46 @@
+import pytest
+
+import ChatLLM
+
+
+class FakeSynthesizer:
+    def __init__(self, result):
+        self.result = result
+
+    def call(self, text: str):
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """记录借出与归还的合成器"""
+    state = {"borrowed": [], "returned": [], "result": None}
+
+    def borrow(model, voice, format, callback=None):
+        synthesizer = FakeSynthesizer(state["result"])
+        state["borrowed"].append(synthesizer)
+        return synthesizer
+
+    monkeypatch.setattr(ChatLLM, "borrow_synthesizer", borrow)
+    monkeypatch.setattr(ChatLLM, "return_synthesizer", state["returned"].append)
+    monkeypatch.setattr(ChatLLM.tts_cache, "get", lambda key: None)
+    monkeypatch.setattr(ChatLLM.tts_cache, "put", lambda key, audio: None)
+    return state
+
+
+@pytest.mark.parametrize("result", [ConnectionError("upstream closed"), None])
+def test_failed_synthesis_returns_synthesizer(pool, result):
+    pool["result"] = result
+    client = ChatLLM.TextToSpeechClient()
+    with pytest.raises((ConnectionError, RuntimeError)):
+        client.text_to_speech("你好")
+    assert pool["returned"] == pool["borrowed"] and len(pool["borrowed"]) == 1
+
+
+def test_text_to_speech_data_uri(pool):
+    pool["result"] = b"ID3audio"
+    uri = ChatLLM.TextToSpeechClient().text_to_speech("你好")
+    assert uri == "data:audio/mpeg;base64,SUQzYXVkaW8="
+    assert pool["returned"] == pool["borrowed"]
@@ -0,0 +1,261 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+import wb_telemetry
+
+# 上游模型调用的准入控制：按模型限制同时进行的调用数，并限制单个用户占用的并发，
+# 超出时进入公平队列（各用户轮流获得名额，单个用户的突发请求不会挤占其他用户）。
+# 限额按 worker 进程计算，多进程部署时总并发为 限额 × 进程数。
+
+# 每个模型的默认并发上限，以及按模型覆盖的配置，如 "qwen-omni-turbo=16,cosyvoice-v2=8"
+UPSTREAM_CONCURRENCY = int(os.getenv("WB_UPSTREAM_CONCURRENCY", "16"))
+UPSTREAM_MODEL_CONCURRENCY = os.getenv("WB_UPSTREAM_MODEL_CONCURRENCY", "")
+# 单个用户在同一模型上的并发上限
+UPSTREAM_USER_CONCURRENCY = int(os.getenv("WB_UPSTREAM_USER_CONCURRENCY", "2"))
+# 每个模型的排队上限，超过时直接拒绝，避免请求无限堆积
+UPSTREAM_MAX_QUEUE = int(os.getenv("WB_UPSTREAM_MAX_QUEUE", "256"))
+# 上游返回 429 时的重试次数与退避时间（秒）
+UPSTREAM_RETRY_ATTEMPTS = int(os.getenv("WB_UPSTREAM_RETRY_ATTEMPTS", "3"))
+UPSTREAM_RETRY_BASE_DELAY = float(os.getenv("WB_UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+UPSTREAM_RETRY_MAX_DELAY = float(os.getenv("WB_UPSTREAM_RETRY_MAX_DELAY", "8"))
+
+
+def parse_model_limits(config: str) -> dict[str, int]:
+    limits = {}
+    for item in config.split(","):
+        model, _, limit = item.partition("=")
+        if model.strip() and limit.strip():
+            limits[model.strip()] = int(limit)
+    return limits
+
+
+class AdmissionRejected(Exception):
+    """排队人数已满"""
+
+
+class RateLimited(Exception):
+    """上游返回 429，用于不抛出异常、只返回状态码的 SDK 调用"""
+
+
+class _Waiter:
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.granted = False
+        self.changed = asyncio.Event()
+
+
+class FairLimiter:
+    """
+    单个模型的并发限制与公平队列。
+    每个用户一个 FIFO 队列，有空闲名额时按用户轮询放行，并跳过已达到单用户上限的用户。
+    """
+
+    def __init__(self, model: str, limit: int, per_user_limit: int = UPSTREAM_USER_CONCURRENCY,
+                 max_queue: int = UPSTREAM_MAX_QUEUE):
+        self.model = model
+        self.limit = limit
+        self.per_user_limit = per_user_limit
+        self.max_queue = max_queue
+        self.active = 0
+        self._active_by_user: dict[str, int] = {}
+        # 轮询顺序：本轮已放行的用户移到末尾
+        self._queues: OrderedDict[str, deque] = OrderedDict()
+        self._waiting = 0
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    def _can_run(self, user_id: str) -> bool:
+        return self._active_by_user.get(user_id, 0) < self.per_user_limit
+
+    def _grant(self, waiter: _Waiter):
+        waiter.granted = True
+        waiter.changed.set()
+        self.active += 1
+        self._active_by_user[waiter.user_id] = self._active_by_user.get(waiter.user_id, 0) + 1
+
+    def _dispatch(self):
+        while self.active < self.limit:
+            user_id = next((u for u in self._queues if self._can_run(u)), None)
+            if user_id is None:
+                break
+            queue = self._queues.pop(user_id)
+            self._waiting -= 1
+            self._grant(queue.popleft())
+            if queue:
+                self._queues[user_id] = queue
+        for queue in self._queues.values():
+            for waiter in queue:
+                waiter.changed.set()
+        self._update_metrics()
+
+    def _remove(self, waiter: _Waiter):
+        queue = self._queues.get(waiter.user_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self._waiting -= 1
+            if not queue:
+                del self._queues[waiter.user_id]
+
+    def position(self, waiter: _Waiter) -> int:
+        """按轮询顺序估算的排队位置，1 表示下一个"""
+        queue = self._queues.get(waiter.user_id)
+        if queue is None or waiter not in queue:
+            return 0
+        rank = queue.index(waiter)
+        ahead = rank
+        before = True
+        for user_id, other in self._queues.items():
+            if user_id == waiter.user_id:
+                before = False
+                continue
+            ahead += min(len(other), rank + 1 if before else rank)
+        return ahead + 1
+
+    async def acquire(self, user_id: str, on_queued=None):
+        """
+        获取一个名额，需要排队时每当位置变化就 await on_queued(position)。
+        排队人数已满时抛出 AdmissionRejected。
+        """
+        waiter = _Waiter(user_id)
+        if self.active < self.limit and self._can_run(user_id) and not self._queues.get(user_id):
+            self._grant(waiter)
+            self._update_metrics()
+            wb_telemetry.UPSTREAM_WAIT_SECONDS.labels(model=self.model).observe(0.0)
+            return
+        if self._waiting >= self.max_queue:
+            wb_telemetry.UPSTREAM_REJECTED.labels(model=self.model).inc()
+            raise AdmissionRejected(f"Too many requests queued for {self.model}")
+
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self._waiting += 1
+        self._update_metrics()
+        start = time.perf_counter()
+        last_position = None
+        try:
+            while not waiter.granted:
+                waiter.changed.clear()
+                position = self.position(waiter)
+                if on_queued is not None and position != last_position:
+                    last_position = position
+                    await on_queued(position)
+                if not waiter.granted:
+                    await waiter.changed.wait()
+        except BaseException:
+            # 排队期间被取消（如客户端断开）：已放行则归还名额，否则移出队列
+            if waiter.granted:
+                self.release(user_id)
+            else:
+                self._remove(waiter)
+                self._update_metrics()
+            raise
+        wb_telemetry.UPSTREAM_WAIT_SECONDS.labels(model=self.model).observe(time.perf_counter() - start)
+
+    def release(self, user_id: str):
+        self.active -= 1
+        remaining = self._active_by_user.get(user_id, 1) - 1
+        if remaining > 0:
+            self._active_by_user[user_id] = remaining
+        else:
+            self._active_by_user.pop(user_id, None)
+        self._dispatch()
+
+    def _update_metrics(self):
+        wb_telemetry.UPSTREAM_QUEUE_DEPTH.labels(model=self.model).set(self._waiting)
+        wb_telemetry.UPSTREAM_ACTIVE.labels(model=self.model).set(self.active)
+
+
+class AdmissionController:
+    """按模型名分配 FairLimiter，所有上游调用（对话、语音合成、图像生成）共用"""
+
+    def __init__(self, default_limit: int = UPSTREAM_CONCURRENCY,
+                 model_limits: dict[str, int] | None = None):
+        self.default_limit = default_limit
+        self.model_limits = parse_model_limits(UPSTREAM_MODEL_CONCURRENCY) if model_limits is None else model_limits
+        self._limiters: dict[str, FairLimiter] = {}
+        # 名额只在事件循环中分配；线程中的同步调用通过 blocking_slot 提交到该循环排队
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop | None):
+        self._loop = loop
+
+    def limiter(self, model: str) -> FairLimiter:
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            limiter = self._limiters[model] = FairLimiter(model, self.model_limits.get(model, self.default_limit))
+        return limiter
+
+    async def acquire(self, model: str, user_id: str, on_queued=None):
+        await self.limiter(model).acquire(user_id, on_queued)
+
+    def release(self, model: str, user_id: str):
+        self.limiter(model).release(user_id)
+
+    @asynccontextmanager
+    async def slot(self, model: str, user_id: str, on_queued=None):
+        await self.acquire(model, user_id, on_queued)
+        try:
+            yield
+        finally:
+            self.release(model, user_id)
+
+    @contextmanager
+    def blocking_slot(self, model: str, user_id: str):
+        """
+        slot 的同步版本，供线程池中的上游调用使用，阻塞当前线程直到获得名额。
+        未绑定事件循环（如在脚本中使用）时不做限制。
+        """
+        loop = self._loop
+        if loop is None:
+            yield
+            return
+        asyncio.run_coroutine_threadsafe(self.acquire(model, user_id), loop).result()
+        try:
+            yield
+        finally:
+            loop.call_soon_threadsafe(self.release, model, user_id)
+
+    def stats(self) -> dict:
+        return {model: {"limit": limiter.limit, "active": limiter.active, "waiting": limiter.waiting}
+                for model, limiter in self._limiters.items()}
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    return isinstance(error, RateLimited) or getattr(error, "status_code", None) == 429
+
+
+def retry_delay(attempt: int, error: BaseException | None = None) -> float:
+    """指数退避加随机抖动；上游给出 Retry-After 时以其为准"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        if retry_after is not None:
+            return min(float(retry_after), UPSTREAM_RETRY_MAX_DELAY)
+    except ValueError:
+        pass
+    delay = min(UPSTREAM_RETRY_BASE_DELAY * (2 ** attempt), UPSTREAM_RETRY_MAX_DELAY)
+    return delay * random.uniform(0.5, 1.0)
+
+
+async def retry_rate_limited(call, model: str, attempts: int = UPSTREAM_RETRY_ATTEMPTS):
+    """执行 await call()，遇到 429 时退避后重试，最多重试 attempts 次"""
+    for attempt in range(attempts + 1):
+        try:
+            return await call()
+        except Exception as e:
+            if not is_rate_limited(e) or attempt >= attempts:
+                raise
+            delay = retry_delay(attempt, e)
+            wb_telemetry.UPSTREAM_RETRIES.labels(model=model).inc()
+            wb_telemetry.log_event("upstream_rate_limited", logging.WARNING, model=model,
+                                   attempt=attempt + 1, delay=round(delay, 2))
+            await asyncio.sleep(delay)
+
+
+admission = AdmissionController()
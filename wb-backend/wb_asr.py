@@ -0,0 +1,144 @@
+import os
+import asyncio
+import threading
+from collections import deque
+
+from dashscope.audio.asr import Recognition, RecognitionCallback, RecognitionResult
+from dashscope.common.error import InvalidParameter
+
+# 实时语音识别：客户端边说边通过 /ws/asr/ 推送音频帧，
+# paraformer-realtime-v2 以回调方式返回中间结果，说完后立即得到整段文本
+
+ASR_MODEL = "paraformer-realtime-v2"
+ASR_FORMATS = ("pcm", "wav", "opus")
+ASR_SAMPLE_RATE = 16000
+# 每个 worker 进程保留的空闲识别器数量，以及同时进行的识别会话上限
+ASR_POOL_SIZE = int(os.getenv("WB_ASR_POOL_SIZE", "4"))
+ASR_MAX_SESSIONS = int(os.getenv("WB_ASR_MAX_SESSIONS", "32"))
+
+
+class RecognizerSession(RecognitionCallback):
+    """
+    对 Recognition 的一次 start/stop 封装，可在连接池中反复使用。
+    回调在 dashscope 的接收线程中触发，结果通过事件循环的队列交给 websocket 协程。
+    """
+
+    _DONE = object()
+
+    def __init__(self, format: str = "pcm", sample_rate: int = ASR_SAMPLE_RATE):
+        self.format = format
+        self.sample_rate = sample_rate
+        self.recognition = Recognition(model=ASR_MODEL,
+                                       format=format,
+                                       sample_rate=sample_rate,
+                                       # “language_hints”只支持paraformer-v2和paraformer-realtime-v2模型
+                                       language_hints=['zh', 'en'],
+                                       callback=self)
+        self._reset(None)
+
+    def _reset(self, loop: asyncio.AbstractEventLoop | None):
+        self._loop = loop
+        self._events: asyncio.Queue | None = asyncio.Queue() if loop else None
+        self.sentences: list[str] = []
+        self.partial = ""
+        self.error = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self.sentences) + self.partial
+
+    def _post(self, event):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+
+    # RecognitionCallback
+    def on_event(self, result: RecognitionResult) -> None:
+        sentence = result.get_sentence()
+        if not isinstance(sentence, dict) or "text" not in sentence:
+            return
+        if RecognitionResult.is_sentence_end(sentence):
+            self.sentences.append(sentence["text"])
+            self.partial = ""
+        else:
+            self.partial = sentence["text"]
+        self._post({"type": "partial", "text": self.text,
+                    "sentence_end": RecognitionResult.is_sentence_end(sentence)})
+
+    def on_error(self, result: RecognitionResult) -> None:
+        self.error = getattr(result, "message", None) or "Speech recognition failed"
+        self._post({"type": "error", "message": self.error})
+
+    def start(self):
+        self._reset(asyncio.get_running_loop())
+        self.recognition.start()
+
+    def send(self, frame: bytes):
+        # 只是放入 SDK 的发送队列，不阻塞
+        self.recognition.send_audio_frame(frame)
+
+    async def events(self):
+        while True:
+            event = await self._events.get()
+            if event is self._DONE:
+                return
+            yield event
+
+    async def stop(self) -> str:
+        """结束音频输入，等待最后的识别结果，返回完整文本"""
+        try:
+            await asyncio.to_thread(self.recognition.stop)
+        except InvalidParameter:
+            # 长时间没有音频时 SDK 已自行结束识别
+            pass
+        finally:
+            self._post(self._DONE)
+        return self.text
+
+    def detach(self):
+        self._reset(None)
+
+
+class RecognizerPool:
+    """
+    进程级识别器池，按 (format, sample_rate) 复用空闲的 RecognizerSession，
+    并限制同时进行的识别会话数。
+    """
+
+    def __init__(self, max_idle: int = ASR_POOL_SIZE, max_sessions: int = ASR_MAX_SESSIONS):
+        self.max_idle = max_idle
+        self.max_sessions = max_sessions
+        self._idle: dict[tuple, deque] = {}
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, format: str = "pcm", sample_rate: int = ASR_SAMPLE_RATE) -> RecognizerSession | None:
+        """借出一个识别器，达到会话上限时返回 None"""
+        with self._lock:
+            if self._active >= self.max_sessions:
+                return None
+            self._active += 1
+            idle = self._idle.get((format, sample_rate))
+            if idle:
+                return idle.popleft()
+        try:
+            return RecognizerSession(format, sample_rate)
+        except Exception:
+            with self._lock:
+                self._active -= 1
+            raise
+
+    def release(self, session: RecognizerSession, reusable: bool = True):
+        session.detach()
+        with self._lock:
+            self._active -= 1
+            idle = self._idle.setdefault((session.format, session.sample_rate), deque())
+            if reusable and sum(len(q) for q in self._idle.values()) < self.max_idle:
+                idle.append(session)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"active": self._active, "idle": sum(len(q) for q in self._idle.values())}
+
+
+asr_pool = RecognizerPool()
+
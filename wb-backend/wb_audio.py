@@ -1,16 +1,219 @@
-import pydub
+import os
+import io
+import mmap
+import wave
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from pydantic import BaseModel
 
+# 音频探测与规范化：每个文件只解码一次
+# WAV 直接读取文件头，不经过 ffmpeg；其它格式通过 pydub 解码一次后同时得到参数和采样数据
+# pydub 只在需要解码非 WAV 文件时才导入（Python 3.13 移除了它依赖的 audioop）
+
+ASR_SAMPLE_RATE = 16000
+ASR_SAMPLE_WIDTH = 2
+AUDIO_WORKERS = int(os.getenv("WB_AUDIO_WORKERS", "2"))
+# 压缩编码参数：(pydub 导出格式, ffmpeg 编码器, 码率)
+ENCODINGS = {
+    "mp3": ("mp3", "libmp3lame", "64k"),
+    "opus": ("ogg", "libopus", "32k"),
+}
+ENCODED_CONTENT_TYPES = {"mp3": "audio/mpeg", "opus": "audio/ogg"}
+
+
+class AudioInfo(BaseModel):
+    duration: float
+    channels: int
+    sample_rate: int
+    sample_width: int
+
+    @property
+    def is_asr_ready(self) -> bool:
+        """是否已是识别所需的 16kHz 单声道 16bit"""
+        return self.channels == 1 and self.sample_rate == ASR_SAMPLE_RATE and self.sample_width == ASR_SAMPLE_WIDTH
+
+
+def _read_wav_info(audio_file: str) -> AudioInfo | None:
+    try:
+        with wave.open(audio_file, 'rb') as wav_file:
+            frames = wav_file.getnframes()
+            sample_rate = wav_file.getframerate()
+            return AudioInfo(duration=frames / sample_rate if sample_rate else 0.0,
+                             channels=wav_file.getnchannels(),
+                             sample_rate=sample_rate,
+                             sample_width=wav_file.getsampwidth())
+    except (wave.Error, EOFError):
+        # 非 PCM 编码的 WAV 或其它格式
+        return None
+
+
+def _decode(audio_file: str):
+    import pydub
+    return pydub.AudioSegment.from_file(audio_file)
+
+
+def _segment_info(audio) -> AudioInfo:
+    return AudioInfo(duration=audio.duration_seconds, channels=audio.channels,
+                     sample_rate=audio.frame_rate, sample_width=audio.sample_width)
+
+
+def probe_audio(audio_file: str) -> AudioInfo:
+    """读取时长、声道数和采样率；WAV 只读文件头"""
+    info = _read_wav_info(audio_file)
+    if info is not None:
+        return info
+    return _segment_info(_decode(audio_file))
+
+
+def _to_asr_pcm(audio_file: str, info: AudioInfo | None, max_duration: float | None) -> tuple[AudioInfo, bytes]:
+    """解码一次并转换为 16kHz 单声道 16bit PCM；info 为 WAV 文件头信息（非 WAV 时为 None）"""
+    if info is not None:
+        # 非目标参数的 PCM WAV：直接用帧数据构造，同样不经过 ffmpeg
+        import pydub
+        with wave.open(audio_file, 'rb') as wav_file:
+            audio = pydub.AudioSegment(data=wav_file.readframes(wav_file.getnframes()),
+                                       sample_width=info.sample_width, frame_rate=info.sample_rate,
+                                       channels=info.channels)
+    else:
+        audio = _decode(audio_file)
+        info = _segment_info(audio)
+        if max_duration is not None and info.duration > max_duration:
+            raise ValueError("Audio length is too long")
+
+    # 合并所有音轨到一个
+    audio = audio.set_channels(1).set_frame_rate(ASR_SAMPLE_RATE).set_sample_width(ASR_SAMPLE_WIDTH)
+    return info, audio.raw_data
+
+
+def load_audio(audio_file: str, max_duration: float | None = None) -> tuple[AudioInfo, bytes]:
+    """
+    探测并转换为 16kHz 单声道 16bit PCM，返回原始音频的参数与内存中的 PCM 数据，可直接送入识别。
+    已符合要求的 WAV 只读取 data 块，不解码；超过 max_duration 秒时抛出 ValueError。
+    """
+    info = _read_wav_info(audio_file)
+    if info is not None and max_duration is not None and info.duration > max_duration:
+        raise ValueError("Audio length is too long")
+    if info is not None and info.is_asr_ready:
+        with wave.open(audio_file, 'rb') as wav_file:
+            return info, wav_file.readframes(wav_file.getnframes())
+    return _to_asr_pcm(audio_file, info, max_duration)
+
+
+def normalize_audio(audio_file: str, output_file: str, max_duration: float | None = None) -> AudioInfo:
+    """
+    与 load_audio 相同，但把结果写为 16kHz 单声道 16bit WAV 文件 output_file，可再用 load_pcm 映射读取。
+    已符合要求的 WAV 直接复制，不解码。output_file 可以与 audio_file 相同。
+    """
+    info = _read_wav_info(audio_file)
+    if info is not None and max_duration is not None and info.duration > max_duration:
+        raise ValueError("Audio length is too long")
+    if info is not None and info.is_asr_ready:
+        if os.path.abspath(output_file) != os.path.abspath(audio_file):
+            with open(audio_file, 'rb') as src, open(output_file + '.tmp', 'wb') as dst:
+                dst.write(src.read())
+            os.replace(output_file + '.tmp', output_file)
+        return info
+
+    info, pcm = _to_asr_pcm(audio_file, info, max_duration)
+    with wave.open(output_file + '.tmp', 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(ASR_SAMPLE_WIDTH)
+        wav_file.setframerate(ASR_SAMPLE_RATE)
+        wav_file.writeframes(pcm)
+    os.replace(output_file + '.tmp', output_file)
+    return info
+
+
+def load_pcm(wav_file: str) -> memoryview:
+    """
+    以内存映射方式返回规范化 WAV 的 PCM 数据，不复制到内存，可直接分块送入识别。
+    返回的 memoryview 释放后映射随之关闭。
+    """
+    with open(wav_file, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # 找到 data 块的位置（跳过 RIFF 头与其它块）
+    offset = 12
+    while offset + 8 <= len(mapped):
+        chunk_id = mapped[offset:offset + 4]
+        chunk_size = int.from_bytes(mapped[offset + 4:offset + 8], 'little')
+        if chunk_id == b'data':
+            return memoryview(mapped)[offset + 8:offset + 8 + chunk_size]
+        offset += 8 + chunk_size + (chunk_size & 1)
+    mapped.close()
+    raise ValueError(f"No data chunk in {wav_file}")
+
+
+def to_wav_bytes(pcm: bytes, sample_rate: int = ASR_SAMPLE_RATE) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(ASR_SAMPLE_WIDTH)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm)
+    return buffer.getvalue()
+
+
+def encode_audio(wav: bytes, audio_format: str) -> bytes:
+    """把 WAV 数据重新编码为 mp3 / opus（Ogg 容器），需要 ffmpeg"""
+    import pydub
+    export_format, codec, bitrate = ENCODINGS[audio_format]
+    with wave.open(io.BytesIO(wav), 'rb') as wav_file:
+        audio = pydub.AudioSegment(data=wav_file.readframes(wav_file.getnframes()),
+                                   sample_width=wav_file.getsampwidth(),
+                                   frame_rate=wav_file.getframerate(),
+                                   channels=wav_file.getnchannels())
+    buffer = io.BytesIO()
+    audio.export(buffer, format=export_format, codec=codec, bitrate=bitrate)
+    return buffer.getvalue()
+
+
+# 解码依赖 ffmpeg 子进程且是 CPU 密集的，放到进程池中执行，不阻塞事件循环
+_executor: ProcessPoolExecutor | None = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=AUDIO_WORKERS)
+    return _executor
+
+
+async def aprobe_audio(audio_file: str) -> AudioInfo:
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), probe_audio, audio_file)
+
+
+async def aload_audio(audio_file: str, max_duration: float | None = None) -> tuple[AudioInfo, bytes]:
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), load_audio, audio_file, max_duration)
+
+
+async def anormalize_audio(audio_file: str, output_file: str, max_duration: float | None = None) -> AudioInfo:
+    return await asyncio.get_running_loop().run_in_executor(
+        get_executor(), normalize_audio, audio_file, output_file, max_duration)
+
+
+async def aencode_audio(wav: bytes, audio_format: str) -> bytes:
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), encode_audio, wav, audio_format)
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+# 兼容旧接口
 def audio_length(audio_file):
-    audio = pydub.AudioSegment.from_file(audio_file)
-    return audio.duration_seconds
+    return probe_audio(audio_file).duration
+
 
 # 合并所有音轨到一个
 def merge_audio_tracks(audio_file):
-    audio = pydub.AudioSegment.from_file(audio_file)
+    audio = _decode(audio_file)
     audio = audio.set_channels(1)
     return audio
 
+
 # 查看音轨数
 def get_audio_track_count(audio_file):
-    audio = pydub.AudioSegment.from_file(audio_file)
-    return audio.channels
+    return probe_audio(audio_file).channels
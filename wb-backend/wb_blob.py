@@ -0,0 +1,145 @@
+import os
+import re
+import glob
+import json
+import base64
+import hashlib
+import mimetypes
+
+# 内容寻址的二进制存储：音频、图片按 sha256 存放在 userData/blob/ 下，
+# 对话 JSON 中只保存引用（"<sha256>.<ext>"），不再内嵌 base64
+
+USER_DATA_PATH_ROOT = 'userData/'
+BLOB_DATA_PATH_ROOT = USER_DATA_PATH_ROOT + 'blob/'
+CHAT_DATA_PATH_ROOT = USER_DATA_PATH_ROOT + 'chat/'
+
+_REF_PATTERN = re.compile(r"^([0-9a-f]{64})(\.[0-9a-z]+)?$")
+_DATA_URI_PATTERN = re.compile(r"^data:([^;,]+)(?:;[^,]*)?;base64,(.*)$", re.S)
+
+# mimetypes 对部分音频类型没有映射或映射不稳定，这里固定下来
+_EXTENSIONS = {
+    "audio/wav": ".wav",
+    "audio/x-wav": ".wav",
+    "audio/mpeg": ".mp3",
+    "audio/mp3": ".mp3",
+    "audio/webm": ".webm",
+    "audio/ogg": ".ogg",
+    "audio/opus": ".opus",
+    "audio/pcm": ".pcm",
+    "image/jpeg": ".jpg",
+}
+_CONTENT_TYPES = {ext: content_type for content_type, ext in _EXTENSIONS.items()}
+_CONTENT_TYPES[".wav"] = "audio/wav"
+
+
+def extension_for(content_type: str) -> str:
+    """按内容类型选择文件扩展名，未知类型返回空字符串"""
+    return _EXTENSIONS.get(content_type) or mimetypes.guess_extension(content_type) or ""
+
+
+def parse_data_uri(data_uri: str) -> tuple[str, bytes] | None:
+    """解析 data:<type>;base64,<data>，返回 (content_type, bytes)"""
+    match = _DATA_URI_PATTERN.match(data_uri or "")
+    if not match:
+        return None
+    return match.group(1), base64.b64decode(match.group(2))
+
+
+def to_data_uri(content_type: str, data: bytes) -> str:
+    return "data:" + content_type + ";base64," + base64.b64encode(data).decode("utf-8")
+
+
+class BlobStore:
+    def __init__(self, root: str = BLOB_DATA_PATH_ROOT):
+        self.root = root
+
+    def path(self, ref: str) -> str:
+        match = _REF_PATTERN.match(ref or "")
+        if not match:
+            raise ValueError(f"Invalid blob reference: {ref}")
+        # 按哈希前两位分目录，避免单目录文件过多
+        return os.path.join(self.root, match.group(1)[:2], ref)
+
+    def content_type(self, ref: str) -> str:
+        ext = os.path.splitext(ref)[1]
+        return _CONTENT_TYPES.get(ext) or mimetypes.guess_type("blob" + ext)[0] or "application/octet-stream"
+
+    def exists(self, ref: str) -> bool:
+        return os.path.exists(self.path(ref))
+
+    def put(self, data: bytes, content_type: str) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        ref = digest + extension_for(content_type)
+        path = self.path(ref)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再改名，保证读到的 blob 总是完整的
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return ref
+
+    def get(self, ref: str) -> bytes:
+        with open(self.path(ref), 'rb') as f:
+            return f.read()
+
+    def externalize_message(self, msg: dict) -> dict:
+        """把消息中内嵌的音频、图片写入 blob，替换为引用"""
+        if msg.get("audio_base64"):
+            parsed = parse_data_uri(msg["audio_base64"])
+            if parsed:
+                msg["audio_ref"] = self.put(parsed[1], parsed[0])
+                msg["audio_base64"] = None
+        if msg.get("image_base64"):
+            image_type = msg.get("image_type") or "image/png"
+            msg["image_ref"] = self.put(base64.b64decode(msg["image_base64"]), image_type)
+            msg["image_base64"] = None
+        return msg
+
+    def inline_message(self, msg: dict) -> dict:
+        """返回将引用还原为内嵌 base64 的消息副本，供上游模型使用"""
+        msg = dict(msg)
+        if msg.get("audio_ref") and not msg.get("audio_base64"):
+            msg["audio_base64"] = to_data_uri(self.content_type(msg["audio_ref"]), self.get(msg["audio_ref"]))
+        if msg.get("image_ref") and not msg.get("image_base64"):
+            msg["image_base64"] = base64.b64encode(self.get(msg["image_ref"])).decode("utf-8")
+            msg["image_type"] = msg.get("image_type") or self.content_type(msg["image_ref"])
+        return msg
+
+    def inline_messages(self, messages: list) -> list:
+        return [self.inline_message(msg) for msg in messages]
+
+
+blob_store = BlobStore()
+
+
+def migrate_chat_files(chat_root: str = CHAT_DATA_PATH_ROOT, store: BlobStore = blob_store) -> int:
+    """
+    一次性迁移：把已有对话文件中内嵌的 base64 媒体移入 blob 存储。
+    返回被改写的文件数，可重复执行。
+    """
+    migrated = 0
+    for file_path in glob.glob(os.path.join(chat_root, '*.json')):
+        if file_path.endswith(('_favorites.json', '_index.json')):
+            continue
+        with open(file_path, 'r', encoding="utf-8") as f:
+            history_data = json.load(f)
+        changed = False
+        for messages in history_data.values():
+            for msg in messages:
+                if msg.get("audio_base64") or msg.get("image_base64"):
+                    store.externalize_message(msg)
+                    changed = True
+        if changed:
+            tmp_path = file_path + '.tmp'
+            with open(tmp_path, 'w', encoding="utf-8") as f:
+                json.dump(history_data, f, indent=2)
+            os.replace(tmp_path, file_path)
+            migrated += 1
+            print(f"Migrated {file_path}")
+    return migrated
+
+
+if __name__ == "__main__":
+    print(f"{migrate_chat_files()} chat file(s) migrated")
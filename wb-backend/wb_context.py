@@ -0,0 +1,258 @@
+import os
+import re
+import math
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Dict, Any, Optional
+
+from wb_blob import blob_store
+import wb_telemetry
+import logging
+
+# 上下文窗口管理：按模型的 token 预算裁剪发送给上游的历史消息
+# - 最近的对话原样保留，超出预算的早期对话被丢弃
+# - 只有最近 CONTEXT_MEDIA_TURNS 条带媒体的消息保留图片/音频，更早的替换为文字占位
+# - 可选地把被丢弃的对话折叠成滚动摘要（后台生成并缓存，不阻塞当前回复）
+
+# 单次请求的上下文上限（即使模型支持更长的窗口，也不超过该值以控制延迟与费用）
+CONTEXT_MAX_TOKENS = int(os.getenv("WB_CONTEXT_MAX_TOKENS", "16000"))
+# 为模型输出预留的 token 数
+CONTEXT_OUTPUT_RESERVE = int(os.getenv("WB_CONTEXT_OUTPUT_RESERVE", "2048"))
+CONTEXT_MEDIA_TURNS = int(os.getenv("WB_CONTEXT_MEDIA_TURNS", "2"))
+CONTEXT_SUMMARY = os.getenv("WB_CONTEXT_SUMMARY", "0") == "1"
+CONTEXT_SUMMARY_MODEL = os.getenv("WB_CONTEXT_SUMMARY_MODEL", "qwen-plus")
+# 为摘要预留的 token 数
+SUMMARY_RESERVE_TOKENS = 512
+SUMMARY_CACHE_SIZE = 256
+# 同时生成摘要的线程数，以及排队等待生成的摘要上限（超出时本轮跳过，下一轮再安排）
+SUMMARY_WORKERS = int(os.getenv("WB_CONTEXT_SUMMARY_WORKERS", "2"))
+SUMMARY_MAX_PENDING = int(os.getenv("WB_CONTEXT_SUMMARY_MAX_PENDING", "64"))
+# 每条消息写入摘要输入时截取的最大字符数
+SUMMARY_MESSAGE_CHARS = 500
+
+# token 估算参数：没有本地分词器，按字符近似
+IMAGE_TOKENS = 1280
+AUDIO_TOKENS_PER_SECOND = 25
+AUDIO_BYTES_PER_SECOND = 32000  # 16kHz 16bit 单声道
+MESSAGE_OVERHEAD_TOKENS = 4
+
+IMAGE_PLACEHOLDER = "[图片]"
+AUDIO_PLACEHOLDER = "[语音]"
+
+_CJK = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_text_tokens(text: str) -> int:
+    """中日韩字符约 1 token/字，其余约 4 字符/token"""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def has_image(msg: Dict[str, Any]) -> bool:
+    return bool(msg.get("image_base64") or msg.get("image_ref"))
+
+
+def has_audio(msg: Dict[str, Any]) -> bool:
+    return bool(msg.get("audio_base64") or msg.get("audio_ref"))
+
+
+def sends_media(msg: Dict[str, Any]) -> bool:
+    """消息发给模型时是否带媒体：图片总是发送，音频只在没有文本时发送（与 _format_messages 一致）"""
+    return has_image(msg) or (not msg.get("text") and has_audio(msg))
+
+
+def _audio_bytes(msg: Dict[str, Any]) -> int:
+    if msg.get("audio_base64"):
+        return len(msg["audio_base64"]) * 3 // 4
+    try:
+        return os.path.getsize(blob_store.path(msg["audio_ref"]))
+    except (OSError, ValueError):
+        return 0
+
+
+def estimate_message_tokens(msg: Dict[str, Any]) -> int:
+    # 与 LLMTextClient._format_messages 的取舍一致：有文本时不发送音频
+    tokens = MESSAGE_OVERHEAD_TOKENS + estimate_text_tokens(msg.get("text"))
+    if has_image(msg):
+        tokens += IMAGE_TOKENS
+    elif not msg.get("text") and has_audio(msg):
+        tokens += math.ceil(_audio_bytes(msg) / AUDIO_BYTES_PER_SECOND * AUDIO_TOKENS_PER_SECOND)
+    return tokens
+
+
+def strip_media(msg: Dict[str, Any]) -> Dict[str, Any]:
+    """返回去掉图片/音频的消息副本，用文字占位说明原消息包含媒体"""
+    text = msg.get("text") or ""
+    if has_image(msg):
+        text = (text + " " + IMAGE_PLACEHOLDER).strip()
+    elif not text and has_audio(msg):
+        text = AUDIO_PLACEHOLDER
+    return {**msg, "text": text, "image_base64": None, "image_ref": None,
+            "audio_base64": None, "audio_ref": None}
+
+
+def _message_digest(previous: str, msg: Dict[str, Any]) -> str:
+    # 链式哈希：第 i 个值唯一标识前 i 条消息，摘要缓存按前缀查找
+    raw = json.dumps([previous, msg.get("isUser"), msg.get("text"), msg.get("timestamp"),
+                      msg.get("image_ref"), msg.get("audio_ref")], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SummaryCache:
+    """
+    滚动摘要缓存，键为被折叠消息前缀的链式哈希。
+    摘要在固定大小的线程池中生成，同一前缀只会有一个生成任务，排队的任务数有上限。
+    """
+
+    def __init__(self, max_size: int = SUMMARY_CACHE_SIZE, workers: int = SUMMARY_WORKERS,
+                 max_pending: int = SUMMARY_MAX_PENDING):
+        self.max_size = max_size
+        self.workers = workers
+        self.max_pending = max_pending
+        self._summaries: OrderedDict[str, str] = OrderedDict()
+        self._pending: set[str] = set()
+        self._lock = threading.Lock()
+        self._executor: ThreadPoolExecutor | None = None
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is not None:
+                self._summaries.move_to_end(key)
+            return summary
+
+    def put(self, key: str, summary: str):
+        with self._lock:
+            self._summaries[key] = summary
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_size:
+                self._summaries.popitem(last=False)
+
+    def schedule(self, key: str, job: Callable[[], str]):
+        with self._lock:
+            if key in self._pending or key in self._summaries:
+                return
+            if len(self._pending) >= self.max_pending:
+                wb_telemetry.log_event("context_summary_skipped", logging.WARNING, pending=len(self._pending))
+                return
+            self._pending.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="wb-summary")
+            executor = self._executor
+
+        def run():
+            try:
+                summary = job()
+                if summary:
+                    self.put(key, summary)
+            except Exception as e:
+                wb_telemetry.log_event("context_summary_failed", logging.WARNING, error=str(e))
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+        executor.submit(run)
+
+    def shutdown(self):
+        """丢弃排队中的摘要任务，不等待进行中的任务结束"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._pending.clear()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+summary_cache = SummaryCache()
+
+
+def render_transcript(messages: List[Dict[str, Any]]) -> str:
+    lines = []
+    for msg in messages:
+        text = strip_media(msg)["text"][:SUMMARY_MESSAGE_CHARS]
+        if text:
+            lines.append(("用户: " if msg.get("isUser") else "助手: ") + text)
+    return "\n".join(lines)
+
+
+class ContextWindow:
+    """
+    为一个模型选择本轮发送的历史消息。
+
+    :param max_tokens: 历史消息与系统提示可用的 token 预算
+    :param summarizer: 可选，summarizer(previous_summary, transcript) -> str，用于折叠早期对话
+    :param media_turns: 保留原始媒体的最近消息条数
+    """
+
+    def __init__(self, max_tokens: int, summarizer: Optional[Callable[[str, str], str]] = None,
+                 media_turns: int = CONTEXT_MEDIA_TURNS, cache: SummaryCache = summary_cache):
+        self.max_tokens = max_tokens
+        self.summarizer = summarizer
+        self.media_turns = media_turns
+        self.cache = cache
+
+    def build(self, history: List[Dict[str, Any]], system_prompt: str = "") -> tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        返回 (保留的消息, 早期对话摘要)。消息中的 blob 引用不会被展开，由调用方按需还原。
+        最后一条消息（本轮输入）总是保留。
+        """
+        budget = self.max_tokens - estimate_text_tokens(system_prompt)
+        if self.summarizer is not None:
+            budget -= SUMMARY_RESERVE_TOKENS
+
+        prepared = []
+        media_seen = 0
+        for msg in reversed(history):
+            # 只有实际发送媒体的消息占用 media_turns（如带语音的回复有文本，语音不会发送）
+            if sends_media(msg):
+                if media_seen >= self.media_turns:
+                    msg = strip_media(msg)
+                else:
+                    media_seen += 1
+            elif has_audio(msg):
+                # 不会发送的音频也去掉，避免还原 blob 引用时读取文件
+                msg = strip_media(msg)
+            prepared.append(msg)
+        prepared.reverse()
+
+        kept_from = len(prepared)
+        used = 0
+        for i in range(len(prepared) - 1, -1, -1):
+            cost = estimate_message_tokens(prepared[i])
+            if used + cost > budget and i < len(prepared) - 1:
+                break
+            used += cost
+            kept_from = i
+
+        summary = None
+        if kept_from > 0 and self.summarizer is not None:
+            summary = self._summary_for(history[:kept_from])
+        return prepared[kept_from:], summary
+
+    def _summary_for(self, dropped: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        查找覆盖被丢弃消息的摘要。只有较短前缀的摘要时先用它，
+        同时在后台基于它和新增的消息生成完整前缀的摘要，供下一轮使用。
+        """
+        digests = []
+        digest = ""
+        for msg in dropped:
+            digest = _message_digest(digest, msg)
+            digests.append(digest)
+
+        covered, summary = 0, None
+        for i in range(len(digests) - 1, -1, -1):
+            summary = self.cache.get(digests[i])
+            if summary is not None:
+                covered = i + 1
+                break
+
+        if covered < len(dropped):
+            previous = summary or ""
+            transcript = render_transcript(dropped[covered:])
+            self.cache.schedule(digests[-1], lambda: self.summarizer(previous, transcript))
+        return summary
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+from pydantic import ValidationError
+
+import dataModel
+import wb_telemetry
+from wb_blob import blob_store
+
+# 用户对话的流式导出与导入（NDJSON，每行一个 JSON 对象）：
+#   {"type": "header", "format": "wb-chat-export", "version": 1, "user_id": ..., "media": "ref" | "inline", ...}
+#   {"type": "history", "id": ..., "is_favorite": ..., "message_count": ...}
+#   {"type": "message", "history_id": ..., "message": {...}}      # 紧跟在所属的 history 行之后
+#   {"type": "end", "histories": ..., "messages": ...}            # 缺少该行说明导出被截断
+# 导出逐段读取历史、逐条序列化消息；media=inline 时把 blob 中的音频/图片还原为 base64，
+# 否则只保留 blob 引用（目标服务器需另行同步 userData/blob/）。
+# 导入边接收边解析，按批把内嵌媒体写入 blob、消息追加到存储，请求体不会整体读入内存。
+
+EXPORT_FORMAT = "wb-chat-export"
+EXPORT_VERSION = 1
+MEDIA_MODES = ("ref", "inline")
+# 导出时合并小行后再发送的块大小
+EXPORT_CHUNK_BYTES = 64 * 1024
+# 导入每批的消息数与字节数上限，达到任一上限即写入存储
+IMPORT_BATCH_MESSAGES = int(os.getenv("WB_IMPORT_BATCH_MESSAGES", "500"))
+IMPORT_BATCH_BYTES = int(os.getenv("WB_IMPORT_BATCH_BYTES", str(16 * 1024 * 1024)))
+# 单行上限（内嵌媒体的消息可能较大）
+IMPORT_MAX_LINE_BYTES = int(os.getenv("WB_IMPORT_MAX_LINE_BYTES", str(64 * 1024 * 1024)))
+
+
+class LineTooLong(ValueError):
+    pass
+
+
+def _line(obj: dict) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode()
+
+
+def _inline_media(msg: dict) -> dict:
+    try:
+        return blob_store.inline_message(msg)
+    except (OSError, ValueError) as e:
+        # blob 缺失时保留引用，导出不中断
+        wb_telemetry.log_event("export_blob_missing", logging.WARNING,
+                               ref=msg.get("audio_ref") or msg.get("image_ref"), error=str(e))
+        return msg
+
+
+def export_history(store: dataModel.ChatHistoryStore, user_id: str, media: str = "ref"):
+    """
+    在调用线程读取历史 id 与收藏列表，返回按块生成 NDJSON 的迭代器。
+    迭代时每次只取一段历史，内存占用与历史总量无关；导出期间新增的历史不包含在内。
+    """
+    history_ids = [item["id"] for item in store.get_history_list()]
+    favorites = set(store.get_favorites())
+
+    def lines():
+        start = time.perf_counter()
+        histories = messages = 0
+        yield _line({"type": "header", "format": EXPORT_FORMAT, "version": EXPORT_VERSION,
+                     "user_id": user_id, "media": media, "exported_at": int(time.time() * 1000)})
+        for history_id in history_ids:
+            history = store.get_history_data(history_id)
+            if history is None:
+                # 导出期间被删除
+                continue
+            # 浅拷贝列表，导出期间追加的消息不影响已写出的 message_count
+            history = list(history)
+            histories += 1
+            yield _line({"type": "history", "id": history_id, "is_favorite": history_id in favorites,
+                         "message_count": len(history)})
+            for msg in history:
+                if media == "inline":
+                    msg = _inline_media(msg)
+                messages += 1
+                yield _line({"type": "message", "history_id": history_id, "message": msg})
+        yield _line({"type": "end", "histories": histories, "messages": messages})
+        wb_telemetry.log_event("chat_export", user_id=user_id, media=media, histories=histories,
+                               messages=messages, duration_ms=round((time.perf_counter() - start) * 1000))
+
+    def chunks():
+        buffer = bytearray()
+        for line in lines():
+            buffer += line
+            if len(buffer) >= EXPORT_CHUNK_BYTES:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+
+    return chunks()
+
+
+async def iter_lines(chunks, max_line_bytes: int = IMPORT_MAX_LINE_BYTES):
+    """把请求体的字节流切分为行，只缓存当前未结束的一行"""
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        start = 0
+        while (end := buffer.find(b"\n", start)) >= 0:
+            yield bytes(buffer[start:end])
+            start = end + 1
+        del buffer[:start]
+        if len(buffer) > max_line_bytes:
+            raise LineTooLong(f"line exceeds {max_line_bytes} bytes")
+    if buffer:
+        yield bytes(buffer)
+
+
+class HistoryImporter:
+    """
+    逐行解析导出的 NDJSON，攒够一批后写入存储。
+    每段历史第一次出现时清空为空历史（覆盖同 id 的已有历史），之后的消息按批追加；
+    replace=True 时先清空用户的全部历史。
+    """
+
+    def __init__(self, user_id: str, replace: bool = False,
+                 batch_messages: int = IMPORT_BATCH_MESSAGES, batch_bytes: int = IMPORT_BATCH_BYTES):
+        self.user_id = user_id
+        self.replace = replace
+        self.batch_messages = batch_messages
+        self.batch_bytes = batch_bytes
+        self.line_no = 0
+        self.histories = 0
+        self.messages = 0
+        self.missing_media = 0
+        self.complete = False
+        self._header = None
+        self._started: set[str] = set()
+        # 待写入的操作：("clear",) / ("history", id, is_favorite) / ("message", history_id, msg)
+        self._ops: list[tuple] = []
+        self._fed_messages = 0
+        self._batch_count = 0
+        self._batch_size = 0
+        self._start = time.perf_counter()
+
+    def feed(self, raw: bytes) -> bool:
+        """解析一行，格式错误时抛出 ValueError；返回当前批是否已满"""
+        self.line_no += 1
+        if not raw.strip():
+            return False
+        try:
+            item = json.loads(raw)
+        except ValueError as e:
+            raise ValueError(f"invalid JSON: {e}")
+        if not isinstance(item, dict):
+            raise ValueError("expected a JSON object")
+        kind = item.get("type")
+        if self._header is None:
+            if kind != "header" or item.get("format") != EXPORT_FORMAT:
+                raise ValueError(f"not a {EXPORT_FORMAT} file")
+            if not isinstance(item.get("version"), int) or item["version"] > EXPORT_VERSION:
+                raise ValueError(f"unsupported version {item.get('version')}")
+            self._header = item
+            if self.replace:
+                self._ops.append(("clear",))
+            return False
+        if self.complete:
+            raise ValueError("data after end line")
+
+        if kind == "history":
+            history_id = item.get("id")
+            if not isinstance(history_id, str) or not history_id:
+                raise ValueError("history line without id")
+            self._ops.append(("history", history_id, bool(item.get("is_favorite"))))
+        elif kind == "message":
+            history_id = item.get("history_id")
+            if not isinstance(history_id, str) or not history_id:
+                raise ValueError("message line without history_id")
+            try:
+                # 只保留导出时存在的字段，导入后与原数据一致
+                msg = dataModel.Message.model_validate(item.get("message")).model_dump(exclude_unset=True)
+            except ValidationError as e:
+                raise ValueError("invalid message: " + "; ".join(
+                    f"{'.'.join(map(str, err['loc']))} {err['msg']}" for err in e.errors()))
+            self._ops.append(("message", history_id, msg))
+            self._fed_messages += 1
+            self._batch_count += 1
+            self._batch_size += len(raw)
+        elif kind == "end":
+            if item.get("messages") != self._fed_messages:
+                raise ValueError(f"end line reports {item.get('messages')} message(s), file has {self._fed_messages}")
+            self.complete = True
+        else:
+            raise ValueError(f"unknown line type {kind!r}")
+        return self._batch_count >= self.batch_messages or self._batch_size >= self.batch_bytes
+
+    def _prepare(self, ops: list):
+        """在线程池中执行：内嵌的媒体解码后写入 blob，只留引用；统计引用了本机不存在的 blob 的消息"""
+        for op in ops:
+            if op[0] != "message":
+                continue
+            msg = blob_store.externalize_message(op[2])
+            refs = [msg.get("audio_ref"), msg.get("image_ref")]
+            try:
+                if any(ref and not blob_store.exists(ref) for ref in refs):
+                    self.missing_media += 1
+            except ValueError:
+                self.missing_media += 1
+
+    def _apply(self, ops: list):
+        # 每批重新获取存储：导入期间存储可能被缓存淘汰或因其它进程写入而重新加载
+        store = dataModel.open_chat_db(self.user_id)
+        pending_id, pending = None, []
+
+        def append_pending():
+            if pending:
+                store.append_messages(pending_id, pending)
+                self.messages += len(pending)
+
+        for op in ops:
+            if op[0] == "clear":
+                store.clear_all_history()
+                continue
+            history_id = op[1]
+            if history_id not in self._started:
+                append_pending()
+                pending_id, pending = history_id, []
+                self._started.add(history_id)
+                self.histories += 1
+                store.add_history(history_id, [])
+            if op[0] == "history":
+                if op[2]:
+                    store.add_favorite(history_id)
+                else:
+                    store.remove_favorite(history_id)
+            else:
+                if history_id != pending_id:
+                    append_pending()
+                    pending_id, pending = history_id, []
+                pending.append(op[2])
+        append_pending()
+
+    async def write_batch(self):
+        ops, self._ops = self._ops, []
+        self._batch_count = self._batch_size = 0
+        if ops:
+            await asyncio.to_thread(self._prepare, ops)
+            self._apply(ops)
+
+    async def flush(self):
+        """写入剩余的批次并立即写盘"""
+        await self.write_batch()
+        store = dataModel.open_chat_db(self.user_id)
+        await asyncio.to_thread(dataModel.write_pending, store.take_pending_writes())
+
+    def result(self) -> dict:
+        wb_telemetry.log_event("chat_import", user_id=self.user_id, replace=self.replace,
+                               histories=self.histories, messages=self.messages, complete=self.complete,
+                               duration_ms=round((time.perf_counter() - self._start) * 1000))
+        return {"histories": self.histories, "messages": self.messages,
+                "missing_media": self.missing_media, "complete": self.complete}
@@ -0,0 +1,100 @@
+import os
+import json
+import time
+import logging
+from contextlib import contextmanager
+
+import wb_telemetry
+
+# 多进程共享 userData/ 下的 JSON 文件：
+# - 写入先写同目录的临时文件、fsync 后再改名替换，崩溃时文件要么是旧内容要么是新内容；
+# - 读-改-写期间持有按文件加锁的建议锁（POSIX flock / Windows msvcrt），多个 worker 进程互斥。
+
+# 写入后是否 fsync（临时文件与所在目录）；关闭后仍是原子替换，但掉电时可能丢失最近的写入
+FSYNC = os.getenv("WB_CHAT_FSYNC", "1") == "1"
+
+if os.name == "nt":
+    import msvcrt
+
+    def _lock(fd: int):
+        while True:
+            try:
+                # 锁住第一个字节；LK_LOCK 自身会重试 10 秒，超时后继续等待
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                time.sleep(0.05)
+
+    def _unlock(fd: int):
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _lock(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+    def _unlock(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+@contextmanager
+def file_lock(lock_path: str):
+    """进程间互斥的建议锁，锁文件不存在时自动创建，进程退出时由系统释放"""
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        _lock(fd)
+        try:
+            yield
+        finally:
+            _unlock(fd)
+    finally:
+        os.close(fd)
+
+
+def file_stamp(path: str) -> tuple | None:
+    """文件的 (inode, 修改时间, 大小)，改名替换后必然变化；文件不存在时为 None"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def read_json(path: str, default):
+    """
+    读取 JSON 文件，不存在时返回 default。
+    内容损坏（如旧版本写到一半崩溃）时把文件改名为 .corrupt-<时间戳> 保留现场，同样返回 default。
+    """
+    try:
+        with open(path, 'r', encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except ValueError as e:
+        corrupt_path = f"{path}.corrupt-{int(time.time())}"
+        os.replace(path, corrupt_path)
+        wb_telemetry.log_event("json_file_corrupt", logging.ERROR, path=path, moved_to=corrupt_path, error=str(e))
+        return default
+
+
+def write_json_atomic(path: str, data, fsync: bool = FSYNC):
+    """写入同目录的临时文件并改名替换；目录的 fsync 由调用方按批次执行（见 fsync_dir）"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def fsync_dir(dir_path: str):
+    """持久化目录项（改名操作）；Windows 不支持打开目录，跳过"""
+    if os.name == "nt":
+        return
+    fd = os.open(dir_path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
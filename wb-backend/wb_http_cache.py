@@ -0,0 +1,175 @@
+import os
+import gzip
+import asyncio
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Request
+from fastapi.responses import Response
+
+# 历史记录接口的条件请求与压缩：
+# 存储为每个用户、每段历史维护版本号，作为 ETag / Last-Modified 返回，未变化时直接 304；
+# 同一版本的 JSON 只序列化一次，gzip / brotli 压缩结果一并缓存；
+# 序列化与压缩在线程池中执行，大用户的历史不会阻塞事件循环。
+# brotli 为可选依赖，未安装时只提供 gzip。
+
+# 缓存的响应条数与总字节数
+RESPONSE_CACHE_SIZE = int(os.getenv("WB_RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("WB_RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# 小于该字节数的响应不压缩
+COMPRESS_MIN_SIZE = int(os.getenv("WB_COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def make_etag(version: str) -> str:
+    # 同一版本可能以不同编码返回，使用弱 ETag
+    return f'W/"{version}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith("W/") else candidate) == opaque:
+            return True
+    return False
+
+
+def not_modified(request: Request, etag: str, last_modified: float) -> bool:
+    """按 If-None-Match 判断；请求没有携带时才看 If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def choose_encoding(accept_encoding: str) -> str | None:
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip()] = q
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class _Entry:
+    def __init__(self, etag: str, body: bytes, headers: dict):
+        self.etag = etag
+        self.body = body
+        self.headers = headers
+        self.encoded: dict[str, bytes] = {}
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(data) for data in self.encoded.values())
+
+
+class ResponseCache:
+    """按资源键缓存最新版本的 JSON 响应体及其压缩结果，版本变化时整体替换"""
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple, _Entry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _get(self, key: tuple, etag: str) -> _Entry | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.etag != etag:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key: tuple, entry: _Entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._bytes -= self._entries.popitem(last=False)[1].size
+
+    def _build(self, etag: str, build, encoding: str | None) -> _Entry:
+        # 在线程池中执行：生成响应体，并按本次请求的编码压缩
+        entry = _Entry(etag, *build())
+        if encoding is not None and len(entry.body) >= COMPRESS_MIN_SIZE:
+            entry.encoded[encoding] = compress(entry.body, encoding)
+        return entry
+
+    def _add_encoding(self, key: tuple, entry: _Entry, encoding: str) -> bytes:
+        data = compress(entry.body, encoding)
+        with self._lock:
+            if encoding not in entry.encoded:
+                entry.encoded[encoding] = data
+                if self._entries.get(key) is entry:
+                    self._bytes += len(data)
+        return data
+
+    async def respond(self, request: Request, key: tuple, version: tuple[str, float] | None, build) -> Response:
+        """
+        返回 key 对应资源的 JSON 响应。
+        :param version: 存储给出的 (版本标识, 最后修改时间)，为 None 时不做缓存和条件判断
+        :param build: 返回 (响应体 bytes, 额外响应头) 的函数，只在缓存未命中时在线程池中调用
+        """
+        if version is None:
+            body, extra_headers = await asyncio.to_thread(build)
+            return Response(body, media_type="application/json", headers=extra_headers)
+        etag = make_etag(version[0])
+        headers = {
+            "ETag": etag,
+            "Last-Modified": formatdate(version[1], usegmt=True),
+            # 允许浏览器缓存，但每次使用前都带 If-None-Match 重新验证
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding",
+        }
+        if not_modified(request, etag, version[1]):
+            return Response(status_code=304, headers=headers)
+
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+        entry = self._get(key, etag)
+        if entry is None:
+            # 只缓存完整生成的结果
+            entry = await asyncio.to_thread(self._build, etag, build, encoding)
+            self._put(key, entry)
+        headers.update(entry.headers)
+        body = entry.body
+        if encoding is not None and len(body) >= COMPRESS_MIN_SIZE:
+            body = entry.encoded.get(encoding) or await asyncio.to_thread(self._add_encoding, key, entry, encoding)
+            headers["Content-Encoding"] = encoding
+        return Response(body, media_type="application/json", headers=headers)
+
+
+response_cache = ResponseCache()
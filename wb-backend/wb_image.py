@@ -0,0 +1,149 @@
+import os
+import io
+import base64
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+import wb_telemetry
+from wb_blob import blob_store, BLOB_DATA_PATH_ROOT
+
+# 图片预处理：发给视觉模型前限制分辨率并重新压缩，历史记录中只显示缩略图。
+# 处理结果作为普通 blob 保存，并按 "原图哈希 + 变体参数" 记录映射，同一张图只处理一次。
+# Pillow 只在处理图片时才导入；未安装或图片无法解码时直接使用原图。
+
+# 发给模型的图片最长边与 JPEG 质量
+IMAGE_MAX_SIDE = int(os.getenv("WB_IMAGE_MAX_SIDE", "1280"))
+IMAGE_QUALITY = int(os.getenv("WB_IMAGE_QUALITY", "85"))
+# 历史记录缩略图的最长边与 JPEG 质量（界面最大显示 300x200，按 2 倍像素密度生成）
+IMAGE_THUMB_SIDE = int(os.getenv("WB_IMAGE_THUMB_SIDE", "600"))
+IMAGE_THUMB_QUALITY = int(os.getenv("WB_IMAGE_THUMB_QUALITY", "75"))
+# 尺寸不超限的原图若小于该字节数则不重新压缩
+IMAGE_KEEP_BYTES = int(os.getenv("WB_IMAGE_KEEP_BYTES", str(512 * 1024)))
+# 进程内缓存的 原图 -> 变体 映射条数
+IMAGE_VARIANT_CACHE_SIZE = int(os.getenv("WB_IMAGE_VARIANT_CACHE_SIZE", "4096"))
+
+# 变体名 -> (最长边, JPEG 质量)
+VARIANTS = {
+    "model": (IMAGE_MAX_SIDE, IMAGE_QUALITY),
+    "thumb": (IMAGE_THUMB_SIDE, IMAGE_THUMB_QUALITY),
+}
+VARIANT_DATA_PATH_ROOT = BLOB_DATA_PATH_ROOT + "variants/"
+# 可直接发给模型、浏览器也能显示的格式
+_KEPT_FORMATS = ("JPEG", "PNG", "WEBP")
+
+
+def process_image(data: bytes, max_side: int, quality: int) -> bytes | None:
+    """
+    缩放到最长边不超过 max_side 并编码为 JPEG。
+    原图已满足要求（常见格式、尺寸不超限且不大）或处理后反而更大时返回 None，表示沿用原图。
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        oversized = max(image.size) > max_side
+        if not oversized and image.format in _KEPT_FORMATS and len(data) <= IMAGE_KEEP_BYTES:
+            return None
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P"):
+            # JPEG 不支持透明通道，铺白色背景
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    output = buffer.getvalue()
+    if not oversized and len(output) >= len(data):
+        return None
+    return output
+
+
+class ImageVariants:
+    """按原图 blob 引用生成并缓存处理后的变体，返回变体的 blob 引用"""
+
+    def __init__(self, root: str = VARIANT_DATA_PATH_ROOT):
+        self.root = root
+        self._refs: OrderedDict[tuple, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._pillow_missing = False
+
+    def _link_path(self, ref: str, name: str) -> str:
+        max_side, quality = VARIANTS[name]
+        digest = ref.split('.')[0]
+        return os.path.join(self.root, digest[:2], f"{digest}.{name}-{max_side}-{quality}")
+
+    def _read_link(self, path: str) -> str | None:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                ref = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return ref if ref and blob_store.exists(ref) else None
+
+    def _write_link(self, path: str, ref: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(ref)
+        os.replace(tmp_path, path)
+
+    def _process(self, ref: str, name: str) -> str:
+        if self._pillow_missing:
+            return ref
+        max_side, quality = VARIANTS[name]
+        try:
+            output = process_image(blob_store.get(ref), max_side, quality)
+        except ImportError:
+            self._pillow_missing = True
+            wb_telemetry.log_event("image_processing_disabled", logging.WARNING, reason="Pillow is not installed")
+            return ref
+        except Exception as e:
+            # 无法解码的格式（如 HEIC）或损坏的图片，沿用原图
+            wb_telemetry.log_event("image_processing_failed", logging.WARNING, ref=ref, variant=name, error=str(e))
+            output = None
+        return blob_store.put(output, "image/jpeg") if output is not None else ref
+
+    def get(self, ref: str, name: str) -> str:
+        """返回变体的 blob 引用，无需处理时即原图引用；首次调用会解码图片，较慢"""
+        key = (ref, name)
+        with self._lock:
+            cached = self._refs.get(key)
+            if cached is not None:
+                self._refs.move_to_end(key)
+                return cached
+        path = self._link_path(ref, name)
+        variant_ref = self._read_link(path)
+        if variant_ref is None:
+            variant_ref = self._process(ref, name)
+            if not self._pillow_missing:
+                self._write_link(path, variant_ref)
+        with self._lock:
+            self._refs[key] = variant_ref
+            if len(self._refs) > IMAGE_VARIANT_CACHE_SIZE:
+                self._refs.popitem(last=False)
+        return variant_ref
+
+    async def aget(self, ref: str, name: str) -> str:
+        return await asyncio.to_thread(self.get, ref, name)
+
+    def model_message(self, msg: dict) -> dict:
+        """把消息中的图片替换为发给模型的变体（blob 引用），没有图片时原样返回"""
+        if msg.get("image_base64"):
+            ref = blob_store.put(base64.b64decode(msg["image_base64"]), msg.get("image_type") or "image/png")
+        elif msg.get("image_ref"):
+            ref = msg["image_ref"]
+        else:
+            return msg
+        variant_ref = self.get(ref, "model")
+        return dict(msg, image_base64=None, image_ref=variant_ref, image_type=blob_store.content_type(variant_ref))
+
+    def model_messages(self, messages: list) -> list:
+        return [self.model_message(msg) for msg in messages]
+
+
+image_variants = ImageVariants()
@@ -0,0 +1,275 @@
+import os
+import re
+import glob
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+from http import HTTPStatus
+
+import httpx
+from pydantic import BaseModel
+from dashscope import ImageSynthesis
+
+import wb_telemetry
+import wb_admission
+import wb_fileio
+import wb_blob
+
+# 图像生成任务队列：提交后立即返回任务 id，由固定数量的后台 worker 执行，
+# 结果图片流式下载到 userData/image/，不再以 base64 返回。
+# 任务状态同时写入 userData/image/jobs/<job_id>.json：多个 worker 进程部署时，
+# 轮询或 websocket 落到其它进程也能查到任务，并通过轮询状态文件等待变化。
+
+USER_DATA_PATH_ROOT = 'userData/'
+IMAGE_DATA_PATH_ROOT = USER_DATA_PATH_ROOT + 'image/'
+IMAGE_JOB_PATH_ROOT = IMAGE_DATA_PATH_ROOT + 'jobs/'
+IMAGE_WORKERS = int(os.getenv("WB_IMAGE_WORKERS", "2"))
+IMAGE_USER_LIMIT = int(os.getenv("WB_IMAGE_USER_LIMIT", "2"))
+# 已结束的任务在内存中保留的时长（秒），图片文件不受影响
+IMAGE_JOB_TTL = float(os.getenv("WB_IMAGE_JOB_TTL", "3600"))
+# 等待其它进程的任务时读取状态文件的间隔（秒）
+IMAGE_JOB_POLL_INTERVAL = 0.5
+IMAGE_MODEL = "qwen-image"
+# 可用图片大小为 1664*928,1472*1140,1328*1328,1140*1472,928*1664.
+IMAGE_SIZE = '1328*1328'
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+_JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _process_alive(pid: int) -> bool:
+    if os.name == "nt":
+        # Windows 上 os.kill 会结束进程，无法用来探测，视为存活
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ImageJob(BaseModel):
+    job_id: str
+    user_id: str
+    prompt: str
+    size: str = IMAGE_SIZE
+    status: str = JOB_QUEUED
+    created_at: float
+    finished_at: float | None = None
+    image_type: str | None = None
+    error: str | None = None
+    # 执行任务的进程，进程退出后未结束的任务视为失败
+    owner_pid: int = 0
+
+    @property
+    def image_path(self) -> str:
+        # 扩展名与下载时上游返回的 Content-Type 一致，按扩展名推断类型的代码不会误判
+        return IMAGE_DATA_PATH_ROOT + self.job_id + (wb_blob.extension_for(self.image_type or "image/png") or ".img")
+
+    @property
+    def state_path(self) -> str:
+        return IMAGE_JOB_PATH_ROOT + self.job_id + '.json'
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JOB_DONE, JOB_FAILED)
+
+
+class ImageJobLimitError(Exception):
+    pass
+
+
+class ImageJobManager:
+    def __init__(self, workers: int = IMAGE_WORKERS, per_user_limit: int = IMAGE_USER_LIMIT):
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self.jobs: dict[str, ImageJob] = {}
+        self._dedup: dict[str, str] = {}
+        self._changed: dict[str, asyncio.Condition] = {}
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._http: httpx.AsyncClient | None = None
+
+    @staticmethod
+    def _dedup_key(prompt: str, size: str) -> str:
+        return hashlib.sha256(f"{IMAGE_MODEL}\n{size}\n{prompt.strip()}".encode("utf-8")).hexdigest()
+
+    async def start(self):
+        self._sweep()
+        self._queue = asyncio.Queue()
+        self._http = httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0))
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._http is not None:
+            await self._http.aclose()
+
+    def _prune(self):
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished and time.time() - job.finished_at > IMAGE_JOB_TTL]
+        for job_id in expired:
+            job = self.jobs.pop(job_id)
+            del self._changed[job_id]
+            try:
+                os.remove(job.state_path)
+            except FileNotFoundError:
+                pass
+        self._dedup = {key: job_id for key, job_id in self._dedup.items() if job_id in self.jobs}
+
+    def submit(self, user_id: str, prompt: str, size: str = IMAGE_SIZE) -> ImageJob:
+        """
+        提交生成任务。相同提示词的进行中或已成功任务直接复用；
+        单个用户排队和运行中的任务数超过上限时抛出 ImageJobLimitError。
+        """
+        self._prune()
+        key = self._dedup_key(prompt, size)
+        existing = self.jobs.get(self._dedup.get(key, ""))
+        if existing is not None and existing.status != JOB_FAILED and \
+                (existing.status != JOB_DONE or os.path.exists(existing.image_path)):
+            return existing
+
+        active = sum(1 for job in self.jobs.values() if job.user_id == user_id and not job.finished)
+        if active >= self.per_user_limit:
+            raise ImageJobLimitError(f"Too many image jobs in progress (limit {self.per_user_limit})")
+
+        job = ImageJob(job_id=uuid.uuid4().hex, user_id=user_id, prompt=prompt, size=size, created_at=time.time(),
+                       owner_pid=os.getpid())
+        self._save(job)
+        self.jobs[job.job_id] = job
+        self._dedup[key] = job.job_id
+        self._changed[job.job_id] = asyncio.Condition()
+        self._queue.put_nowait(job)
+        return job
+
+    @staticmethod
+    def _save(job: ImageJob):
+        # 状态文件很小且可以重建，不做 fsync
+        os.makedirs(IMAGE_JOB_PATH_ROOT, exist_ok=True)
+        wb_fileio.write_json_atomic(job.state_path, job.model_dump(), fsync=False)
+
+    @staticmethod
+    def _load(job_id: str) -> ImageJob | None:
+        """读取其它进程的任务状态"""
+        if not _JOB_ID_PATTERN.match(job_id):
+            return None
+        data = wb_fileio.read_json(IMAGE_JOB_PATH_ROOT + job_id + '.json', None)
+        if data is None:
+            return None
+        job = ImageJob(**data)
+        if not job.finished and not _process_alive(job.owner_pid):
+            job.status = JOB_FAILED
+            job.error = "Worker process exited"
+        return job
+
+    @staticmethod
+    def _sweep():
+        """启动时删除过期的状态文件（包括已退出进程遗留的）"""
+        for path in glob.glob(IMAGE_JOB_PATH_ROOT + '*.json'):
+            try:
+                if time.time() - os.path.getmtime(path) > IMAGE_JOB_TTL:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, job_id: str) -> ImageJob | None:
+        return self.jobs.get(job_id) or self._load(job_id)
+
+    async def wait_for_change(self, job: ImageJob, since: str, timeout: float | None = None) -> ImageJob:
+        """
+        等待任务状态离开 since（供 websocket 推送和长轮询使用），超时则原样返回。
+        其它进程的任务通过轮询状态文件等待，调用方应使用返回的任务对象。
+        """
+        condition = self._changed.get(job.job_id)
+        if condition is None:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while job.status == since and (deadline is None or time.monotonic() < deadline):
+                await asyncio.sleep(IMAGE_JOB_POLL_INTERVAL)
+                job = self._load(job.job_id) or job
+            return job
+        async with condition:
+            if job.status != since:
+                return job
+            try:
+                await asyncio.wait_for(condition.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return job
+
+    async def _set_status(self, job: ImageJob, status: str, error: str | None = None):
+        job.status = status
+        job.error = error
+        if job.finished:
+            job.finished_at = time.time()
+        self._save(job)
+        condition = self._changed[job.job_id]
+        async with condition:
+            condition.notify_all()
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._set_status(job, JOB_RUNNING)
+                await self._run(job)
+                await self._set_status(job, JOB_DONE)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                wb_telemetry.log_event("image_job_failed", logging.WARNING, job_id=job.job_id,
+                                       user_id=job.user_id, error=str(e))
+                await self._set_status(job, JOB_FAILED, str(e))
+
+    async def _run(self, job: ImageJob):
+        # 与其它上游调用共用准入控制，429 时退避重试
+        async with wb_admission.admission.slot(IMAGE_MODEL, job.user_id):
+            rsp = await wb_admission.retry_rate_limited(lambda: self._call_synthesis(job), IMAGE_MODEL)
+        if not (hasattr(rsp.output, 'results') and len(rsp.output.results) > 0):
+            raise RuntimeError("No results in API response")
+        await self._download(rsp.output.results[0].url, job)
+
+    async def _call_synthesis(self, job: ImageJob):
+        # 调用阿里云百炼图像生成API（阻塞调用，放到线程池中执行）
+        rsp = await asyncio.to_thread(
+            ImageSynthesis.call,
+            api_key=os.getenv("DASHSCOPE_API_KEY"),
+            model=IMAGE_MODEL,
+            prompt=job.prompt,
+            n=1,
+            size=job.size,
+            prompt_extend=True,
+            watermark=False
+        )
+        if rsp.status_code == HTTPStatus.TOO_MANY_REQUESTS:
+            raise wb_admission.RateLimited(getattr(rsp, 'message', 'Too many requests'))
+        if rsp.status_code != HTTPStatus.OK:
+            raise RuntimeError(f"Image generation failed: {getattr(rsp, 'message', 'Unknown error')}")
+        return rsp
+
+    async def _download(self, url: str, job: ImageJob):
+        os.makedirs(IMAGE_DATA_PATH_ROOT, exist_ok=True)
+        async with self._http.stream("GET", url) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to download generated image, status: {response.status_code}")
+            image_type = response.headers.get("content-type", "image/png").split(';')[0].strip().lower()
+            if not image_type.startswith("image/"):
+                raise RuntimeError(f"Generated image has unexpected content type: {image_type}")
+            job.image_type = image_type
+            tmp_path = job.image_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                async for chunk in response.aiter_bytes(64 * 1024):
+                    f.write(chunk)
+        os.replace(tmp_path, job.image_path)
+
+
+image_jobs = ImageJobManager()
@@ -0,0 +1,161 @@
+import asyncio
+import base64
+from fastapi import WebSocket, WebSocketDisconnect
+
+# /ws/chat/ 推流协议
+# v1 (快照): 每个 token 都发送完整的 ChatData，旧版 Chat.vue 使用该模式
+# v2 (增量): 只发送新增内容和消息下标
+#   {"v": 2, "type": "queued", "position": n}   上游繁忙需要排队时推送，位置变化时更新
+#   {"v": 2, "type": "start", "index": i, "timestamp": str}
+#   {"v": 2, "type": "delta", "index": i, "text": str}
+#   {"v": 2, "type": "audio_chunk", "index": i, "seq": n, "format": "pcm", "sample_rate": int, "data": base64}
+#   {"v": 2, "type": "audio", "index": i, "audio_base64": str, "audio_format": str}
+#   {"v": 2, "type": "done",  "index": i, "stopped": bool}
+#
+# 回复过程中客户端可以发送 {"type": "stop"} 中止生成，已生成的部分照常保存，done 帧中 stopped 为 true
+#
+# /ws/chat/session/ 长连接会话只使用 v2，首帧不携带 messages，之后：
+#   服务端  {"v": 2, "type": "session", "history_id": str, "message_count": n}
+#   客户端  {"type": "message", "message": Message, "system_prompt"?: str}，每轮一条
+#   客户端  {"type": "close"}
+#   回复过程中发送新的 message 会中止当前回复，随后开始新的一轮
+#   服务端  {"v": 2, "type": "error", "message": str}，消息无效时返回，会话继续
+#
+# 首帧中还可以携带：
+#   "audio_format": "opus" 或按偏好排列的列表 ["opus", "mp3"]，未携带时为 "wav"
+#   "audio_stream": false  不接收 audio_chunk，只在最后接收完整音频
+
+PROTOCOL_SNAPSHOT = 1
+PROTOCOL_DELTA = 2
+PROTOCOL_VERSIONS = (PROTOCOL_SNAPSHOT, PROTOCOL_DELTA)
+
+# 回复音频的编码：wav 为流式 PCM + 最终的 WAV 文件，mp3 / opus 为压缩格式
+AUDIO_FORMATS = ("wav", "mp3", "opus")
+DEFAULT_AUDIO_FORMAT = "wav"
+
+# 回复过程中会打断生成的客户端帧
+INTERRUPT_FRAMES = ("stop", "message", "close")
+
+
+def negotiate_protocol(data: dict) -> int:
+    """
+    根据客户端首帧中的 "protocol" 字段协商协议版本。
+    未携带或无法识别时回退到快照模式，保证旧客户端可用。
+    """
+    try:
+        requested = int(data.get("protocol", PROTOCOL_SNAPSHOT))
+    except (TypeError, ValueError):
+        return PROTOCOL_SNAPSHOT
+    supported = [v for v in PROTOCOL_VERSIONS if v <= requested]
+    return max(supported) if supported else PROTOCOL_SNAPSHOT
+
+
+def negotiate_audio_format(data: dict) -> str:
+    """
+    根据客户端首帧中的 "audio_format" 字段选择音频编码，
+    可以是单个格式或按偏好排列的列表，取第一个支持的格式；旧客户端回退到 WAV。
+    """
+    requested = data.get("audio_format")
+    if isinstance(requested, str):
+        requested = [requested]
+    if not isinstance(requested, list):
+        return DEFAULT_AUDIO_FORMAT
+    for audio_format in requested:
+        if isinstance(audio_format, str) and audio_format.lower() in AUDIO_FORMATS:
+            return audio_format.lower()
+    return DEFAULT_AUDIO_FORMAT
+
+
+class ChatStreamWriter:
+    """
+    将一次回复的生成过程写入 websocket，屏蔽快照/增量两种协议的差异。
+    chat_data 中的回复消息始终保持最新，便于最终落库。
+    """
+
+    def __init__(self, ws: WebSocket, chat_data: dict, protocol: int = PROTOCOL_SNAPSHOT,
+                 stream_audio: bool = True):
+        """
+        :param stream_audio: 为 False 时不推送 audio_chunk，客户端只播放最终的完整音频
+        """
+        self.ws = ws
+        self.chat_data = chat_data
+        self.protocol = protocol
+        self.stream_audio = stream_audio
+        # 客户端断开后不再推送，回复内容仍然写入 chat_data 以便保存
+        self.closed = False
+        self.index = -1
+        self.audio_seq = 0
+        # token 增量与音频分块由不同协程推送，串行化 websocket 写入
+        self._send_lock = asyncio.Lock()
+
+    @property
+    def message(self) -> dict:
+        return self.chat_data["messages"][self.index]
+
+    async def _send(self, data: dict):
+        async with self._send_lock:
+            if self.closed:
+                return
+            try:
+                await self.ws.send_json(data)
+            except (WebSocketDisconnect, RuntimeError, OSError):
+                self.closed = True
+
+    async def _send_frame(self, frame_type: str, **payload):
+        await self._send({"v": self.protocol, "type": frame_type, "index": self.index, **payload})
+
+    async def start(self, timestamp: str):
+        self.chat_data["messages"].append({"isUser": False, "text": "", "timestamp": timestamp})
+        self.index = len(self.chat_data["messages"]) - 1
+        if self.protocol == PROTOCOL_DELTA:
+            await self._send_frame("start", timestamp=timestamp)
+
+    async def delta(self, text: str):
+        if not text:
+            return
+        self.message["text"] += text
+        if self.protocol == PROTOCOL_DELTA:
+            await self._send_frame("delta", text=text)
+        else:
+            await self._send(self.chat_data)
+
+    async def audio_chunk(self, chunk: bytes, audio_format: str, sample_rate: int):
+        # 快照模式的客户端只接收最终的完整音频
+        if self.protocol != PROTOCOL_DELTA or not self.stream_audio:
+            return
+        await self._send_frame("audio_chunk", seq=self.audio_seq, format=audio_format,
+                               sample_rate=sample_rate, data=base64.b64encode(chunk).decode("utf-8"))
+        self.audio_seq += 1
+
+    async def audio(self, audio_base64: str, audio_format: str = DEFAULT_AUDIO_FORMAT):
+        self.message["audio_base64"] = audio_base64
+        self.message["audio_format"] = audio_format
+        if self.protocol == PROTOCOL_DELTA:
+            await self._send_frame("audio", audio_base64=audio_base64, audio_format=audio_format)
+        else:
+            await self._send(self.chat_data)
+
+    async def session(self, history_id: str, message_count: int):
+        await self._send({"v": PROTOCOL_DELTA, "type": "session", "history_id": history_id,
+                          "message_count": message_count})
+
+    async def queued(self, position: int):
+        if self.protocol == PROTOCOL_DELTA:
+            await self._send({"v": self.protocol, "type": "queued", "position": position})
+
+    async def error(self, message: str):
+        await self._send({"v": self.protocol, "type": "error", "message": message})
+
+    async def done(self, stopped: bool = False):
+        if self.protocol == PROTOCOL_DELTA:
+            await self._send_frame("done", stopped=stopped)
+
+    async def close(self):
+        async with self._send_lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                await self.ws.close()
+            except (WebSocketDisconnect, RuntimeError, OSError):
+                pass
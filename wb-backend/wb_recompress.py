@@ -0,0 +1,94 @@
+import os
+import glob
+import asyncio
+import logging
+import argparse
+
+import dataModel
+import wb_audio
+import wb_telemetry
+from wb_blob import blob_store, parse_data_uri, CHAT_DATA_PATH_ROOT
+
+# 后台重新压缩历史音频：userData/chat/*.json 中的 WAV（内嵌 base64 或 .wav blob）
+# 转为 mp3 / opus 写入 blob 存储，消息改为引用新的 blob 并记录 audio_format。
+# 通过对话存储的接口修改消息，与正在运行的服务共用写回缓存，不会覆盖新写入的数据。
+# 用法: python wb_recompress.py [--format opus]；或设置 WB_AUDIO_RECOMPRESS=1 随服务启动
+
+RECOMPRESS_FORMAT = os.getenv("WB_AUDIO_RECOMPRESS_FORMAT", "mp3")
+# 每条消息处理完后让出的时间，避免占满编码进程池影响在线请求
+RECOMPRESS_PAUSE = float(os.getenv("WB_AUDIO_RECOMPRESS_PAUSE", "0.05"))
+
+_WAV_TYPES = ("audio/wav", "audio/x-wav", "audio/wave")
+
+
+def wav_payload(msg: dict) -> bytes | None:
+    """取出消息中的 WAV 音频，已是压缩格式或没有音频时返回 None"""
+    if msg.get("audio_format") not in (None, "wav"):
+        return None
+    parsed = parse_data_uri(msg.get("audio_base64") or "")
+    if parsed is not None:
+        content_type, data = parsed
+        return data if content_type in _WAV_TYPES else None
+    ref = msg.get("audio_ref")
+    if ref and ref.endswith(".wav") and blob_store.exists(ref):
+        return blob_store.get(ref)
+    return None
+
+
+def chat_user_ids(chat_root: str = CHAT_DATA_PATH_ROOT) -> list[str]:
+    user_ids = []
+    for file_path in glob.glob(os.path.join(chat_root, '*.json')):
+        if file_path.endswith(('_favorites.json', '_index.json')):
+            continue
+        user_ids.append(os.path.splitext(os.path.basename(file_path))[0])
+    return sorted(user_ids)
+
+
+async def recompress_user(user_id: str, audio_format: str = RECOMPRESS_FORMAT) -> int:
+    """重新压缩一个用户的全部历史音频，返回改写的消息数"""
+    content_type = wb_audio.ENCODED_CONTENT_TYPES[audio_format]
+    chatdb = dataModel.open_chat_db(user_id)
+    converted = 0
+    for item in chatdb.get_history_list():
+        history_id = item["id"]
+        for index, msg in enumerate(list(chatdb.get_history_data(history_id) or [])):
+            wav = await asyncio.to_thread(wav_payload, msg)
+            if wav is None:
+                continue
+            audio = await wb_audio.aencode_audio(wav, audio_format)
+            # 编码期间消息可能已被修改或删除，此时放弃本条
+            current = chatdb.get_history_data(history_id) or []
+            if index >= len(current) or current[index] != msg:
+                continue
+            new_msg = dict(msg, audio_base64=None, audio_format=audio_format,
+                           audio_ref=await asyncio.to_thread(blob_store.put, audio, content_type))
+            chatdb.change_chat_in_history(history_id, dataModel.Message(**new_msg), index)
+            converted += 1
+            await asyncio.sleep(RECOMPRESS_PAUSE)
+    return converted
+
+
+async def recompress_chat_files(audio_format: str = RECOMPRESS_FORMAT, chat_root: str = CHAT_DATA_PATH_ROOT) -> int:
+    """依次处理所有用户，可重复执行，已压缩的消息会被跳过"""
+    total = 0
+    for user_id in chat_user_ids(chat_root):
+        try:
+            converted = await recompress_user(user_id, audio_format)
+        except Exception as e:
+            # 多半是缺少 ffmpeg 或音频损坏，记录后继续处理其他用户
+            wb_telemetry.log_event("audio_recompress_failed", logging.WARNING, user_id=user_id, error=str(e))
+            continue
+        if converted:
+            wb_telemetry.log_event("audio_recompressed", user_id=user_id, messages=converted, audio_format=audio_format)
+        total += converted
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--format", default=RECOMPRESS_FORMAT, choices=sorted(wb_audio.ENCODINGS))
+    args = parser.parse_args()
+    count = asyncio.run(recompress_chat_files(args.format))
+    dataModel.chat_store_cache.flush_all()
+    wb_audio.shutdown_executor()
+    print(f"{count} message(s) recompressed")
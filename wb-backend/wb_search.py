@@ -0,0 +1,272 @@
+import os
+import re
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import wb_telemetry
+
+# 对话全文检索：每个用户一个 SQLite FTS5 倒排索引（userData/search/<user_id>.db）。
+# 中日韩文字没有空格分词，入库前切成相邻两字的 bigram（并补上末尾单字），
+# 其它文字按单词切分，再交给 FTS5 的 unicode61 分词器按空格建索引。
+# 对话存储的增删改会同步更新索引；索引不存在或更新失败时，下次搜索前从存储整体重建。
+
+SEARCH_DATA_PATH_ROOT = os.getenv("WB_SEARCH_PATH", "userData/search/")
+# 同时保持打开的用户索引数
+SEARCH_MAX_OPEN = int(os.getenv("WB_SEARCH_MAX_OPEN", "64"))
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_SNIPPET_CHARS = 60
+
+# 平假名/片假名、CJK 统一汉字（含扩展 A）、兼容汉字、韩文音节
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_RUN_PATTERN = re.compile("([" + _CJK + "]+)|([^\\W_" + _CJK + "]+)")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    history_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    tokens TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_docs_history_pos ON docs (history_id, position);
+CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(tokens, content='docs', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS docs_ai AFTER INSERT ON docs BEGIN
+    INSERT INTO docs_fts(rowid, tokens) VALUES (new.id, new.tokens);
+END;
+CREATE TRIGGER IF NOT EXISTS docs_ad AFTER DELETE ON docs BEGIN
+    INSERT INTO docs_fts(docs_fts, rowid, tokens) VALUES ('delete', old.id, old.tokens);
+END;
+CREATE TRIGGER IF NOT EXISTS docs_au AFTER UPDATE ON docs BEGIN
+    INSERT INTO docs_fts(docs_fts, rowid, tokens) VALUES ('delete', old.id, old.tokens);
+    INSERT INTO docs_fts(rowid, tokens) VALUES (new.id, new.tokens);
+END;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _runs(text: str) -> list[tuple[str, bool]]:
+    """切分为 (文字片段, 是否中日韩) 列表"""
+    return [(cjk or word.lower(), bool(cjk)) for cjk, word in _RUN_PATTERN.findall(text or "")]
+
+
+def tokenize(text: str) -> str:
+    """转换为以空格分隔的索引词：中日韩片段为 bigram 加末尾单字，其它为小写单词"""
+    tokens = []
+    for run, cjk in _runs(text):
+        if cjk:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            tokens.append(run[-1])
+        else:
+            tokens.append(run)
+    return " ".join(tokens)
+
+
+def build_match_query(query: str) -> str | None:
+    """
+    把用户输入转换为 FTS5 查询：各片段之间为 AND，
+    多字的中日韩片段按 bigram 短语匹配（即子串匹配），单字与单词按前缀匹配。
+    """
+    terms = []
+    for run, cjk in _runs(query):
+        if cjk and len(run) > 1:
+            terms.append('"' + " ".join(run[i:i + 2] for i in range(len(run) - 1)) + '"')
+        else:
+            terms.append('"' + run + '"*')
+    return " AND ".join(terms) if terms else None
+
+
+def make_snippet(text: str, query: str, width: int = SEARCH_SNIPPET_CHARS) -> str:
+    """截取第一个命中词附近的文字"""
+    lowered = text.lower()
+    hits = [i for i in (lowered.find(run) for run, _ in _runs(query)) if i >= 0]
+    start = max(0, min(hits) - width // 3) if hits else 0
+    end = min(len(text), start + width)
+    start = max(0, min(start, end - width))
+    snippet = text[start:end].replace("\n", " ")
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(text) else "")
+
+
+class UserSearchIndex:
+    """单个用户的索引文件，读写都经过同一个连接，由锁串行化"""
+
+    def __init__(self, user_id: str, root: str = SEARCH_DATA_PATH_ROOT):
+        os.makedirs(root, exist_ok=True)
+        self.user_id = user_id
+        self.lock = threading.RLock()
+        # 借用计数与是否已被 LRU 淘汰，由 SearchIndex 在其锁内维护
+        self.refs = 0
+        self.evicted = False
+        self.conn = sqlite3.connect(os.path.join(root, user_id + ".db"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+
+    @property
+    def built(self) -> bool:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'built'").fetchone()
+        return row is not None and row[0] == "1"
+
+    def set_built(self, built: bool):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', ?)", ("1" if built else "0",))
+
+    def sync_history(self, history_id: str, messages: list):
+        """按位置比较文本，只改写新增或变化的消息"""
+        existing = dict(self.conn.execute(
+            "SELECT position, text FROM docs WHERE history_id = ?", (history_id,)).fetchall())
+        for position, msg in enumerate(messages):
+            self.sync_message(history_id, position, msg, existing.get(position))
+        self.conn.execute("DELETE FROM docs WHERE history_id = ? AND position >= ?", (history_id, len(messages)))
+
+    def sync_message(self, history_id: str, position: int, msg: dict, current: str | None = None):
+        text = (msg.get("text") or "").strip()
+        if text == (current or ""):
+            return
+        if not text:
+            self.conn.execute("DELETE FROM docs WHERE history_id = ? AND position = ?", (history_id, position))
+            return
+        self.conn.execute(
+            "INSERT INTO docs (history_id, position, text, tokens) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (history_id, position) DO UPDATE SET text = excluded.text, tokens = excluded.tokens",
+            (history_id, position, text, tokenize(text)))
+
+    def remove_history(self, history_id: str):
+        self.conn.execute("DELETE FROM docs WHERE history_id = ?", (history_id,))
+
+    @wb_telemetry.timed(wb_telemetry.STORE_SECONDS, backend="search", op="rebuild")
+    def rebuild(self, store):
+        """从对话存储重建：逐段对比同步，并删除存储中已不存在的历史"""
+        history_ids = [item["id"] for item in store.get_history_list()]
+        for history_id in history_ids:
+            self.sync_history(history_id, store.get_history_data(history_id) or [])
+        indexed = {row[0] for row in self.conn.execute("SELECT DISTINCT history_id FROM docs")}
+        for history_id in indexed - set(history_ids):
+            self.remove_history(history_id)
+        self.set_built(True)
+        self.conn.commit()
+
+    @wb_telemetry.timed(wb_telemetry.STORE_SECONDS, backend="search", op="query")
+    def search(self, query: str, limit: int) -> list[dict]:
+        match = build_match_query(query)
+        if match is None:
+            return []
+        # bm25 越小越相关；每段历史取最相关的一条消息（SQLite 的 MIN 聚合会同时返回该行的其它列）
+        rows = self.conn.execute(
+            "SELECT d.history_id, d.position, d.text, MIN(m.score), COUNT(*) FROM ("
+            "  SELECT rowid, rank AS score FROM docs_fts WHERE docs_fts MATCH ?"
+            ") m JOIN docs d ON d.id = m.rowid GROUP BY d.history_id ORDER BY MIN(m.score) LIMIT ?",
+            (match, limit)).fetchall()
+        return [{"id": history_id, "position": position, "snippet": make_snippet(text, query),
+                 "score": round(-score, 4), "match_count": count}
+                for history_id, position, text, score, count in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SearchIndex:
+    """
+    进程级的用户索引管理，按 LRU 保持打开的连接。
+    存储修改时调用 update_* / remove_* 增量更新，失败时只记录日志并标记索引待重建，不影响保存。
+    连接按借用计数关闭：被淘汰时仍有线程在使用的索引，等最后一个使用者归还后再关闭。
+    """
+
+    def __init__(self, root: str = SEARCH_DATA_PATH_ROOT, max_open: int = SEARCH_MAX_OPEN):
+        self.root = root
+        self.max_open = max_open
+        self._indexes: OrderedDict[str, UserSearchIndex] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def use(self, user_id: str):
+        """借用用户的索引，退出时归还"""
+        idle = []
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None:
+                self._indexes.move_to_end(user_id)
+            else:
+                index = self._indexes[user_id] = UserSearchIndex(user_id, self.root)
+                while len(self._indexes) > max(self.max_open, 1):
+                    evicted = self._indexes.popitem(last=False)[1]
+                    evicted.evicted = True
+                    if evicted.refs == 0:
+                        idle.append(evicted)
+            index.refs += 1
+        for evicted in idle:
+            evicted.close()
+        try:
+            yield index
+        finally:
+            with self._lock:
+                index.refs -= 1
+                close = index.evicted and index.refs == 0
+            if close:
+                index.close()
+
+    def _apply(self, user_id: str, op: str, func, *args):
+        try:
+            with self.use(user_id) as index, index.lock:
+                try:
+                    func(index, *args)
+                    index.conn.commit()
+                except Exception:
+                    index.conn.rollback()
+                    index.set_built(False)
+                    index.conn.commit()
+                    raise
+        except Exception as e:
+            wb_telemetry.log_event("search_index_failed", logging.WARNING, user_id=user_id, op=op, error=str(e))
+
+    def update_history(self, user_id: str, history_id: str, messages: list):
+        self._apply(user_id, "update_history", UserSearchIndex.sync_history, history_id, messages)
+
+    def update_message(self, user_id: str, history_id: str, position: int, msg: dict):
+        def sync(index: UserSearchIndex):
+            current = index.conn.execute("SELECT text FROM docs WHERE history_id = ? AND position = ?",
+                                         (history_id, position)).fetchone()
+            index.sync_message(history_id, position, msg, current[0] if current else None)
+        self._apply(user_id, "update_message", sync)
+
+    def update_messages(self, user_id: str, history_id: str, start: int, messages: list):
+        """从 start 位置起连续写入多条消息，在同一个事务中提交"""
+        def sync(index: UserSearchIndex):
+            existing = dict(index.conn.execute(
+                "SELECT position, text FROM docs WHERE history_id = ? AND position >= ? AND position < ?",
+                (history_id, start, start + len(messages))).fetchall())
+            for position, msg in enumerate(messages, start):
+                index.sync_message(history_id, position, msg, existing.get(position))
+        self._apply(user_id, "update_messages", sync)
+
+    def remove_history(self, user_id: str, history_id: str):
+        self._apply(user_id, "remove_history", UserSearchIndex.remove_history, history_id)
+
+    def clear_user(self, user_id: str):
+        self._apply(user_id, "clear_user", lambda index: index.conn.execute("DELETE FROM docs"))
+
+    def search(self, user_id: str, query: str, store, limit: int = SEARCH_DEFAULT_LIMIT) -> list[dict]:
+        """
+        返回按相关度排序的历史 id 与命中片段。
+        :param store: 用户的对话存储，索引未建立时从中重建
+        """
+        with self.use(user_id) as index, index.lock:
+            if not index.built:
+                index.rebuild(store)
+            return index.search(query, limit)
+
+    def close_all(self):
+        with self._lock:
+            idle = []
+            for index in self._indexes.values():
+                index.evicted = True
+                if index.refs == 0:
+                    idle.append(index)
+            self._indexes.clear()
+        for index in idle:
+            index.close()
+
+
+search_index = SearchIndex()
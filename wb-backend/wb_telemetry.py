@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import functools
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+# 运行指标与结构化日志
+# 指标以 Prometheus 文本格式从 /metrics 导出；实现只覆盖本项目用到的计数器、仪表和直方图，不引入额外依赖
+# 日志每行一个 JSON 对象，高频事件按 WB_LOG_SAMPLE_RATE 采样，警告及以上级别总是输出
+
+LOG_LEVEL = os.getenv("WB_LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.getenv("WB_LOG_SAMPLE_RATE", "1.0"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(ABC):
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    @abstractmethod
+    def _new_child(self): ...
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            return child
+
+    # 返回 (名称后缀, 标签, 值) 序列
+    @abstractmethod
+    def _samples(self): ...
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            yield "", dict(zip(self.labelnames, key)), child.value
+
+
+class _GaugeChild(_CounterChild):
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+
+class Gauge(Counter):
+    metric_type = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _HistogramChild:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _samples(self):
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            labels = dict(zip(self.labelnames, key))
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", {**labels, "le": _format_value(float(bound))}, cumulative
+            yield "_bucket", {**labels, "le": "+Inf"}, count
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# 一轮对话各阶段耗时：accept / format_messages / ttft / generation / tts / save / turn
+CHAT_STAGE_SECONDS = Histogram("wb_chat_stage_seconds", "Duration of each stage of a chat turn.", ("stage",))
+CHAT_TURNS = Counter("wb_chat_turns_total", "Chat turns handled over /ws/chat/.", ("model", "status"))
+LLM_TTFT_SECONDS = Histogram("wb_llm_ttft_seconds", "Upstream time to first token.", ("model",))
+LLM_TOKEN_RATE = Histogram("wb_llm_tokens_per_second", "Upstream generation speed after the first token.",
+                           ("model",), buckets=(5, 10, 20, 40, 80, 160, 320))
+LLM_TOKENS = Counter("wb_llm_tokens_total", "Token usage reported by the upstream.", ("model", "kind"))
+TTS_SECONDS = Histogram("wb_tts_seconds", "Streaming speech synthesis duration per reply.", ("cached",))
+STORE_SECONDS = Histogram("wb_store_seconds", "Chat history store load and save duration.", ("backend", "op"))
+ASR_FINALIZE_SECONDS = Histogram("wb_asr_finalize_seconds", "Time from end of speech input to the final transcript.")
+ASR_SESSIONS = Counter("wb_asr_sessions_total", "Realtime speech recognition sessions over /ws/asr/.", ("status",))
+# 上游调用的准入控制（wb_admission），model 为对话、语音合成或图像生成的模型名
+UPSTREAM_QUEUE_DEPTH = Gauge("wb_upstream_queue_depth", "Upstream calls waiting for a concurrency slot.", ("model",))
+UPSTREAM_ACTIVE = Gauge("wb_upstream_active", "Upstream calls currently holding a concurrency slot.", ("model",))
+UPSTREAM_WAIT_SECONDS = Histogram("wb_upstream_wait_seconds", "Time spent queued before an upstream call.", ("model",))
+UPSTREAM_REJECTED = Counter("wb_upstream_rejected_total", "Upstream calls rejected because the queue was full.",
+                            ("model",))
+UPSTREAM_RETRIES = Counter("wb_upstream_retries_total", "Upstream calls retried after a 429 response.", ("model",))
+
+
+def timed(metric: Histogram, **labels):
+    """函数装饰器：把每次调用的耗时记录到 metric 的对应标签下"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metric.labels(**labels).time():
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        data.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+logger = logging.getLogger("wb")
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(JsonFormatter())
+    logger.addHandler(_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+def log_event(event: str, level: int = logging.INFO, sampled: bool = False, exc_info=None, **fields):
+    """
+    输出一条结构化日志。
+
+    :param event: 事件名，如 "chat_turn"
+    :param sampled: 为 True 时按 LOG_SAMPLE_RATE 采样（仅对 WARNING 以下级别生效）
+    :param fields: 附加字段，原样写入 JSON
+    """
+    if sampled and level < logging.WARNING and random.random() >= LOG_SAMPLE_RATE:
+        return
+    logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
@@ -0,0 +1,140 @@
+import os
+import re
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+# 语音合成结果缓存：内存 LRU + 磁盘两级，按 (模型, 音色, 格式, 规范化文本) 的哈希寻址
+
+USER_DATA_PATH_ROOT = 'userData/'
+TTS_CACHE_PATH_ROOT = USER_DATA_PATH_ROOT + 'audio/tts_cache/'
+TTS_CACHE_MEMORY_BYTES = int(os.getenv("WB_TTS_CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+TTS_CACHE_DISK_BYTES = int(os.getenv("WB_TTS_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    # 全角/半角统一，合并空白，使只在空白上有差异的文本命中同一条缓存
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text or "")).strip()
+
+
+class TTSCache:
+    def __init__(self, root: str = TTS_CACHE_PATH_ROOT, memory_bytes: int = TTS_CACHE_MEMORY_BYTES,
+                 disk_bytes: int = TTS_CACHE_DISK_BYTES):
+        self.root = root
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_size = 0
+        self._disk_size = None
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, voice: str, audio_format, text: str) -> str:
+        raw = "\n".join([model, voice, str(audio_format), normalize_text(text)])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old)
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return data
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # 更新访问时间，磁盘淘汰按最久未使用进行
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        if not data:
+            return
+        with self._lock:
+            self._remember(key, data)
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._disk_size is not None:
+                self._disk_size += len(data)
+        self._evict_disk()
+
+    def _scan_disk(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for dir_path, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict_disk(self):
+        with self._lock:
+            if self._disk_size is None:
+                self._disk_size = sum(size for _, size, _ in self._scan_disk())
+            if self._disk_size <= self.disk_bytes:
+                return
+            # 超出上限时删除最久未访问的文件，直到降到上限的 90%
+            target = self.disk_bytes * 0.9
+            for _, size, path in sorted(self._scan_disk()):
+                if self._disk_size <= target:
+                    break
+                try:
+                    os.remove(path)
+                    self._disk_size -= size
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "disk_bytes": self._disk_size,
+            }
+
+
+tts_cache = TTSCache()
@@ -0,0 +1,9 @@
+const Domain = "127.0.0.1:8000"
+
+export const apiDomain = "http://" + Domain;  // Set the API domain
+export const wsDomain = "ws://" + Domain;
+
+// 历史消息中的音频/图片以 blob 引用保存，通过该地址获取原始数据
+export const blobUrl = (ref) => `${apiDomain}/api/blob/${ref}`;
+// 图片的缩略图（服务端生成并缓存），点击后再加载原图
+export const thumbnailUrl = (ref) => `${apiDomain}/api/blob/${ref}/thumbnail`;
@@ -0,0 +1,144 @@
+// 回复语音的边收边播：/ws/chat/session/ 的 audio_chunk 帧按到达顺序排队播放
+// mp3 分块通过 MediaSource 追加到同一个 <audio>，浏览器不支持时改为请求 PCM（wav），用 Web Audio 逐块排期播放
+
+const MP3_MIME = 'audio/mpeg';
+
+export const canStreamMp3 = () => typeof MediaSource !== 'undefined' && MediaSource.isTypeSupported(MP3_MIME);
+
+// 流式播放时请求的编码：Ogg Opus 的分块无法单独追加播放，因此不参与协商
+export const streamingAudioFormats = () => (canStreamMp3() ? ['mp3'] : ['wav']);
+
+const decodeBase64 = (data) => {
+  const binary = atob(data);
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) {
+    bytes[i] = binary.charCodeAt(i);
+  }
+  return bytes;
+};
+
+let audioContext = null;
+
+// 需在用户操作（如点击发送）中调用一次，浏览器才允许之后自动播放
+export const unlockAudio = () => {
+  if (!audioContext && typeof AudioContext !== 'undefined') {
+    audioContext = new AudioContext();
+  }
+  if (audioContext && audioContext.state === 'suspended') {
+    audioContext.resume();
+  }
+};
+
+// 16bit 单声道 PCM：每块转换为 AudioBuffer，紧接上一块的结束时间播放
+const createPcmPlayer = () => {
+  unlockAudio();
+  const sources = new Set();
+  let playAt = 0;
+  // 分块可能在采样中间切开，剩余的奇数字节留到下一块
+  let carry = null;
+
+  return {
+    push(bytes, sampleRate) {
+      if (carry) {
+        const joined = new Uint8Array(carry.length + bytes.length);
+        joined.set(carry);
+        joined.set(bytes, carry.length);
+        bytes = joined;
+        carry = null;
+      }
+      if (bytes.length % 2) {
+        carry = bytes.slice(-1);
+        bytes = bytes.subarray(0, bytes.length - 1);
+      }
+      if (!bytes.length) return;
+      const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+      const buffer = audioContext.createBuffer(1, bytes.length / 2, sampleRate);
+      const channel = buffer.getChannelData(0);
+      for (let i = 0; i < channel.length; i++) {
+        channel[i] = view.getInt16(i * 2, true) / 32768;
+      }
+      const source = audioContext.createBufferSource();
+      source.buffer = buffer;
+      source.connect(audioContext.destination);
+      source.onended = () => sources.delete(source);
+      // 留出少量缓冲，避免首块因调度延迟被截掉开头
+      playAt = Math.max(playAt, audioContext.currentTime + 0.05);
+      source.start(playAt);
+      playAt += buffer.duration;
+      sources.add(source);
+    },
+    end() {},
+    stop() {
+      sources.forEach((source) => source.stop());
+      sources.clear();
+    }
+  };
+};
+
+// mp3：分块按顺序追加到 SourceBuffer，上一块追加完成前新到的块先排队
+const createMp3Player = () => {
+  const mediaSource = new MediaSource();
+  const audio = new Audio();
+  audio.src = URL.createObjectURL(mediaSource);
+  const queue = [];
+  let sourceBuffer = null;
+  let ended = false;
+
+  const drain = () => {
+    if (!sourceBuffer || sourceBuffer.updating || mediaSource.readyState !== 'open') return;
+    if (queue.length) {
+      sourceBuffer.appendBuffer(queue.shift());
+    } else if (ended) {
+      mediaSource.endOfStream();
+    }
+  };
+
+  mediaSource.addEventListener('sourceopen', () => {
+    sourceBuffer = mediaSource.addSourceBuffer(MP3_MIME);
+    sourceBuffer.mode = 'sequence';
+    sourceBuffer.addEventListener('updateend', drain);
+    drain();
+  });
+
+  return {
+    push(bytes) {
+      queue.push(bytes);
+      drain();
+      if (audio.paused) {
+        audio.play().catch((error) => console.warn('Audio playback blocked:', error));
+      }
+    },
+    end() {
+      ended = true;
+      drain();
+    },
+    stop() {
+      queue.length = 0;
+      audio.pause();
+      URL.revokeObjectURL(audio.src);
+    }
+  };
+};
+
+// 一轮回复的播放器：首个 audio_chunk 帧到达时按其编码创建
+export const createAudioStream = () => {
+  let player = null;
+
+  return {
+    push(frame) {
+      if (!player) {
+        player = frame.format === 'mp3' ? createMp3Player() : createPcmPlayer();
+      }
+      player.push(decodeBase64(frame.data), frame.sample_rate);
+    },
+    // 回复结束：已收到的分块播放完毕后自然停止
+    end() {
+      if (player) player.end();
+    },
+    // 中止回复：立即停止播放
+    stop() {
+      if (player) player.stop();
+      player = null;
+    }
+  };
+};